@@ -1,14 +1,18 @@
 # This stuff deals with user registration and authentication
-from flask import Blueprint, session, redirect, url_for, render_template, request, g
+from flask import Blueprint, session, redirect, url_for, render_template, request, g, make_response
 from flask_wtf import FlaskForm
 from wtforms import StringField, PasswordField, SubmitField
 from wtforms.validators import DataRequired, Email
 from backend.database import user_functions
-from backend.blueprints.session_manager import Session, session_manager
+from backend.password_hasher import HasherBusy
+from backend.blueprints.session_manager import Session, session_manager, encode_session_id, decode_session_id
 from sqlalchemy import exc # For various database exceptions
 
 bp = Blueprint("auth", __name__)
 
+# Seconds a client is asked to wait before trying again when the password hashing is overloaded
+RETRY_AFTER = 2
+
 class UserRegistrationForm(FlaskForm):
     username = StringField("Username", validators=[DataRequired()])
     password = PasswordField("Password", validators=[DataRequired()])
@@ -21,6 +25,12 @@ class UserLoginForm(FlaskForm):
     password = PasswordField("Password", validators=[DataRequired()])
     submit = SubmitField("Log in")
 
+def hasher_busy():
+    # Response to a login or registration that couldn't be hashed because too many are waiting
+    response = make_response(render_template("error.html", error_message="Too many logins right now, please try again in a few seconds"), 503)
+    response.headers["Retry-After"] = str(RETRY_AFTER)
+    return response
+
 @bp.route("/register", methods=("GET", "POST"))
 def register():
     form = UserRegistrationForm()
@@ -51,11 +61,13 @@ def register():
         # FIXME: REST API and shit for this crap, making it possible to see the error
         # in real time on the web browser, rather than only after the request.
         return render_template("error.html", error_message="Username or email already exists")
+    except HasherBusy:
+        return hasher_busy()
     # If execution reached here, the registration was successful
     # Create a session for the user and redirect them to the index page
     user_obj = user_functions.get_user_by_name(username)
     session_obj = Session(user_obj.id)
-    session["session_id"] = session_obj.session_id
+    session["session_id"] = encode_session_id(session_obj.session_id)
     session_manager.add_token(session_obj.session_id, session_obj)
     return redirect(url_for("index"))
 
@@ -74,18 +86,20 @@ def login():
     except (AttributeError, TypeError):
         # Verification failed due an error
         return render_template("error.html", error_message="Verification failed")
+    except HasherBusy:
+        return hasher_busy()
     if verified:
         # Success. Create the session cookie and all that shit
         user_obj = user_functions.get_user_by_name(username)
         session_obj = Session(user_obj.id)
-        session["session_id"] = session_obj.session_id
+        session["session_id"] = encode_session_id(session_obj.session_id)
         session_manager.add_token(session_obj.session_id, session_obj)
     return redirect(url_for("index"))
 
 @bp.route("/logout", methods=("GET",))
 def logout():
     # Clear out the session
-    session_manager.expire_token(session.get("session_id"))
+    session_manager.expire_token(decode_session_id(session.get("session_id")))
     session.clear()
     g.user = None
     return redirect(url_for("index"))
@@ -93,11 +107,12 @@ def logout():
 @bp.before_app_request
 def get_logged_in_user():
     # Get the logged in user based on the session ID
-    session_id = session.get("session_id")
+    session_id = decode_session_id(session.get("session_id"))
     session_object = session_manager.get_token_object(session_id)
     if session_object is None:
         g.user = None
     else:
         # an active session was found
-        user = user_functions.get_user_by_id(session_object.user_id)
+        # g.user is a cached UserSnapshot, not the ORM object
+        user = user_functions.get_user_snapshot(session_object.user_id)
         g.user = user # None if not found
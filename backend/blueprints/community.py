@@ -1,16 +1,28 @@
-from flask import Blueprint, g, session, redirect, url_for, render_template, request
+from flask import Blueprint, g, session, redirect, url_for, render_template, request, jsonify
 from datetime import datetime, timedelta
 from backend.blueprints.session_manager import session_manager
-from backend.database import community_functions, user_functions
+from backend.database import community_functions, user_functions, post_functions, comment_functions, permission_functions
+from backend.blueprints.conditional import page_etag, not_modified, add_validator
+from backend.cache import LRUCache
+from backend.models import Community, Post
 
 bp = Blueprint("community", __name__)
 
-def get_recent_posts(community):
-    # Get all the posts that were added to the community
-    # within the last 24 hours
+# How much of a thread viewpost shows at first
+THREAD_DEPTH = 10
+THREAD_COMMENTS = 500
+# Posts per page of a community's index
+POSTS_PER_PAGE = 25
+
+# community name: community id, so that a community page's ETag can be checked without a query
+community_ids = LRUCache(max_entries=10000, ttl=timedelta(minutes=5))
+
+def get_recent_posts(community, cursor=None):
+    # Get a page of the posts that were added to the community
+    # within the last 24 hours, newest first.
+    # Returns (posts, cursor of the next page or None)
     timeLimit = datetime.utcnow() - timedelta(days=1)
-    posts = Post.query.filter(Post.community_id == community.id and Post.post_time >= timeLimit).all()
-    return posts
+    return post_functions.get_posts_page([community.id], "new", cursor, POSTS_PER_PAGE, since=timeLimit)
 
 @bp.route("/community/create", methods=("GET", "POST"))
 def create():
@@ -53,9 +65,10 @@ def join():
         # Community not found?
         return render_template("error.html", error_message="No such community")
 
-    # Checks passed
-    community.users.append(g.user)
-    db.session.commit()
+    # Checks passed. g.user is a cached snapshot, not an ORM object: join through
+    # community_functions, which also invalidates the user's cached identity and permissions.
+    community_functions.join(g.user.id, community.id)
+    return redirect(url_for("community.index", name=community.name))
 
 @bp.route("/community/ban", methods=("POST",))
 def ban():
@@ -65,13 +78,32 @@ def ban():
 @bp.route("/community/<string:name>", methods=("GET",))
 def index(name):
     # Show the community, posts, etc
-    community = Community.query.filter(Community.name == name).first()
-    if not community:
-        # 404 it
-        return render_template("404.html"), 404
+    community = None
+    community_id = community_ids.get(name)
+    if community_id is None:
+        community = Community.query.filter(Community.name == name).first()
+        if not community:
+            # 404 it
+            return render_template("404.html"), 404
+        community_id = community.id
+        community_ids.set(name, community_id)
+    cursor = request.args.get("cursor")
+    etag = page_etag([("community", community_id)], "community", name, cursor)
+    response = not_modified(etag)
+    if response:
+        return response
+    if community is None:
+        community = Community.query.filter(Community.id == community_id).first()
+        if not community:
+            # Deleted since its ID was cached, look the name up again
+            community_ids.invalidate(name)
+            return index(name)
     # found it, get the latest posts
-    posts = getRecentPosts(community)
-    return render_template("community/index.html", name=name, posts=posts)
+    try:
+        posts, next_cursor = get_recent_posts(community, cursor)
+    except ValueError:
+        return render_template("error.html", error_message="Invalid page"), 400
+    return add_validator(render_template("community/index.html", name=name, posts=posts, next_cursor=next_cursor), etag)
 
 @bp.route("/community/post", methods=("GET", "POST"))
 def post():
@@ -85,28 +117,69 @@ def post():
     title = request.form["title"]
     text = request.form["text"]
     
-    userObj = g.user
-    community = Community.query.filter(Community.id == community_id)
+    community = Community.query.filter(Community.id == community_id).first()
     if not community:
         # ...community doesn't exist?
         # TODO: "something went wrong" page that redirects to index
         error_message = "Community doesn't exist"
         return render_template("error.html", error_message=error_message)
     
-    if not post or not title:
+    if not text or not title:
         # Meaningful message
         return render_template("error.html", error_message="Post title or body missing")
 
-    if not community in userObj.communities or community in userObj.banned_on:
+    if not permission_functions.is_member(g.user.id, community.id) or permission_functions.is_banned(g.user.id, community.id):
         # User is not a member of the community, or is banned from participating in it
         return redirect(url_for('community.index', name=community.name))
 
     # Success
-    postObj = Post(user_id=user_id, community_id=community.id, title=title, text=text)
-    community.posts.append(postObj)
-    db.session.commit()
-    return redirect(url_for("community.viewpost", id=postObj.id))
+    post_id = post_functions.create_post(g.user.id, community.id, title, text)
+    return redirect(url_for("community.viewpost", id=post_id))
+
+def can_view(community):
+    # Private communities are only visible to their members
+    return not community.is_private or (g.user and permission_functions.is_member(g.user.id, community.id))
 
 @bp.route("/community/viewpost/<int:id>", methods=("GET",))
 def viewpost(id):
-    return
+    # Show the post and the first part of its comment thread.
+    # The rest is loaded with the continuation tokens, through comments()
+    etag = page_etag([("post", id)], "viewpost", id)
+    response = not_modified(etag)
+    if response:
+        return response
+    post = Post.query.filter(Post.id == id).first()
+    if not post:
+        return render_template("error.html", error_message="No such post"), 404
+    community = post.community
+    if not can_view(community):
+        return render_template("error.html", error_message="This community is private"), 403
+    tree, next_token = comment_functions.get_thread_page(post.id, max_depth=THREAD_DEPTH, limit=THREAD_COMMENTS)
+    comments = comment_functions.flatten_tree(tree)
+    return add_validator(render_template("community/viewpost.html", post=post, community=community,
+        comments=comments, next_token=next_token), etag)
+
+@bp.route("/community/viewpost/<int:id>/comments", methods=("GET",))
+def comments(id):
+    # More of a post's thread, as JSON: ?token=<continuation token from viewpost or a previous call>
+    post = Post.query.filter(Post.id == id).first()
+    if not post:
+        return jsonify(error="No such post"), 404
+    if not can_view(post.community):
+        return jsonify(error="This community is private"), 403
+    try:
+        tree, next_token = comment_functions.get_thread_page(post.id, request.args.get("token"),
+                max_depth=THREAD_DEPTH, limit=THREAD_COMMENTS)
+    except ValueError:
+        return jsonify(error="Invalid continuation token"), 400
+    comments = [{
+        "id": node.comment.id,
+        "parent_id": node.comment.parent_id,
+        "depth": node.depth,
+        "username": node.username,
+        "text": node.comment.text,
+        "karma": node.comment.karma,
+        "is_pinned": bool(node.comment.is_pinned),
+        "more_replies": node.more_replies,
+        } for node in comment_functions.flatten_tree(tree)]
+    return jsonify(comments=comments, next_token=next_token)
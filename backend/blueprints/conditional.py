@@ -0,0 +1,41 @@
+# Conditional GETs for the listing and post pages.
+# A page's ETag is made of the versions of what it shows (see backend/content_versions.py),
+# so a view can work it out before it loads or renders anything, and answer a request
+# that already has the page (If-None-Match) with an empty 304 Not Modified.
+# Logged in users and anonymous visitors get different ETags, since the pages look
+# different to them, and so do users in different communities.
+from hashlib import sha1
+from flask import g, request, make_response
+from backend.content_versions import content_versions
+
+def viewer():
+    # The part of the ETag that depends on who's looking
+    if g.user is None:
+        return ("anonymous",)
+    return ("user", g.user.id, tuple(community.id for community in g.user.communities))
+
+def page_etag(version_keys, *parts):
+    # ETag of a page showing the contents of <version_keys>.
+    # parts: anything else the page depends on, like its name and URL arguments
+    versions = tuple(content_versions.get(key) for key in version_keys)
+    # What the page is built from, for backend/page_cache.py
+    g.page_versions = dict(zip(version_keys, versions))
+    data = repr((content_versions.generation, viewer(), parts, versions))
+    return sha1(data.encode()).hexdigest()
+
+def not_modified(etag):
+    # The 304 response if the client already has the page with this ETag, otherwise None
+    if etag not in request.if_none_match:
+        return None
+    return add_validator(make_response("", 304), etag)
+
+def add_validator(response, etag):
+    # Send the page's ETag with the response
+    response = make_response(response)
+    response.set_etag(etag)
+    # Browsers check with us before reusing the page, and shared caches don't keep logged in users' pages
+    response.cache_control.no_cache = True
+    if g.user is not None:
+        response.cache_control.private = True
+    response.vary.add("Cookie")
+    return response
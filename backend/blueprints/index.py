@@ -1,6 +1,8 @@
 from flask import Blueprint, g, session, request, url_for, redirect, render_template
 from werkzeug.security import generate_password_hash, check_password_hash
-from ..models import db, Post, User
+from ..models import db, Post, User, Community
+from backend.database import post_functions, search_functions
+from backend.blueprints.conditional import page_etag, not_modified, add_validator
 from flask import jsonify
 
 # This should generate the index template
@@ -12,12 +14,37 @@ bp = Blueprint("index", __name__)
 def index():
     posts = []
     communities = []
+    next_cursor = None
     if g.user:
         communities = g.user.communities
-    return render_template("index.html", posts=posts, communities=communities)
+    cursor = request.args.get("cursor")
+    etag = page_etag([("community", community.id) for community in communities], "index", cursor)
+    response = not_modified(etag)
+    if response:
+        return response
+    if g.user:
+        # The hottest posts from the user's communities, a page at a time
+        try:
+            posts, next_cursor = post_functions.get_hot_posts([community.id for community in communities], cursor)
+        except ValueError:
+            return render_template("error.html", error_message="Invalid page"), 400
+    return add_validator(render_template("index.html", posts=posts, communities=communities, next_cursor=next_cursor), etag)
 
 @bp.route("/search", methods=("GET",))
 def search():
-    pattern = request.args.get("value")
-    print("Search called with: {}".format(pattern))
-    return redirect(url_for("index"))
+    # Search posts, comments and communities: ?value=<words>, optionally &community=<name>
+    value = request.args.get("value", "")
+    community_name = request.args.get("community")
+    community_id = None
+    if community_name:
+        community = Community.query.filter(Community.name == community_name).first()
+        if not community:
+            return render_template("error.html", error_message="No such community"), 404
+        community_id = community.id
+    member_of = [community.id for community in g.user.communities] if g.user else []
+    try:
+        results, next_cursor = search_functions.search(value, community_id, request.args.get("cursor"), member_of=member_of)
+    except ValueError:
+        return render_template("error.html", error_message="Invalid page"), 400
+    return render_template("search.html", value=value, community_name=community_name,
+            results=search_functions.load_results(results), next_cursor=next_cursor)
@@ -2,31 +2,59 @@
 # I implemented this so that we won't have to store the user ID
 # in the session cookie.
 from flask import Blueprint
-from string import ascii_letters, digits
-from random import choice
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from binascii import Error as Base64Error
+from secrets import token_bytes
 from datetime import timedelta
 from backend.token_expiration_manager import TokenExpirationManager
 
 bp = Blueprint("session_manager", __name__)
 
 # Tokens and sessions will expire after approximately 2 hours, give or take 10 minutes.
-session_manager = TokenExpirationManager(session_timeout=timedelta(hours=2), expiration_proximity=timedelta(minutes=10))
+# An active session's expiration time is pushed back at most once every 6 minutes (5% of 2 hours).
+session_manager = TokenExpirationManager(session_timeout=timedelta(hours=2), expiration_proximity=timedelta(minutes=10),
+        touch_granularity=0.05)
 
-def generate_random_tag(length=128):
-    # Generates a random session tag (ID)
-    characters = ascii_letters + digits + "_" # url safe shit
-    tag = "".join([choice(characters) for c in range(length)])
-    return tag
+# Session IDs are kept as raw bytes internally, 32 bytes is 256 bits of randomness.
+# They're only encoded to a url safe string when they go into the session cookie.
+SESSION_ID_BYTES = 32
+
+def generate_session_id(length=SESSION_ID_BYTES):
+    # Generates a random session ID
+    return token_bytes(length)
+
+def encode_session_id(session_id):
+    # bytes -> url safe string for the cookie, without the base64 padding
+    return urlsafe_b64encode(session_id).rstrip(b"=").decode("ascii")
+
+def decode_session_id(cookie_value):
+    # url safe string from the cookie -> bytes
+    # Returns None if there's no session ID or it's not a valid one
+    if not cookie_value:
+        return None
+    try:
+        return urlsafe_b64decode(cookie_value + "=" * (-len(cookie_value) % 4))
+    except (Base64Error, TypeError, ValueError):
+        return None
 
 # Session object
+# __slots__ instead of a __dict__ per instance, there's one of these for every logged in user
 class Session:
+    __slots__ = ("session_id", "user_id")
+
     def __init__(self, user_id):
-        self.session_id = generate_random_tag()
+        self.session_id = generate_session_id()
         self.user_id = user_id
+
     def __repr__(self):
-        return "<Session {}>".format(self.session_id)
+        return "<Session {}>".format(encode_session_id(self.session_id))
+
+# How often the background reaper removes expired sessions
+PURGE_INTERVAL = timedelta(minutes=1)
 
-# Call this before processing each request, to remove any expired sessions
-@bp.before_app_request
-def purge_expired():
-   session_manager.purge_expired_tokens()
+# Start purging expired sessions in the background once the blueprint is registered,
+# so that requests never have to wait for a sweep.
+# The statistics are available through session_manager.get_purge_statistics()
+@bp.record_once
+def start_reaper(state):
+    session_manager.start_reaper(PURGE_INTERVAL)
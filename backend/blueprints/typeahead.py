@@ -0,0 +1,22 @@
+# Search-as-you-type for community names and usernames, as JSON.
+# Served from the in-memory prefix index in backend/prefix_index.py, no query per keystroke.
+from flask import Blueprint, request, jsonify
+from backend.prefix_index import username_index, community_index
+
+bp = Blueprint("typeahead", __name__)
+
+# Most names returned for one prefix
+MAX_MATCHES = 10
+
+@bp.route("/typeahead/communities", methods=("GET",))
+def communities():
+    # ?prefix=<what was typed so far>
+    return jsonify(matches=community_index.complete(request.args.get("prefix", ""), MAX_MATCHES))
+
+@bp.route("/typeahead/users", methods=("GET",))
+def users():
+    # ?prefix=<what was typed so far>
+    # taken tells the registration form whether that exact username already exists.
+    # The database has the final word when the form is sent.
+    prefix = request.args.get("prefix", "")
+    return jsonify(matches=username_index.complete(prefix, MAX_MATCHES), taken=username_index.contains(prefix))
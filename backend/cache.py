@@ -0,0 +1,66 @@
+# Small in-process caches.
+# Each worker process has its own, so anything cached here
+# should either be invalidated explicitly or have a short TTL.
+import sys
+import threading
+from collections import OrderedDict
+from time import monotonic
+
+class LRUCache:
+    def __init__(self, max_entries, ttl=None, max_bytes=None, sizeof=sys.getsizeof):
+        self.max_entries = max_entries
+        self.ttl = ttl.total_seconds() if ttl else None # datetime.timedelta() object, or None for no expiration
+        self.max_bytes = max_bytes # Limit on the total sizeof() of the values, or None for no limit
+        self.sizeof = sizeof # Only called when max_bytes is set
+        self.size = 0 # Total sizeof() of the values
+        self.entries = OrderedDict() # key: (expiration time, value, size), least recently used first
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            expires, value, size = entry
+            if expires is not None and monotonic() >= expires:
+                # Stale, drop it
+                del self.entries[key]
+                self.size -= size
+                self.misses += 1
+                return default
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        expires = monotonic() + self.ttl if self.ttl is not None else None
+        size = self.sizeof(value) if self.max_bytes is not None else 0
+        with self.lock:
+            old_entry = self.entries.get(key)
+            if old_entry is not None:
+                self.size -= old_entry[2]
+            self.entries[key] = (expires, value, size)
+            self.entries.move_to_end(key)
+            self.size += size
+            while len(self.entries) > self.max_entries or (self.max_bytes is not None and self.size > self.max_bytes):
+                # Evict the least recently used entry.
+                # A value bigger than max_bytes on its own evicts everything, itself included.
+                evicted_key, (expires, value, size) = self.entries.popitem(last=False)
+                self.size -= size
+
+    def invalidate(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.size -= entry[2]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def __len__(self):
+        return len(self.entries)
@@ -0,0 +1,48 @@
+# Version counters of what the pages show, for the ETags of conditional GETs
+# (see backend/blueprints/conditional.py).
+# ("community", community_id) changes when a post is added to, removed from, edited or voted on
+# in the community, or when the community itself changes.
+# ("post", post_id) changes when the post, or any of its comments, changes.
+# The functions in backend/database bump them after committing their changes.
+# A version is "<process generation>-<counter>", and one that isn't known yet gets a new one,
+# so versions from before a restart, or from another worker process, never match.
+# Other processes don't see this process' bumps though, which is why the versions
+# also expire after a short while, like the other in-process caches.
+import itertools
+import threading
+from datetime import timedelta
+from secrets import token_hex
+from backend.cache import LRUCache
+
+class ContentVersions:
+    def __init__(self, max_entries=100000, ttl=timedelta(minutes=1)):
+        self.versions = LRUCache(max_entries, ttl) # key: version
+        self.generation = token_hex(4)
+        self.counter = itertools.count(1)
+        self.lock = threading.Lock()
+
+    def new_version(self):
+        return "{}-{}".format(self.generation, next(self.counter))
+
+    def get(self, key):
+        # The current version of the key
+        with self.lock:
+            version = self.versions.get(key)
+            if version is None:
+                version = self.new_version()
+                self.versions.set(key, version)
+            return version
+
+    def bump(self, *keys):
+        # The content of the keys changed
+        with self.lock:
+            for key in keys:
+                self.versions.set(key, self.new_version())
+
+    def bump_communities(self, community_ids):
+        self.bump(*(("community", community_id) for community_id in community_ids))
+
+    def bump_posts(self, post_ids):
+        self.bump(*(("post", post_id) for post_id in post_ids))
+
+content_versions = ContentVersions()
@@ -0,0 +1,20 @@
+# Opaque cursors for pagination: a short list of JSON values, base64 encoded so that
+# they're url safe and clients don't build them by hand.
+# They aren't signed, so whatever is decoded from one still has to be validated.
+import json
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from binascii import Error as Base64Error
+
+def encode_cursor_data(values):
+    data = json.dumps(values, separators=(",", ":")).encode("utf-8")
+    return urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+def decode_cursor_data(cursor):
+    # The list that was encoded. Raises ValueError if <cursor> isn't a valid cursor.
+    try:
+        values = json.loads(urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except (Base64Error, TypeError, ValueError):
+        raise ValueError("invalid cursor")
+    if type(values) is not list:
+        raise ValueError("invalid cursor")
+    return values
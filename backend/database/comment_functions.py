@@ -1,19 +1,26 @@
 # Comment handling functions
 # Not Python comments ;)
 
-from backend.models import User, Community, Post, Comment, db
-from sqlalchemy.orm import exc as orm_exc
+from backend.models import User, Community, Post, Comment, CommentVote, db, COMMENT_PATH_SEGMENT
+from backend.database import permission_functions, vote_functions, search_functions
+from backend.vote_buffer import vote_buffer
+from backend.content_versions import content_versions
+from backend.cursors import encode_cursor_data, decode_cursor_data
+from sqlalchemy import exc, func, exists, and_, or_, case, literal, bindparam
+from sqlalchemy.orm import exc as orm_exc, aliased
 
 # FIXME: the function will still create a comment even if the user_id doesn't exist in the database
-def create_comment(user_id, post_id, text):
+def create_comment(user_id, post_id, text, parent_id=None):
     # Create a comment and add it to the post
+    # parent_id: the comment this one replies to, None for a top level comment.
+    # Raises ValueError if the parent comment isn't in the same post.
     user_obj = User.query.filter(User.id == user_id).first()
     post_obj = Post.query.filter(Post.id == post_id).first()
     community = post_obj.community # Raises AttributeError if post_obj is None
     # Permission checks
     if user_obj is None:
         raise ValueError("user doesn't exist")
-    if user_obj in community.banned_users:
+    if permission_functions.is_banned(user_obj.id, community.id):
         # User is banned from the community and is therefore not allowed to comment
         raise PermissionError("user {} is banned in community {}".format(user_obj, community))
     # Locked post check
@@ -24,17 +31,24 @@ def create_comment(user_id, post_id, text):
     # the thread at all if the community is set to private.
     # But, until we implement the verification in a different layer of the request processing,
     # we will verify it here, for now.
-    if community.is_private and user_obj not in community.users:
+    if community.is_private and not permission_functions.is_member(user_obj.id, community.id):
         raise PermissionError("community {} is private".format(community))
+    if parent_id is not None:
+        parent = Comment.query.filter(Comment.id == parent_id).first()
+        if parent is None or parent.post_id != post_obj.id:
+            raise ValueError("parent comment {} isn't in post {}".format(parent_id, post_obj))
     # Checks passed, let's create the post.
-    comment = Comment(user_id=user_id, post_id=post_id, text=text)
+    comment = Comment(user_id=user_id, post_id=post_id, text=text, parent_id=parent_id)
     db.session.add(comment)
     try:
+        db.session.flush()
+        search_functions.add_to_index("comment", comment.id, community.id, None, text)
         db.session.commit()
     except exc.IntegrityError:
         # some field in the comment object is None
         db.session.rollback()
         raise
+    content_versions.bump_posts([post_id])
 
 # NOTE: this function should only be callable by the user who is the author of the comment
 # or mods/admins/owners in the community
@@ -44,50 +58,277 @@ def delete_comment(comment_id):
     # Err...
     db.session.delete(comment_obj)
     try:
+        post_id = comment_obj.post_id
+        search_functions.remove_from_index("comment", [comment_id])
         db.session.commit()
     except orm_exc.UnmappedInstanceError:
         # Comment object is None
         db.session.rollback()
         raise
+    content_versions.bump_posts([post_id])
 
 # Karma
-def upvote(user_id, comment_id):
+# The votes themselves are handled by vote_functions.set_vote()
+def vote(user_id, comment_id, vote_type):
     # user_id is the voter.
     # we need it to associate the vote with a user so that users
-    # won't be able to just upvote or downvote the post infinitely.
-    comment = Comment.query.filter(Comment.id == comment_id).first()
-    user = User.query.filter(User.id == user_id).first()
-    vote = CommentVote(user_id=user_id, comment_id=comment_id, vote_type=True) # True == +1
-    # Add the vote to the user's comment votes list
-    user.comment_votes.append(vote)
-    comment.votes.append(vote)
-    # Increase the post karma and save changes
-    comment.karma += 1
-    db.session.add(vote)
-    db.session.commit()
-
-def downvote(user_id, post_id):
-    comment = Comment.query.filter(Comment.id == post_id).first()
-    user = User.query.filter(User.id == user_id).first()
-    vote = CommentVote(user_id=user_id, comment_id=comment_id, vote_type=False) # -1
-    user.comment_votes.append(vote)
-    comment.votes.append(vote)
-    comment.karma -= 1
-    db.session.add(vote)
-    db.session.commit()
+    # won't be able to just upvote or downvote the comment infinitely.
+    # vote_type: True for an upvote, False for a downvote, None to remove the vote
+    vote_functions.check_exists(CommentVote, Comment, "comment_id", user_id, comment_id)
+    delta = vote_functions.set_vote(CommentVote, Comment, "comment_id", user_id, comment_id, vote_type)
+    try:
+        db.session.commit()
+    except exc.IntegrityError:
+        db.session.rollback()
+        raise
+    if delta:
+        content_versions.bump_posts(comment_post_ids([comment_id]))
+
+def upvote(user_id, comment_id):
+    vote(user_id, comment_id, True) # True == +1
+
+def downvote(user_id, comment_id):
+    vote(user_id, comment_id, False) # -1
 
 def unvote(user_id, comment_id):
-    # Remove the relationship between the post karma and the user,
-    # and reset the count according to the karma type it was (upvote or downvote)
-    vote = CommentVote.query.fiter(CommentVote.user_id == user_id, CommentVote.comment_id == comment_id).first()
-    comment = vote.comment
-    if vote.vote_type is True:
-        # True vote_type means we need to decrease the comment's karma in this case
-        # because the user removed their upvote
-        comment.karma -= 1
+    # Remove the user's vote from the comment,
+    # and reset the karma according to the vote type it was (upvote or downvote)
+    vote(user_id, comment_id, None)
+
+def queue_vote(user_id, comment_id, vote_type):
+    # Like vote(), but through the write-behind vote buffer instead of committing right away.
+    # Use get_karma() to see the comment's karma including the votes that are still buffered.
+    vote_buffer.record("comment", user_id, comment_id, vote_type)
+
+def get_karma(comment_obj):
+    return vote_buffer.get_karma("comment", comment_obj.id, comment_obj.karma)
+
+def comment_post_ids(comment_ids):
+    # The IDs of the posts the comments are in
+    if not comment_ids:
+        return set()
+    return {post_id for post_id, in db.session.query(Comment.post_id).filter(Comment.id.in_(comment_ids))}
+
+# Threads
+# Comment.path orders a post's comments so that every comment comes right after its parent,
+# so a thread, or any subtree of it, is one range scan of the comment_post_path index,
+# and the tree is built in one pass over the rows.
+
+# The columns a thread is displayed with. Plain rows are much cheaper to load than Comment objects.
+THREAD_COLUMNS = (Comment.id, Comment.parent_id, Comment.path, Comment.user_id, Comment.text,
+        Comment.karma, Comment.is_pinned, Comment.comment_time)
+
+class CommentNode:
+    # A comment in a thread, with its replies
+    __slots__ = ("comment", "username", "depth", "children", "more_replies")
+
+    def __init__(self, row):
+        self.comment = row # THREAD_COLUMNS of the comment, comment.id, comment.text, etc
+        self.username = row.username # The author's username, None if the user was deleted
+        self.depth = len(row.path or "") // COMMENT_PATH_SEGMENT - 1 # 0 for top level comments
+        self.children = []
+        # Continuation token for the replies that weren't loaded because of the depth limit, or None
+        self.more_replies = None
+
+def thread_query(post_id, parent_id=None, max_depth=None, limit=None, after_path=None):
+    # THREAD_COLUMNS of the post's comments with their authors' usernames, in thread order.
+    # parent_id: only the replies under this comment, at any depth.
+    # max_depth: only this many levels, counting from the top level or from <parent_id>.
+    #     The rows then also have has_replies, True for the comments at the last level that have replies.
+    # limit: only the first <limit> comments in thread order.
+    # after_path: only the comments after this path in thread order, to continue where a page ended.
+    query = db.session.query(*THREAD_COLUMNS, User.username).outerjoin(User, User.id == Comment.user_id)
+    query = query.filter(Comment.post_id == post_id)
+    base_length = 0
+    if parent_id is not None:
+        parent = aliased(Comment)
+        parent_path = db.session.query(parent.path).filter(parent.id == parent_id).as_scalar()
+        # Every path under the parent's path starts with it, and ":" sorts right after the digits
+        query = query.filter(Comment.path > parent_path, Comment.path < parent_path + ":")
+        base_length = func.length(parent_path)
+    if after_path is not None:
+        query = query.filter(Comment.path > after_path)
+    query = limit_depth(query, base_length, max_depth)
+    query = query.order_by(Comment.path)
+    if limit is not None:
+        query = query.limit(limit)
+    return query
+
+def limit_depth(query, base_length, max_depth):
+    # Only the comments of the first <max_depth> levels under <base_length>, the length of the parent's path.
+    # Adds has_replies, see thread_query().
+    if max_depth is None:
+        return query
+    max_length = base_length + max_depth * COMMENT_PATH_SEGMENT
+    query = query.filter(func.length(Comment.path) <= max_length)
+    # Whether the replies of the last level were left out. One index seek per comment of the last level.
+    reply = aliased(Comment)
+    has_replies = exists().where(and_(reply.post_id == Comment.post_id,
+        reply.path > Comment.path, reply.path < Comment.path + ":"))
+    return query.add_columns(case([(func.length(Comment.path) == max_length, has_replies)], else_=literal(False)).label("has_replies"))
+
+def top_level_order(comment):
+    # ORDER BY of top level comments in thread_order(), the order of the comment_post_top index
+    return (comment.is_pinned.desc(), comment.karma.desc(), comment.id)
+
+def after_top_level(comment, after):
+    # The top level comments after the one at <after>, its (is_pinned, karma, id), in thread_order()
+    is_pinned, karma, comment_id = after
+    # As a number, SQLAlchemy only compares booleans with = and !=
+    is_pinned = int(is_pinned)
+    return or_(comment.is_pinned < is_pinned, and_(comment.is_pinned == is_pinned,
+        or_(comment.karma < karma, and_(comment.karma == karma, comment.id > comment_id))))
+
+def top_level_query(post_id, max_depth=None, limit=None, after=None):
+    # Like thread_query(), for the post's top level comments only, in thread_order() instead of thread order,
+    # from the comment_post_top index. after: see after_top_level().
+    # The rows also have any_replies, True for the comments that have replies. One index seek per comment.
+    query = db.session.query(*THREAD_COLUMNS, User.username).outerjoin(User, User.id == Comment.user_id)
+    query = query.filter(Comment.post_id == post_id, Comment.parent_id == None)
+    if after is not None:
+        query = query.filter(after_top_level(Comment, after))
+    reply = aliased(Comment)
+    any_replies = exists().where(and_(reply.post_id == Comment.post_id,
+        reply.path > Comment.path, reply.path < Comment.path + ":"))
+    query = limit_depth(query.add_columns(any_replies.label("any_replies")), 0, max_depth)
+    query = query.order_by(*top_level_order(Comment))
+    if limit is not None:
+        query = query.limit(limit)
+    return query
+
+def thread_order(node):
+    # Pinned comments first, then the highest rated, then the oldest
+    return (not node.comment.is_pinned, -(node.comment.karma or 0), node.comment.id)
+
+def build_comment_tree(rows, sort_roots=True):
+    # Build the tree from thread_query() rows, in one pass.
+    # Returns the top level nodes. Comments whose parent isn't in the rows
+    # (like the first replies of a subtree) are top level nodes too.
+    # sort_roots: False to keep the top level nodes in the order of the rows.
+    nodes = {}
+    roots = []
+    for row in rows:
+        node = CommentNode(row)
+        nodes[row.id] = node
+        parent = nodes.get(row.parent_id)
+        if parent is None:
+            roots.append(node)
+        else:
+            parent.children.append(node)
+    # Sort each comment's replies, without asking the database
+    if sort_roots:
+        roots.sort(key=thread_order)
+    for node in nodes.values():
+        if len(node.children) > 1:
+            node.children.sort(key=thread_order)
+    return roots
+
+def get_comment_tree(post_id, parent_id=None, max_depth=None, limit=None):
+    # The post's comments as a tree, with one query. See thread_query() for the arguments.
+    return build_comment_tree(thread_query(post_id, parent_id, max_depth, limit))
+
+# Streaming huge threads.
+# Nothing here loads a whole thread: iter_thread() reads it in chunks, and get_thread_page()
+# returns a bounded part of it, with continuation tokens for the rest. So the memory
+# needed to view a thread doesn't depend on how many comments it has.
+# THREAD_CHUNK_SIZE rows are fetched from the database at a time.
+THREAD_CHUNK_SIZE = 1000
+
+def iter_thread(post_id, parent_id=None, max_depth=None, limit=None, after_path=None, chunk_size=THREAD_CHUNK_SIZE):
+    # Iterate over the thread_query() rows, holding only <chunk_size> of them at a time
+    return thread_query(post_id, parent_id, max_depth, limit, after_path).yield_per(chunk_size)
+
+def encode_thread_token(post_id, parent_id, after_path, after_root=None):
+    return encode_cursor_data([post_id, parent_id, after_path, after_root])
+
+def decode_thread_token(token, post_id):
+    # (parent_id, after_path, after_root) of a continuation token for the post's thread.
+    # Raises ValueError if it isn't a valid token for this post.
+    try:
+        token_post_id, parent_id, after_path, after_root = decode_cursor_data(token)
+    except (TypeError, ValueError):
+        raise ValueError("invalid continuation token")
+    if token_post_id != post_id or not (parent_id is None or type(parent_id) is int) or not (after_path is None or type(after_path) is str):
+        raise ValueError("invalid continuation token")
+    if after_root is not None:
+        if (parent_id is not None or after_path is None or not isinstance(after_root, list) or len(after_root) != 3
+                or type(after_root[0]) is not bool or type(after_root[1]) is not int or type(after_root[2]) is not int):
+            raise ValueError("invalid continuation token")
+        after_root = tuple(after_root)
+    return parent_id, after_path, after_root
+
+def top_level_position(row):
+    # (is_pinned, karma, id) of a top level comment, where a page of top level comments continues
+    return (bool(row.is_pinned), row.karma or 0, row.id)
+
+def get_thread_page(post_id, token=None, max_depth=10, limit=500):
+    # A bounded part of the post's thread, as a tree: at most <limit> comments and <max_depth> levels.
+    # token: a continuation token from a previous page, for more of the thread
+    #     or for the replies under a comment that were left out.
+    # Returns (top level nodes, continuation token for the rest of this part of the thread or None).
+    # Nodes whose replies were left out because of the depth limit have a more_replies token.
+    # The comments of a continued page whose parents were on an earlier page are top level nodes,
+    # their comment.parent_id says where they belong.
+    parent_id, after_path, after_root = decode_thread_token(token, post_id) if token else (None, None, None)
+    if parent_id is None:
+        rows, next_token = top_level_thread_page(post_id, max_depth, limit, after_root, after_path)
     else:
-        # False means we need to increase the karma because the user removed their downvote
-        comment.karma += 1
-    # Remove the vote object altogether
-    db.session.delete(vote)
-    db.session.commit()
+        # The replies under a comment, in thread order. One more than the limit, to know whether there's more.
+        rows = list(iter_thread(post_id, parent_id, max_depth, limit + 1, after_path, chunk_size=min(limit + 1, THREAD_CHUNK_SIZE)))
+        next_token = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_token = encode_thread_token(post_id, parent_id, rows[-1].path)
+    # The top level comments are already in thread_order(), and continued replies go before them
+    roots = build_comment_tree(rows, sort_roots=parent_id is not None)
+    for node in flatten_tree(roots):
+        if getattr(node.comment, "has_replies", False):
+            node.more_replies = encode_thread_token(post_id, node.comment.id, None)
+    return roots, next_token
+
+def top_level_thread_page(post_id, max_depth, limit, after_root=None, after_path=None):
+    # The rows of a page of the whole thread: the top level comments in thread_order(), pinned and
+    # highest rated first, each followed by its replies. So the comments everyone sees first are the
+    # ones on the first page, however long the thread is.
+    # One query for the top level comments, and one range scan for the replies of each of them
+    # that has some, stopping as soon as the page is full.
+    # after_root, after_path: where the previous page ended, the position of a top level comment
+    #     and the path of the last comment shown in its subtree.
+    # Returns (rows, continuation token or None).
+    rows = []
+    positions = [] # top_level_position() of the top level comment of each row
+    if after_root is not None:
+        # The rest of the replies of the last top level comment of the previous page
+        replies = thread_query(post_id, after_root[2], max_depth - 1, limit + 1, after_path).all() if max_depth > 1 else []
+        rows.extend(replies)
+        positions.extend([after_root] * len(replies))
+    if len(rows) <= limit:
+        # The replies of one top level comment: built and compiled once, run for each of them
+        replies_query = thread_query(post_id, bindparam("root_id"), max_depth - 1, bindparam("remaining")).statement
+        connection = db.session.connection().execution_options(compiled_cache={})
+        # Every top level comment takes at least one row
+        for root in top_level_query(post_id, max_depth, limit + 1 - len(rows), after_root):
+            position = top_level_position(root)
+            rows.append(root)
+            positions.append(position)
+            if root.any_replies and max_depth > 1 and len(rows) <= limit:
+                replies = connection.execute(replies_query, root_id=root.id, remaining=limit + 1 - len(rows)).fetchall()
+                rows.extend(replies)
+                positions.extend([position] * len(replies))
+            if len(rows) > limit:
+                break
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, encode_thread_token(post_id, None, rows[-1].path, positions[limit - 1])
+
+def flatten_tree(roots):
+    # The nodes in display order, each followed by its replies, without recursion
+    # so that deep threads don't hit the recursion limit
+    flat = []
+    stack = roots[::-1]
+    while stack:
+        node = stack.pop()
+        flat.append(node)
+        stack.extend(reversed(node.children))
+    return flat
@@ -1,4 +1,9 @@
 from backend.models import Community, User, db
+from backend.identity_cache import identity_cache
+from backend.content_versions import content_versions
+from backend.prefix_index import community_index
+from backend.database.permission_functions import invalidate_permissions
+from backend.database import search_functions
 from sqlalchemy import exc
 from sqlalchemy.orm import exc as orm_exc
 
@@ -28,6 +33,8 @@ def create_community(name, description, owner_user_id):
     # It will raise FlushError if the user object is None.
     try:
         db.session.add(community)
+        db.session.flush()
+        search_functions.add_to_index("community", community.id, community.id, name, description)
         db.session.commit()
     except (exc.IntegrityError, orm_exc.FlushError) as e:
         # Something went wrong, rollback the changes
@@ -35,20 +42,36 @@ def create_community(name, description, owner_user_id):
         # inform the user of the failure.
         db.session.rollback()
         raise e
+    community_index.add(name)
+    # The owner is now a member of the community
+    identity_cache.invalidate(owner_user_id)
+    invalidate_permissions(owner_user_id, community.id)
 
 def delete_community(community_id):
     # delete the community
     # first we gotta remove all the community->user relationships
     # if community_id is [], set(), {}, etc, will raise exc.InterfaceError
     community = Community.query.filter(Community.id == community_id).first()
+    # Every user who had any relationship with the community loses it,
+    # so their cached identities and permissions are invalidated afterwards.
+    # if community is None, will raise AttributeError
+    affected_user_ids = set()
+    for relationship in Community.user_departure_relationships + ("banned_users",):
+        affected_user_ids.update(user_obj.id for user_obj in getattr(community, relationship))
     for relationship in Community.deletion_relationships:
-        # if community is None, will raise AttributeError
         list_obj = getattr(community, relationship)
         list_obj.clear()
     # Now that all the relationships have been deleted,
     # we delete the community itself
+    name = community.name
     db.session.delete(community)
+    search_functions.remove_from_index("community", [community_id])
     db.session.commit()
+    community_index.remove(name)
+    for user_id in affected_user_ids:
+        identity_cache.invalidate(user_id)
+        invalidate_permissions(user_id, community_id)
+    content_versions.bump_communities([community_id])
 
 def add_user(user_id, community_id, key):
     # Generalized function to append a user object to a community list object.
@@ -66,6 +89,9 @@ def add_user(user_id, community_id, key):
         # AttributeError: raised on list_object.append() if the user was some non-user object, but not None
         db.session.rollback()
         raise
+    identity_cache.invalidate(user_id)
+    invalidate_permissions(user_id, community_id)
+    content_versions.bump_communities([community_id])
 
 def delete_user(user_id, community_id, key):
     # Generalized function like add_user(), but for removal of users from lists.
@@ -79,6 +105,9 @@ def delete_user(user_id, community_id, key):
     except orm_exc.FlushError:
         db.session.rollback()
         raise
+    identity_cache.invalidate(user_id)
+    invalidate_permissions(user_id, community_id)
+    content_versions.bump_communities([community_id])
 
 def join(user_id, community_id):
     # the user with <user_id> joins the community <community_id>
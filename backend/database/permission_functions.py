@@ -0,0 +1,68 @@
+# Permission checks: is the user a member of the community, banned from it,
+# one of its moderators, admins, or owners.
+# All five facts about a (user_id, community_id) pair are loaded together with one
+# UNION query against the association tables' primary keys, and cached as a bitmask,
+# so a permission check is usually just a dictionary lookup.
+# The cache is invalidated by community_functions and user_functions whenever
+# they change a relationship. Other worker processes don't see those invalidations,
+# so the entries also expire after a minute.
+from datetime import timedelta
+from backend.cache import LRUCache
+from backend.models import db, memberships, bans, moderators, admins, owners
+from sqlalchemy import select, literal, and_, union_all
+
+# Permission bits
+MEMBER = 1
+BANNED = 2
+MODERATOR = 4
+ADMIN = 8
+OWNER = 16
+
+# Which association table each bit comes from
+PERMISSION_TABLES = ((MEMBER, memberships), (BANNED, bans), (MODERATOR, moderators), (ADMIN, admins), (OWNER, owners))
+
+# (user_id, community_id): bitmask
+permission_cache = LRUCache(max_entries=100000, ttl=timedelta(minutes=1))
+
+def permissions_query(user_id, community_id):
+    # One row with the table's bit for each table the pair is found in
+    queries = []
+    for bit, table in PERMISSION_TABLES:
+        condition = and_(table.c.user_id == user_id, table.c.community_id == community_id)
+        queries.append(select([literal(bit)]).where(condition))
+    return union_all(*queries)
+
+def load_permissions(user_id, community_id):
+    # Build the bitmask from the database
+    permissions = 0
+    for row in db.session.execute(permissions_query(user_id, community_id)):
+        permissions |= row[0]
+    return permissions
+
+def get_permissions(user_id, community_id):
+    # The permission bitmask of the user in the community, 0 if they have no relationship with it
+    key = (user_id, community_id)
+    permissions = permission_cache.get(key)
+    if permissions is None:
+        permissions = load_permissions(user_id, community_id)
+        permission_cache.set(key, permissions)
+    return permissions
+
+def invalidate_permissions(user_id, community_id):
+    # Call this after changing any of the user's relationships with the community
+    permission_cache.invalidate((user_id, community_id))
+
+def is_member(user_id, community_id):
+    return bool(get_permissions(user_id, community_id) & MEMBER)
+
+def is_banned(user_id, community_id):
+    return bool(get_permissions(user_id, community_id) & BANNED)
+
+def is_moderator(user_id, community_id):
+    return bool(get_permissions(user_id, community_id) & MODERATOR)
+
+def is_admin(user_id, community_id):
+    return bool(get_permissions(user_id, community_id) & ADMIN)
+
+def is_owner(user_id, community_id):
+    return bool(get_permissions(user_id, community_id) & OWNER)
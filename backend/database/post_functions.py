@@ -1,13 +1,20 @@
 from backend.models import User, Community, Post, PostVote, db
-from sqlalchemy import exc
+from backend.database import permission_functions, vote_functions, search_functions
+from backend.vote_buffer import vote_buffer
+from backend.hot_feed import hot_feed
+from backend.fragment_cache import fragment_cache
+from backend.content_versions import content_versions
+from sqlalchemy import exc, select, union_all, tuple_
 from sqlalchemy.orm import exc as orm_exc
+from backend.cursors import encode_cursor_data, decode_cursor_data
+from datetime import datetime
 
 # FIXME: shitload of verifications in this one, just trust data instead?
 def create_post(user_id, community_id, post_title, post_body):
     # This function can only be called when user is logged in
     # So the user id must be a valid one because it's derived from the session handler
     # input: (int, int, str, str)
-    # Create a new post
+    # Create a new post, returns its ID
     community = Community.query.filter(Community.id == community_id).first()
     user_obj = User.query.filter(User.id == user_id).first()
     if user_obj is None:
@@ -15,19 +22,26 @@ def create_post(user_id, community_id, post_title, post_body):
     if community is None:
         raise ValueError("community doesn't exist")
 
-    if user_obj in community.banned_users:
+    if permission_functions.is_banned(user_obj.id, community.id):
         raise PermissionError("user {} is banned on {}".format(user_obj, community))
-    if community.is_private and user_obj not in community.users:
+    if community.is_private and not permission_functions.is_member(user_obj.id, community.id):
         raise PermissionError("community {} is private".format(community))
     # Create it now
     post_obj = Post(user_id=user_id, community_id=community_id, title=post_title, body=post_body)
     db.session.add(post_obj)
     try:
+        # Flush first, so that the new post's ID and hot score don't have to be read back after the commit
+        db.session.flush()
+        post_id, post_score = post_obj.id, post_obj.hot_score
+        search_functions.add_to_index("post", post_id, community_id, post_title, post_body)
         db.session.commit()
     except (exc.IntegrityError, exc.InterfaceError): 
         # if the title or body is None, IntegrityError
         db.session.rollback()
         raise
+    hot_feed.update(community_id, post_id, post_score)
+    content_versions.bump_communities([community_id])
+    return post_id
 
 def delete_post(post_id):
     # This should not be called by users with no special permissions on the group
@@ -35,11 +49,17 @@ def delete_post(post_id):
     post = Post.query.filter(Post.id == post_id).first()
     try:
         db.session.delete(post)
+        community_id = post.community_id
+        search_functions.remove_post_from_index(post_id)
         db.session.commit()
     except orm_exc.UnmappedInstanceError:
         # post is None
         db.session.rollback()
         raise
+    hot_feed.update(community_id, post_id, None)
+    fragment_cache.invalidate([post_id])
+    content_versions.bump_communities([community_id])
+    content_versions.bump_posts([post_id])
 
 def edit_post(post_id, title, body):
     # Edit an existing post
@@ -50,62 +70,143 @@ def edit_post(post_id, title, body):
     post = Post.query.filter(Post.id == post_id).first()
     post.title = title # AttributeError if post is None
     post.body = body # AttributeError if post is None
+    post.version = Post.version + 1 # The cached HTML of the post is stale now
+    community_id = post.community_id
+    search_functions.update_in_index("post", post_id, title, body)
     db.session.commit()
+    fragment_cache.invalidate([post_id])
+    content_versions.bump_communities([community_id])
+    content_versions.bump_posts([post_id])
 
 # Karma
-def upvote(user_id, post_id):
+# The votes themselves are handled by vote_functions.set_vote()
+def vote(user_id, post_id, vote_type):
     # user_id is the voter.
     # we need it to associate the vote with a user so that users
     # won't be able to just upvote or downvote the post infinitely.
-    post = Post.query.filter(Post.id == post_id).first()
-    user = User.query.filter(User.id == user_id).first()
-    if user is None:
-        raise ValueError("user doesn't exist")
-    if post is None:
-        raise ValueError("post doesn't exist")
-    vote = PostVote(user_id=user_id, post_id=post_id, vote_type=True) # True == +1
-    # Add the vote to the user's post votes list
-    user.post_votes.append(vote)
-    post.votes.append(vote)
-    # Increase the post karma and save changes
-    post.karma += 1
-    db.session.add(vote)
+    # vote_type: True for an upvote, False for a downvote, None to remove the vote
+    vote_functions.check_exists(PostVote, Post, "post_id", user_id, post_id)
+    delta = vote_functions.set_vote(PostVote, Post, "post_id", user_id, post_id, vote_type)
     try:
         db.session.commit()
     except exc.IntegrityError:
         db.session.rollback()
         raise
+    if delta:
+        community_ids = hot_feed.refresh_posts([post_id])
+        content_versions.bump_communities(community_ids)
+        content_versions.bump_posts([post_id])
+
+def upvote(user_id, post_id):
+    vote(user_id, post_id, True) # True == +1
 
 def downvote(user_id, post_id):
-    post = Post.query.filter(Post.id == post_id).first()
-    user = User.query.filter(User.id == user_id).first()
-    if user is None:
-        raise ValueError("user doesn't exist")
-    if post is None:
-        raise ValueError("post doesn't exist")
-    vote = PostVote(user_id=user_id, post_id=post_id, vote_type=False) # -1
-    user.post_votes.append(vote)
-    post.votes.append(vote)
-    post.karma -= 1
-    db.session.add(vote)
-    try:
-        db.session.commit()
-    except exc.IntegrityError:
-        db.session.rollback()
-        raise
+    vote(user_id, post_id, False) # -1
 
 def unvote(user_id, post_id):
-    # Remove the relationship between the post karma and the user,
-    # and reset the count according to the karma type it was (upvote or downvote)
-    vote = PostVote.query.filter(PostVote.user_id == user_id, PostVote.post_id == post_id).first()
-    post = vote.post
-    if vote.vote_type is True:
-        # True vote_type means we need to decrease the post's karma in this case
-        # because the user removed their upvote
-        post.karma -= 1
-    else:
-        # False means we need to increase the karma because the user removed their downvote
-        post.karma += 1
-    # Remove the vote object altogether
-    db.session.delete(vote)
-    db.session.commit()
+    # Remove the user's vote from the post,
+    # and reset the karma according to the vote type it was (upvote or downvote)
+    vote(user_id, post_id, None)
+
+def queue_vote(user_id, post_id, vote_type):
+    # Like vote(), but through the write-behind vote buffer instead of committing right away.
+    # Use get_karma() to see the post's karma including the votes that are still buffered.
+    vote_buffer.record("post", user_id, post_id, vote_type)
+
+def get_karma(post_obj):
+    return vote_buffer.get_karma("post", post_obj.id, post_obj.karma)
+
+def render_post(post_obj):
+    # The post's HTML for the listings, from the fragment cache, with the karma from get_karma().
+    # Available to the templates as render_post(post).
+    return fragment_cache.render_post(post_obj, get_karma(post_obj))
+
+# Listing posts a page at a time.
+# Pages are keyset paginated: each page continues after the (sort key, id) of the last post
+# of the previous page, which the post_community_time and post_community_hot_score indexes
+# can seek to directly. So a deep page costs the same as the first one, unlike OFFSET,
+# and posts added in the meantime don't shift the pages.
+# The position is handed to the client as an opaque cursor.
+
+# Sort orders: name: (column, how it's stored in the cursor, how it's read back from it)
+POST_ORDERS = {
+        "new": (Post.post_time, datetime.isoformat, datetime.fromisoformat),
+        "hot": (Post.hot_score, float, float),
+        }
+
+# How many communities are read with one query.
+# Stays under SQLite's limit of 500 terms in a compound SELECT.
+PAGE_CHUNK_SIZE = 100
+
+def encode_cursor(order, sort_value, post_id):
+    # The position after a post, as a url safe string
+    to_cursor = POST_ORDERS[order][1]
+    return encode_cursor_data([order, to_cursor(sort_value), post_id])
+
+def decode_cursor(cursor, order):
+    # The (sort value, post id) that <cursor> points after.
+    # Raises ValueError if it isn't a cursor for <order>.
+    try:
+        cursor_order, sort_value, post_id = decode_cursor_data(cursor)
+        if cursor_order != order or type(post_id) is not int:
+            raise ValueError
+        return POST_ORDERS[order][2](sort_value), post_id
+    except (TypeError, ValueError):
+        raise ValueError("invalid cursor")
+
+def get_posts_page(community_ids, order="new", cursor=None, count=25, since=None):
+    # A page of the posts in the communities, newest or hottest first.
+    # cursor: from the previous page, None for the first page.
+    # since: only posts from this datetime on.
+    # Reads at most <count> index entries per community, however deep the page is.
+    # Returns (posts, cursor of the next page or None if this was the last page).
+    # Raises ValueError for an unknown order or an invalid cursor.
+    if order not in POST_ORDERS:
+        raise ValueError("unknown order {}".format(order))
+    after = decode_cursor(cursor, order) if cursor else None
+    community_ids = list(dict.fromkeys(community_ids))
+    rows = []
+    for start in range(0, len(community_ids), PAGE_CHUNK_SIZE):
+        queries = []
+        for community_id in community_ids[start:start + PAGE_CHUNK_SIZE]:
+            query = posts_page_query(community_id, order, after, count, since)
+            queries.append(select([query.alias()]))
+        statement = union_all(*queries) if len(queries) > 1 else queries[0]
+        rows.extend(tuple(row) for row in db.session.execute(statement))
+    # Merge the communities' pages
+    rows.sort(reverse=True)
+    rows = rows[:count]
+    next_cursor = encode_cursor(order, *rows[-1]) if len(rows) == count else None
+    return load_posts([post_id for sort_value, post_id in rows]), next_cursor
+
+def posts_page_query(community_id, order, after, count, since=None):
+    # The (sort value, id) of a page of one community's posts
+    column = POST_ORDERS[order][0]
+    query = select([column, Post.id]).where(Post.community_id == community_id)
+    if after is not None:
+        query = query.where(tuple_(column, Post.id) < tuple_(*after))
+    if since is not None:
+        query = query.where(Post.post_time >= since)
+    return query.order_by(column.desc(), Post.id.desc()).limit(count)
+
+def load_posts(post_ids):
+    # The posts, in the order of <post_ids>
+    if not post_ids:
+        return []
+    posts = {post.id: post for post in Post.query.filter(Post.id.in_(post_ids))}
+    # Deleted in the meantime by another process, if it's missing
+    return [posts[post_id] for post_id in post_ids if post_id in posts]
+
+def get_hot_posts(community_ids, cursor=None, count=25):
+    # A page of the hottest posts across the communities, for the front page.
+    # Served from the in-memory hot feed when it can, otherwise from the database.
+    # Returns (posts, cursor of the next page or None).
+    after = decode_cursor(cursor, "hot") if cursor else None
+    post_ids = hot_feed.get_feed(community_ids, count, after)
+    if post_ids is None:
+        return get_posts_page(community_ids, "hot", cursor, count)
+    posts = load_posts(post_ids)
+    next_cursor = None
+    if len(post_ids) == count and posts:
+        next_cursor = encode_cursor("hot", posts[-1].hot_score or 0, posts[-1].id)
+    return posts, next_cursor
@@ -0,0 +1,108 @@
+# Index audit: runs EXPLAIN QUERY PLAN on the queries the application makes,
+# and reports the ones that scan a whole table instead of using an index.
+# Run it with "python main.py explain-queries".
+# When adding a query on a hot path, add it to known_queries() too.
+import re
+from datetime import datetime
+from sqlalchemy import event
+from backend.models import User, Community, Post, Comment, PostVote, CommentVote, db, comment_path_segment
+from backend.database import permission_functions, post_functions, user_functions, vote_functions, comment_functions, search_functions
+from backend.hot_feed import hot_feed
+
+# "SCAN post", "SCAN post USING INDEX ...", or "SCAN TABLE post" on older SQLite versions.
+# Tables aliased by SQLAlchemy show up as e.g. memberships_1.
+# Subqueries and the like show up as SCAN too, so only real tables count.
+SCAN_PATTERN = re.compile(r"^SCAN (?:TABLE )?(\w+?)(?:_\d+)?\b")
+# Scanning a partial index only reads the rows it was made for, which is fine
+PARTIAL_INDEX_PATTERN = re.compile(r"USING (?:COVERING )?INDEX (\w+)")
+
+# Relationships that are loaded lazily: (model, relationship name)
+RELATIONSHIPS = (
+        (User, "posts"), (User, "comments"), (User, "post_votes"), (User, "comment_votes"),
+        (User, "communities"), (User, "owner"), (User, "admin"), (User, "moderator"), (User, "banned_on"),
+        (Community, "users"), (Community, "owners"), (Community, "admins"), (Community, "moderators"),
+        (Community, "banned_users"), (Community, "posts"),
+        (Post, "comments"), (Post, "votes"), (Comment, "votes"),
+        )
+
+def known_queries():
+    # (name, statement, parameters) of the queries to check, with made up values
+    queries = [
+            ("user by name", User.query.filter(User.username == "name").statement, None),
+            ("user by id", User.query.filter(User.id == 1).statement, None),
+            ("permissions", permission_functions.permissions_query(1, 1), None),
+            ("hot feed ranking", hot_feed.ranking_query(1), None),
+            ("load posts", Post.query.filter(Post.id.in_([1, 2, 3])).statement, None),
+            ("recompute karma users", db.session.query(User.id, User.karma).filter(User.id > 1).order_by(User.id).limit(100).statement, None),
+            ]
+    for order, after in (("new", (datetime(2024, 1, 1), 1)), ("hot", (1.5, 1))):
+        queries.append(("posts page {}".format(order), post_functions.posts_page_query(1, order, None, 25), None))
+        queries.append(("posts page {} after cursor".format(order), post_functions.posts_page_query(1, order, after, 25), None))
+    queries.append(("recent posts page", post_functions.posts_page_query(1, "new", None, 25, since=datetime(2024, 1, 1)), None))
+    queries.append(("comment thread", comment_functions.thread_query(1, max_depth=10, limit=500).statement, None))
+    queries.append(("comment subtree", comment_functions.thread_query(1, parent_id=1, max_depth=3).statement, None))
+    after_path = comment_path_segment(1)
+    queries.append(("comment thread after token", comment_functions.thread_query(1, max_depth=10, limit=500, after_path=after_path).statement, None))
+    queries.append(("top level comments", comment_functions.top_level_query(1, max_depth=10, limit=501).statement, None))
+    queries.append(("top level comments after token", comment_functions.top_level_query(1, max_depth=10, limit=501, after=(False, 3, 1)).statement, None))
+    queries.append(("search", search_functions.search_query('"word"', hidden=[1]), None))
+    queries.append(("private communities", db.session.query(Community.id).filter(Community.is_private == True).statement, None))
+    queries.append(("search in community after cursor", search_functions.search_query('"word"', 1, (-1.5, 3), 25), None))
+    vote_parameters = {"vote_user_id": 1, "vote_target_id": 1, "vote_type_": True, "vote_time": datetime(2024, 1, 1), "delta": 1,
+            "vote_user_ids": [1, 2], "vote_target_ids": [1, 2]}
+    for vote_model, target_model, target_key in ((PostVote, Post, "post_id"), (CommentVote, Comment, "comment_id")):
+        for name, statement in vote_functions.get_statements(vote_model, target_model, target_key).items():
+            queries.append(("{} vote: {}".format(target_model.__tablename__, name), statement, vote_parameters))
+        queries.append(("{} vote: batch delete".format(target_model.__tablename__),
+            vote_functions.batch_delete_statement(vote_model, target_key, 2), {"u0": 1, "t0": 1, "u1": 2, "t1": 1}))
+        karma_query = user_functions.karma_query(vote_model, target_model, getattr(vote_model, target_key), 1, 10000)
+        queries.append(("recompute karma from {} votes".format(target_model.__tablename__), karma_query.statement, None))
+    for model, relationship in RELATIONSHIPS:
+        # The query of a lazy load of the relationship
+        instance = model(id=1)
+        related_model = getattr(model, relationship).property.mapper.class_
+        query = db.session.query(related_model).with_parent(instance, relationship)
+        queries.append(("{}.{}".format(model.__name__, relationship), query.statement, None))
+    return queries
+
+def explain(statement, parameters=None):
+    # The EXPLAIN QUERY PLAN lines of the statement, which isn't actually run.
+    # Rolls the session back, so only use it outside of other work.
+    plan = []
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        return "EXPLAIN QUERY PLAN " + statement, parameters
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        plan.extend(row[-1] for row in cursor.fetchall())
+    engine = db.session.get_bind()
+    event.listen(engine, "before_cursor_execute", before_cursor_execute, retval=True)
+    event.listen(engine, "after_cursor_execute", after_cursor_execute)
+    try:
+        db.session.execute(statement, parameters or {})
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+        event.remove(engine, "after_cursor_execute", after_cursor_execute)
+        db.session.rollback()
+    return plan
+
+def partial_indexes():
+    # Names of the indexes with a WHERE clause
+    return {index.name for table in db.metadata.tables.values() for index in table.indexes
+            if index.dialect_options["sqlite"]["where"] is not None}
+
+def full_scans(plan):
+    # The tables that the plan reads entirely
+    tables = []
+    partial = partial_indexes()
+    for line in plan:
+        match = SCAN_PATTERN.match(line)
+        if match and match.group(1) in db.metadata.tables:
+            index_match = PARTIAL_INDEX_PATTERN.search(line)
+            if index_match and index_match.group(1) in partial:
+                continue
+            tables.append(match.group(1))
+    return tables
+
+def audit():
+    # Returns a list of (query name, plan lines, tables scanned in full)
+    return [(name, plan, full_scans(plan)) for name, plan in
+            ((name, explain(statement, parameters)) for name, statement, parameters in known_queries())]
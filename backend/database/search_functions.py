@@ -0,0 +1,137 @@
+# Full text search over posts, comments and communities.
+# Everything searchable is in the search_index FTS5 table (see backend/models.py), which the
+# functions creating, editing and deleting posts, comments and communities keep in sync,
+# in the same transaction as the change itself.
+# Results are ranked with BM25, best first, and keyset paginated on (rank, rowid) like the
+# post listings, with an opaque cursor. The ranks depend on the whole index, so a page loaded
+# after the index changed can repeat or miss a result at its start.
+import re
+from collections import namedtuple
+from sqlalchemy import table, column, select, literal, and_, or_
+from backend.models import Post, Comment, Community, db, SEARCH_KIND_NAMES, SEARCH_KINDS
+from backend.cursors import encode_cursor_data, decode_cursor_data
+
+search_index = table("search_index", column("rowid"), column("community_id"), column("title"), column("body"), column("rank"))
+# The table's hidden column of the same name, the left side of a full text MATCH
+search_match = column("search_index")
+
+# Words as the default FTS5 tokenizer sees them
+WORD_PATTERN = re.compile(r"\w+")
+
+SearchResult = namedtuple("SearchResult", ("kind", "id", "community_id", "rank"))
+
+def search_rowid(kind, target_id):
+    return target_id * SEARCH_KINDS + SEARCH_KIND_NAMES.index(kind)
+
+def add_to_index(kind, target_id, community_id, title, body):
+    # kind: "post", "comment" or "community". Comments have no title.
+    # Replaces what's left of an earlier row with the same ID, SQLite can reuse the highest ID after a delete.
+    statement = search_index.insert().prefix_with("OR REPLACE").values(rowid=search_rowid(kind, target_id), community_id=community_id, title=title, body=body)
+    db.session.execute(statement)
+
+def update_in_index(kind, target_id, title, body):
+    statement = search_index.update().where(search_index.c.rowid == search_rowid(kind, target_id)).values(title=title, body=body)
+    db.session.execute(statement)
+
+def remove_from_index(kind, target_ids):
+    rowids = [search_rowid(kind, target_id) for target_id in target_ids]
+    db.session.execute(search_index.delete().where(search_index.c.rowid.in_(rowids)))
+
+def remove_post_from_index(post_id):
+    # The post and all of its comments. Call it before the comments are deleted.
+    comment_rowids = select([Comment.id * SEARCH_KINDS + SEARCH_KIND_NAMES.index("comment")]).where(Comment.post_id == post_id)
+    db.session.execute(search_index.delete().where(search_index.c.rowid.in_(comment_rowids)))
+    remove_from_index("post", [post_id])
+
+def index_sources():
+    # (kind, SELECT of rowid, community_id, title, body) of everything that goes into the index
+    kind_index = {kind: literal(index) for index, kind in enumerate(SEARCH_KIND_NAMES)}
+    return (
+            ("post", select([Post.id * SEARCH_KINDS + kind_index["post"], Post.community_id, Post.title, Post.body])),
+            ("comment", select([Comment.id * SEARCH_KINDS + kind_index["comment"], Post.community_id, literal(None), Comment.text])
+                .select_from(Comment.__table__.join(Post.__table__))),
+            ("community", select([Community.id * SEARCH_KINDS + kind_index["community"], Community.id, Community.name, Community.description])),
+            )
+
+def rebuild_index():
+    # Index everything again from scratch, e.g. for a database from before the search index.
+    # Returns the number of rows indexed.
+    db.session.execute(search_index.delete())
+    count = 0
+    for kind, query in index_sources():
+        columns = [search_index.c.rowid, search_index.c.community_id, search_index.c.title, search_index.c.body]
+        count += db.session.execute(search_index.insert().from_select(columns, query)).rowcount
+    db.session.commit()
+    return count
+
+def match_expression(text):
+    # The FTS5 query for the user's search: every word has to be in the result.
+    # The words are quoted, so nothing the user types is taken as query syntax.
+    # None if there are no words.
+    words = WORD_PATTERN.findall(text or "")
+    if not words:
+        return None
+    return " ".join('"{}"'.format(word) for word in words)
+
+def hidden_communities(member_of=()):
+    # IDs of the private communities that aren't in <member_of>, from the community_private index
+    query = db.session.query(Community.id).filter(Community.is_private == True)
+    return [community_id for community_id, in query if community_id not in member_of]
+
+def search_query(expression, community_id=None, after=None, limit=25, hidden=()):
+    # after: (rank, rowid) of the last result of the previous page.
+    # hidden: IDs of the communities to leave out.
+    # Filtering on community_id reads it for every match, so it's only done when needed.
+    query = select([search_index.c.rowid, search_index.c.community_id, search_index.c.rank]).where(search_match.op("MATCH")(expression))
+    if community_id is not None:
+        query = query.where(search_index.c.community_id == community_id)
+    elif hidden:
+        query = query.where(search_index.c.community_id.notin_(list(hidden)))
+    if after is not None:
+        rank, rowid = after
+        query = query.where(or_(search_index.c.rank > rank, and_(search_index.c.rank == rank, search_index.c.rowid > rowid)))
+    return query.order_by(search_index.c.rank, search_index.c.rowid).limit(limit)
+
+def encode_search_cursor(expression, community_id, rank, rowid):
+    return encode_cursor_data([expression, community_id, rank, rowid])
+
+def decode_search_cursor(cursor, expression, community_id):
+    # The (rank, rowid) that <cursor> points after.
+    # Raises ValueError if it isn't a cursor of this search.
+    data = decode_cursor_data(cursor)
+    if (not isinstance(data, list) or len(data) != 4 or data[:2] != [expression, community_id]
+            or not isinstance(data[2], (int, float)) or not isinstance(data[3], int)):
+        raise ValueError("invalid search cursor")
+    return data[2], data[3]
+
+def search(text, community_id=None, cursor=None, count=25, member_of=()):
+    # Search for <text>, in one community or everywhere.
+    # member_of: IDs of the private communities the searching user can see.
+    # Returns (list of SearchResult, cursor of the next page or None).
+    # Raises ValueError if the cursor is invalid.
+    expression = match_expression(text)
+    if expression is None:
+        return [], None
+    after = decode_search_cursor(cursor, expression, community_id) if cursor else None
+    hidden = hidden_communities(set(member_of))
+    if community_id in hidden:
+        return [], None
+    rows = db.session.execute(search_query(expression, community_id, after, count + 1, hidden)).fetchall()
+    results = [SearchResult(SEARCH_KIND_NAMES[rowid % SEARCH_KINDS], rowid // SEARCH_KINDS, result_community_id, rank)
+            for rowid, result_community_id, rank in rows[:count]]
+    next_cursor = None
+    if len(rows) > count:
+        rowid, result_community_id, rank = rows[count - 1]
+        next_cursor = encode_search_cursor(expression, community_id, rank, rowid)
+    return results, next_cursor
+
+def load_results(results):
+    # The Post, Comment and Community objects of the results, as (kind, object) in the same order.
+    # Leaves out anything that no longer exists.
+    models = {"post": Post, "comment": Comment, "community": Community}
+    objects = {}
+    for kind, model in models.items():
+        ids = [result.id for result in results if result.kind == kind]
+        if ids:
+            objects.update(((kind, obj.id), obj) for obj in model.query.filter(model.id.in_(ids)))
+    return [(result.kind, objects[(result.kind, result.id)]) for result in results if (result.kind, result.id) in objects]
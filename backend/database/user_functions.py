@@ -1,11 +1,16 @@
 # Handles the various user functions, such as registering a user
 # logging in, deleting a user, changing settings, and so forth.
 
-from backend.models import User, db
-from passlib.hash import argon2
+from backend.models import User, Post, Comment, PostVote, CommentVote, db
+from backend.identity_cache import identity_cache, UserSnapshot
+from backend.prefix_index import username_index
+from backend.database.permission_functions import invalidate_permissions
+from backend.password_hasher import password_hasher
 from random import choice  # for salt
 from string import ascii_letters, digits, punctuation  # for salt
-from sqlalchemy import exc
+from collections import defaultdict
+from sqlalchemy import exc, func, case, bindparam
+from sqlalchemy.orm import selectinload
 
 # sqlalchemy.exc.IntegrityError: (sqlite3.IntegrityError) NOT NULL constraint failed: user.salt
 # sqlalchemy.exc.IntegrityError: (sqlite3.IntegrityError) UNIQUE constraint failed: user.email
@@ -13,6 +18,9 @@ from sqlalchemy import exc
 
 # NOTE: remember to call db.session.rollback() in the case of SQLAlchemy exceptions.
 
+# argon2 options of the password hashes. Changing them is safe: the existing hashes still
+# verify, and are made again with the new options when their users log in.
+# "python main.py calibrate-hashing" suggests options for this machine.
 hash_config = {
         "salt_size": 64,
         "digest_size": 256,
@@ -37,7 +45,7 @@ def register_user(username, password, email):
         raise ValueError("username is empty")
     salt = generate_salt()
     try:
-        hash_result = argon2.using(**hash_config).hash(password + salt)
+        hash_result = password_hasher.hash(password + salt, hash_config)
     except TypeError:
         # If the password is a non-string object, this exception will be raised.
         # For example, if the password argument is a list, or an int, or float, etc.
@@ -59,16 +67,21 @@ def register_user(username, password, email):
     except exc.IntegrityError:
         db.session.rollback()
         raise
+    username_index.add(username)
 
 def verify_user(username, password):
     # Verify the user's password
-    # argon2.verify(password, argon2_hash)
+    # The hashing runs in backend/password_hasher.py's processes, raises HasherBusy if too many are waiting.
     # if the user doesn't exist, trying to access its attributes will throw an AttributeError
     user_obj = User.query.filter(User.username == username).first()
     salt = user_obj.salt
     hashed_password = user_obj.password  # the hash
-    # If the password isn't a string object, argon2.verify() will throw a TypeError
-    verified = argon2.using(**hash_config).verify(password + salt, hashed_password)
+    # If the password isn't a string object, a TypeError is raised
+    verified, new_hash = password_hasher.verify_and_update(password + salt, hashed_password, hash_config)
+    if new_hash is not None:
+        # The hash was made before hash_config changed, store it with the current options
+        user_obj.password = new_hash
+        db.session.commit()
     return verified
 
 def get_user_by_name(username):
@@ -80,6 +93,29 @@ def get_user_by_id(user_id):
     user_obj = User.query.filter(User.id == user_id).first()
     return user_obj
 
+def load_user(user_id, with_=()):
+    # Load a user along with only the relationships the caller needs,
+    # e.g. load_user(user_id, with_=("communities", "banned_on")).
+    # Each relationship in <with_> costs one extra query, the others
+    # are loaded lazily if they're ever accessed.
+    # Raises AttributeError if <with_> contains something that isn't a User relationship.
+    query = User.query.filter(User.id == user_id)
+    for relationship in with_:
+        query = query.options(selectinload(getattr(User, relationship)))
+    return query.first()
+
+def get_user_snapshot(user_id):
+    # Lightweight, cached version of get_user_by_id(), used to identify the logged in user
+    # on every request. None if the user doesn't exist.
+    snapshot = identity_cache.get(user_id)
+    if snapshot is None:
+        user_obj = load_user(user_id, with_=("communities",))
+        if user_obj is None:
+            return None
+        snapshot = UserSnapshot(user_obj)
+        identity_cache.set(user_id, snapshot)
+    return snapshot
+
 def delete_user(user_id):
     # delete a user from the database
     # Since only the authenticated user is able to delete their own account,
@@ -87,10 +123,61 @@ def delete_user(user_id):
     # also from the session handler, indicating that the user wants to delete their own account.
     # User.query.filter() will raise exc.InterfaceError if the user_id is some weird object like an empty dict or list
     user_obj = User.query.filter(User.id == user_id).first()
+    community_ids = set()
     for relationship in user_obj.deletion_relationships:
         # Get all the relationships the user is linked to and clear them.
         relationship_list_obj = getattr(user_obj, relationship)
+        community_ids.update(community.id for community in relationship_list_obj)
         relationship_list_obj.clear()
     # Community relationships have been deleted, now delete the user itself
+    username = user_obj.username
     db.session.delete(user_obj)
     db.session.commit()
+    username_index.remove(username)
+    # The user's ID could be reused, so nothing about this user can stay cached
+    identity_cache.invalidate(user_id)
+    for community_id in community_ids:
+        invalidate_permissions(user_id, community_id)
+
+def compute_karma(chunk_size=10000):
+    # Sum up every user's karma from the post and comment votes.
+    # The votes are aggregated by the database in ranges of <chunk_size> vote ids,
+    # so only one total per user is kept in memory, never the votes themselves.
+    # Returns a dict of user_id: karma, users without votes aren't in it.
+    karma = defaultdict(int)
+    for vote_model, target_model, target_key in ((PostVote, Post, PostVote.post_id), (CommentVote, Comment, CommentVote.comment_id)):
+        max_id = db.session.query(func.max(vote_model.id)).scalar() or 0
+        for first_id in range(1, max_id + 1, chunk_size):
+            for user_id, total in karma_query(vote_model, target_model, target_key, first_id, chunk_size):
+                karma[user_id] += total
+    return karma
+
+def karma_query(vote_model, target_model, target_key, first_id, chunk_size):
+    # (author's user_id, karma) from the votes with IDs first_id .. first_id + chunk_size - 1
+    query = db.session.query(target_model.user_id, func.sum(case([(vote_model.vote_type, 1)], else_=-1)))
+    query = query.join(target_model, target_key == target_model.id)
+    query = query.filter(vote_model.id >= first_id, vote_model.id < first_id + chunk_size)
+    return query.group_by(target_model.user_id)
+
+def recompute_karma(chunk_size=10000, fix=True):
+    # Rebuild User.karma from the votes, or only check it if <fix> is False.
+    # Meant to be run offline: votes cast while it runs can be overwritten.
+    # The users are read and updated in chunks of <chunk_size>, each chunk in its own transaction.
+    # Returns (number of users checked, number of users whose karma was wrong).
+    karma = compute_karma(chunk_size)
+    update = User.__table__.update().where(User.id == bindparam("user_id")).values(karma=bindparam("new_karma"))
+    checked, wrong = 0, 0
+    last_id = 0
+    while True:
+        users = db.session.query(User.id, User.karma).filter(User.id > last_id).order_by(User.id).limit(chunk_size).all()
+        if not users:
+            break
+        changes = [{"user_id": user_id, "new_karma": karma.get(user_id, 0)}
+                for user_id, stored_karma in users if (stored_karma or 0) != karma.get(user_id, 0)]
+        checked += len(users)
+        wrong += len(changes)
+        if fix and changes:
+            db.session.execute(update, changes)
+            db.session.commit()
+        last_id = users[-1][0]
+    return checked, wrong
@@ -0,0 +1,170 @@
+# Voting logic shared by posts and comments.
+# A vote is set with at most two statements on the vote table, which relies on the
+# unique (user_id, target) index, and atomic "karma = karma + delta" UPDATEs
+# on the voted post or comment and on its author. No vote lists are loaded, so the cost is the same
+# however many votes the target already has, and concurrent votes can't lose
+# karma updates the way a read-modify-write in Python can.
+# Voting is a hot path, so the statements are built once with bound parameters
+# and their compiled form is cached, instead of compiling new SQL for every vote.
+# apply_votes() writes a whole batch of votes with a couple of statements, for the vote buffer.
+from collections import defaultdict
+from datetime import datetime
+from backend.models import User, db
+from sqlalchemy import exists, and_, select, literal, bindparam, func, text
+
+# Votes per statement of apply_votes(), 2 bound parameters each
+VOTE_BATCH_SIZE = 500
+
+# Compiled SQL of the statements below, shared by all connections
+compiled_cache = {}
+# (vote_model, target_model, target_key): dict of statements
+statements = {}
+
+def get_statements(vote_model, target_model, target_key):
+    key = (vote_model, target_model, target_key)
+    if key not in statements:
+        vote_table, target_table, user_table = vote_model.__table__, target_model.__table__, User.__table__
+        user_id = bindparam("vote_user_id", type_=vote_table.c.user_id.type)
+        target_id = bindparam("vote_target_id", type_=vote_table.c[target_key].type)
+        vote_type = bindparam("vote_type_", type_=vote_table.c.vote_type.type)
+        this_vote = and_(vote_table.c.user_id == user_id, vote_table.c[target_key] == target_id)
+        statements[key] = {
+                "exists": select([exists().where(user_table.c.id == user_id),
+                    exists().where(target_table.c.id == target_id)]),
+                # Which of a batch of voters and targets exist, in one query
+                "existing": select([literal("user"), user_table.c.id])
+                    .where(user_table.c.id.in_(bindparam("vote_user_ids", expanding=True)))
+                    .union_all(select([literal("target"), target_table.c.id])
+                    .where(target_table.c.id.in_(bindparam("vote_target_ids", expanding=True)))),
+                "delete": vote_table.delete().where(and_(this_vote, vote_table.c.vote_type == vote_type)),
+                "flip": vote_table.update().where(and_(this_vote, vote_table.c.vote_type != vote_type))
+                    .values(vote_type=vote_type, voted_on=bindparam("vote_time", type_=vote_table.c.voted_on.type)),
+                # No vote, or already the same vote, which the unique index ignores
+                "insert": vote_table.insert().prefix_with("OR IGNORE").values({"user_id": user_id, target_key: target_id,
+                    "vote_type": vote_type, "voted_on": bindparam("vote_time", type_=vote_table.c.voted_on.type)}),
+                "karma": target_table.update().where(target_table.c.id == target_id).values(karma_values(target_table)),
+                # The author's karma follows the karma of their posts and comments
+                "author_karma": user_table.update()
+                    .where(user_table.c.id == select([target_table.c.user_id]).where(target_table.c.id == target_id).as_scalar())
+                    .values(karma=func.coalesce(user_table.c.karma, 0) + bindparam("delta", type_=user_table.c.karma.type)),
+                }
+    return statements[key]
+
+def karma_values(target_table):
+    # SET clause of the karma UPDATE. Posts also get their hot score recomputed from the new karma.
+    # Their version stays: the karma isn't part of their cached HTML, see backend/fragment_cache.py.
+    karma = target_table.c.karma + bindparam("delta", type_=target_table.c.karma.type)
+    values = {"karma": karma}
+    if "hot_score" in target_table.c:
+        values["hot_score"] = func.hot_score(karma, target_table.c.post_time)
+    return values
+
+def execute(statement, **params):
+    # Execute in the current database session's transaction, using the compiled statement cache
+    connection = db.session.connection().execution_options(compiled_cache=compiled_cache)
+    return connection.execute(statement, params)
+
+def check_exists(vote_model, target_model, target_key, user_id, target_id):
+    # Raise ValueError if the voter or the voted post/comment doesn't exist, in one query
+    statement = get_statements(vote_model, target_model, target_key)["exists"]
+    user_exists, target_exists = execute(statement, vote_user_id=user_id, vote_target_id=target_id).first()
+    if not user_exists:
+        raise ValueError("user doesn't exist")
+    if not target_exists:
+        raise ValueError("{} doesn't exist".format(target_model.__tablename__))
+
+def existing_ids(vote_model, target_model, target_key, user_ids, target_ids):
+    # The voters out of <user_ids> and the posts/comments out of <target_ids> that exist,
+    # as two sets, in one query
+    statement = get_statements(vote_model, target_model, target_key)["existing"]
+    existing = {"user": set(), "target": set()}
+    for kind, row_id in execute(statement, vote_user_ids=list(user_ids), vote_target_ids=list(target_ids)):
+        existing[kind].add(row_id)
+    return existing["user"], existing["target"]
+
+def set_vote(vote_model, target_model, target_key, user_id, target_id, vote_type):
+    # Set the user's vote on a post or comment and update its karma accordingly.
+    # vote_model: PostVote or CommentVote, target_model: Post or Comment
+    # target_key: name of the vote column pointing at the target, "post_id" or "comment_id"
+    # vote_type: True is +1, False is -1, None removes the vote.
+    # Voting the same way twice changes nothing.
+    # Does not commit. Returns the change in the target's karma.
+    delta = apply_vote(vote_model, target_model, target_key, user_id, target_id, vote_type)
+    add_karma(vote_model, target_model, target_key, target_id, delta)
+    return delta
+
+def apply_vote(vote_model, target_model, target_key, user_id, target_id, vote_type):
+    # The vote row half of set_vote(), without touching the karma.
+    # Returns the change in the target's karma that the caller has to apply.
+    vote_statements = get_statements(vote_model, target_model, target_key)
+    params = {"vote_user_id": user_id, "vote_target_id": target_id}
+    if vote_type is None:
+        # Remove the vote, whichever way it was
+        for previous_vote_type, change in ((True, -1), (False, 1)):
+            if execute(vote_statements["delete"], vote_type_=previous_vote_type, **params).rowcount:
+                return change
+        return 0
+    value = 1 if vote_type else -1
+    utcnow = datetime.utcnow()
+    # Flip an existing vote of the other type
+    if execute(vote_statements["flip"], vote_type_=vote_type, vote_time=utcnow, **params).rowcount:
+        return 2 * value
+    if execute(vote_statements["insert"], vote_type_=vote_type, vote_time=utcnow, **params).rowcount:
+        return value
+    return 0
+
+def batch_delete_statement(vote_model, target_key, count):
+    # DELETE of <count> votes, with the bound parameters u0, t0, u1, t1... for their user and target IDs,
+    # returning the deleted votes
+    vote_table = vote_model.__table__
+    # Joined on the unique (user_id, target) index: "(user_id, target) IN (VALUES ...)" scans the table
+    return text("DELETE FROM {table} WHERE rowid IN (SELECT {table}.rowid FROM (VALUES {keys}) AS batch "
+            "JOIN {table} ON {table}.user_id = batch.column1 AND {table}.{target_key} = batch.column2) "
+            "RETURNING user_id, {target_key}, vote_type, voted_on".format(table=vote_table.name, target_key=target_key,
+                keys=", ".join("(:u{0}, :t{0})".format(i) for i in range(count)))) \
+            .columns(vote_table.c.user_id, vote_table.c[target_key], vote_table.c.vote_type, vote_table.c.voted_on)
+
+def apply_votes(vote_model, target_model, target_key, votes):
+    # apply_vote() for a batch of votes: [(user_id, target_id, vote_type)], at most one per user and target.
+    # The previous votes are deleted and returned by the same statement (SQLite 3.35+),
+    # so another process can't change them in between, then the new votes are inserted in one go,
+    # keeping the time of the votes that didn't change.
+    # Returns {target_id: change in the target's karma that the caller has to apply}.
+    vote_table = vote_model.__table__
+    changes = defaultdict(int)
+    utcnow = datetime.utcnow()
+    for start in range(0, len(votes), VOTE_BATCH_SIZE):
+        batch = votes[start:start + VOTE_BATCH_SIZE]
+        params = {}
+        for i, (user_id, target_id, vote_type) in enumerate(batch):
+            params["u{}".format(i)] = user_id
+            params["t{}".format(i)] = target_id
+        delete = batch_delete_statement(vote_model, target_key, len(batch))
+        # Not through execute(): the compiled cache would keep every batch's new statement
+        connection = db.session.connection()
+        previous = {(user_id, target_id): (vote_type, voted_on)
+                for user_id, target_id, vote_type, voted_on in connection.execute(delete, params).fetchall()}
+        rows = []
+        for user_id, target_id, vote_type in batch:
+            previous_type, voted_on = previous.get((user_id, target_id), (None, None))
+            changes[target_id] += vote_value(vote_type) - vote_value(previous_type)
+            if vote_type is not None:
+                rows.append({"user_id": user_id, target_key: target_id, "vote_type": vote_type,
+                    "voted_on": voted_on if vote_type == previous_type else utcnow})
+        if rows:
+            connection.execute(vote_table.insert(), rows)
+    return changes
+
+def add_karma(vote_model, target_model, target_key, target_id, delta):
+    # Atomically add <delta> to a post's or comment's karma, and to its author's karma.
+    # Does not commit, so it's part of the same transaction as the vote.
+    if delta:
+        vote_statements = get_statements(vote_model, target_model, target_key)
+        execute(vote_statements["karma"], vote_target_id=target_id, delta=delta)
+        execute(vote_statements["author_karma"], vote_target_id=target_id, delta=delta)
+
+def vote_value(vote_type):
+    # How much a vote adds to the karma
+    if vote_type is None:
+        return 0
+    return 1 if vote_type else -1
@@ -0,0 +1,56 @@
+# Cache of the rendered HTML of posts.
+# Posts rarely change after they're created, so the community pages and the front page
+# render each post's block once and reuse it until the post changes.
+# Fragments are keyed by (post id, Post.version). The version goes up with every edit,
+# also in other processes, so a stale fragment is never served: a version that doesn't match
+# is a miss. The edit and delete paths also invalidate the post's fragment right away,
+# so that the memory isn't held until it's evicted.
+# Only things that look the same for every user go into a fragment.
+# The karma is left out: it changes with every vote, including the votes still in the vote buffer,
+# so it's put in the cached HTML every time it's shown, and votes don't change the version.
+import sys
+from secrets import token_hex
+from flask import render_template
+from markupsafe import Markup
+from backend.cache import LRUCache
+
+POST_TEMPLATE = "fragments/post.html"
+# Rendered in place of the karma, then split on. Random so that no post's text can contain it.
+KARMA_MARKER = "karma" + token_hex(16)
+
+def fragment_size(entry):
+    # Bytes held by a (version, html before the karma, html after it) entry, for the max_bytes limit
+    return sys.getsizeof(entry[1]) + sys.getsizeof(entry[2])
+
+class FragmentCache:
+    def __init__(self, max_entries=20000, max_bytes=32 * 1024 * 1024):
+        self.fragments = LRUCache(max_entries, max_bytes=max_bytes, sizeof=fragment_size) # post_id: (version, head, tail)
+
+    def get(self, post_id, version):
+        # The cached (HTML before the karma, HTML after it) of the version of the post, or None
+        entry = self.fragments.get(post_id)
+        if entry is None or entry[0] != version:
+            return None
+        return entry[1:]
+
+    def set(self, post_id, version, head, tail):
+        self.fragments.set(post_id, (version, head, tail))
+
+    def invalidate(self, post_ids):
+        for post_id in post_ids:
+            self.fragments.invalidate(post_id)
+
+    def render_post(self, post, karma=None):
+        # The post's HTML from the cache, rendering it on a miss.
+        # karma: what to show as the post's karma, post.karma by default.
+        # The templates use post_functions.render_post(), which passes the karma with the buffered votes.
+        parts = self.get(post.id, post.version)
+        if parts is None:
+            html = render_template(POST_TEMPLATE, post=post, karma=KARMA_MARKER)
+            head, marker, tail = html.partition(KARMA_MARKER)
+            parts = (head, tail)
+            self.set(post.id, post.version, head, tail)
+        head, tail = parts
+        return Markup(head + str(post.karma if karma is None else karma) + tail)
+
+fragment_cache = FragmentCache()
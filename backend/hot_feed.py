@@ -0,0 +1,149 @@
+# The "hot" front page feed.
+# Every post has a precomputed, indexed hot score (see hot_score() in backend/models.py),
+# which the vote UPDATEs keep current. On top of that, each community's hottest posts are
+# kept in memory as a list sorted by score. A user's feed is then a k-way merge of the lists
+# of their communities, which stops after <count> posts, instead of sorting every post
+# of every community the user is in.
+# The lists are per process: votes cast in this process update them right away,
+# votes from other processes show up when the list expires and is reloaded.
+import threading
+from bisect import bisect_left, bisect_right, insort
+from datetime import timedelta
+from heapq import merge
+from itertools import islice
+from sqlalchemy import select, union_all
+from backend.cache import LRUCache
+from backend.models import Post, db
+
+# How many communities are loaded with one query.
+# Stays under SQLite's limit of 500 terms in a compound SELECT.
+LOAD_CHUNK_SIZE = 100
+
+class CommunityRanking:
+    # The hottest posts of one community, hottest first
+    __slots__ = ("entries", "scores", "complete")
+
+    def __init__(self, posts, complete):
+        # posts: (post_id, hot_score) pairs
+        # complete: True if these are all the posts of the community, not only the hottest ones
+        self.entries = sorted(entry_key(post_id, score) for post_id, score in posts)
+        self.scores = dict(posts) # post_id: hot_score
+        self.complete = complete
+
+def entry_key(post_id, score):
+    # Ascending order of the keys is the feed order: highest score first, newest post first on ties
+    return (-score, -post_id)
+
+class HotFeed:
+    def __init__(self, max_posts=500, max_communities=10000, ttl=timedelta(minutes=5)):
+        self.max_posts = max_posts # posts kept per community
+        self.rankings = LRUCache(max_communities, ttl) # community_id: CommunityRanking
+        self.lock = threading.Lock()
+
+    def load_rankings(self, community_ids):
+        # Load the hottest posts of the given communities from the post_community_hot_score index.
+        # One query per LOAD_CHUNK_SIZE communities, each reading at most max_posts + 1 index entries per community.
+        # Returns a dict of community_id: CommunityRanking
+        posts = {community_id: [] for community_id in community_ids}
+        community_ids = list(posts)
+        for start in range(0, len(community_ids), LOAD_CHUNK_SIZE):
+            queries = []
+            for community_id in community_ids[start:start + LOAD_CHUNK_SIZE]:
+                queries.append(select([self.ranking_query(community_id).alias()]))
+            statement = union_all(*queries) if len(queries) > 1 else queries[0]
+            for community_id, post_id, score in db.session.execute(statement):
+                posts[community_id].append((post_id, score or 0))
+        rankings = {}
+        for community_id, community_posts in posts.items():
+            complete = len(community_posts) <= self.max_posts
+            rankings[community_id] = CommunityRanking(community_posts[:self.max_posts], complete)
+        return rankings
+
+    def ranking_query(self, community_id):
+        # The community's hottest posts. One more than we keep, to know whether the community has more posts.
+        query = select([Post.community_id, Post.id, Post.hot_score]).where(Post.community_id == community_id)
+        return query.order_by(Post.hot_score.desc(), Post.id.desc()).limit(self.max_posts + 1)
+
+    def get_rankings(self, community_ids):
+        # The cached rankings of the communities, loading the missing ones
+        rankings = {}
+        missing = []
+        for community_id in community_ids:
+            ranking = self.rankings.get(community_id)
+            if ranking is None:
+                missing.append(community_id)
+            else:
+                rankings[community_id] = ranking
+        if missing:
+            for community_id, ranking in self.load_rankings(missing).items():
+                self.rankings.set(community_id, ranking)
+                rankings[community_id] = ranking
+        return [rankings[community_id] for community_id in community_ids]
+
+    def get_feed(self, community_ids, count=25, after=None):
+        # IDs of the <count> hottest posts across the communities, hottest first.
+        # after: (hot_score, post_id) of the last post of the previous page, to get the next page.
+        # Costs O(count * log(communities)) once the rankings are loaded.
+        # Returns None when going deeper than the max_posts kept for a community
+        # would be needed to know the order, the caller has to ask the database then.
+        rankings = self.get_rankings(list(dict.fromkeys(community_ids)))
+        start_key = entry_key(after[1], after[0]) if after is not None else None
+        with self.lock:
+            # Posts that aren't kept in memory all rank below the last kept post of their community,
+            # so the merge is only right up to the lowest ranked of those.
+            limit = min((ranking.entries[-1] for ranking in rankings if not ranking.complete and ranking.entries), default=None)
+            if limit is not None and start_key is not None and start_key >= limit:
+                return None
+            merged = merge(*(self.entries_after(ranking.entries, start_key) for ranking in rankings))
+            entries = list(islice(merged, count))
+        if limit is not None and (len(entries) < count or entries[-1] > limit):
+            return None
+        return [-post_id for score, post_id in entries]
+
+    def entries_after(self, entries, start_key):
+        # Iterate over the sorted entries that come after <start_key>
+        start = bisect_right(entries, start_key) if start_key is not None else 0
+        return (entries[index] for index in range(start, len(entries)))
+
+    def update(self, community_id, post_id, score):
+        # A post's hot score changed, or None if the post was deleted.
+        # Communities that aren't loaded are left alone, they'll read the new score when they're loaded.
+        ranking = self.rankings.get(community_id)
+        if ranking is None:
+            return
+        with self.lock:
+            old_score = ranking.scores.pop(post_id, None)
+            if old_score is not None:
+                index = bisect_left(ranking.entries, entry_key(post_id, old_score))
+                del ranking.entries[index]
+            if score is None:
+                return
+            key = entry_key(post_id, score)
+            if not ranking.complete and (not ranking.entries or key > ranking.entries[-1]):
+                # Below the posts we keep, where we don't know the order
+                should_reload = len(ranking.entries) < self.max_posts // 2
+            else:
+                insort(ranking.entries, key)
+                ranking.scores[post_id] = score
+                if len(ranking.entries) > self.max_posts:
+                    score, post_id = ranking.entries.pop()
+                    del ranking.scores[-post_id]
+                    ranking.complete = False
+                should_reload = False
+        if should_reload:
+            # Too many posts fell out of the kept ones, read them again next time
+            self.rankings.invalidate(community_id)
+
+    def refresh_posts(self, post_ids):
+        # Read the current hot scores of the posts, after votes on them were committed.
+        # Returns the IDs of the posts' communities.
+        if not post_ids:
+            return set()
+        community_ids = set()
+        query = db.session.query(Post.id, Post.community_id, Post.hot_score).filter(Post.id.in_(post_ids))
+        for post_id, community_id, score in query:
+            self.update(community_id, post_id, score or 0)
+            community_ids.add(community_id)
+        return community_ids
+
+hot_feed = HotFeed()
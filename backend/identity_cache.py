@@ -0,0 +1,27 @@
+# Cache of who the logged in users are, so that identifying the user
+# doesn't cost a round of database queries on every request.
+# We only cache a lightweight snapshot of the user, not the ORM object,
+# since ORM objects are bound to the database session of the request that loaded them.
+# Entries are invalidated by the functions in backend/database that change a user's
+# memberships or roles. Other worker processes don't see those invalidations,
+# which is why the entries also expire after a short while.
+from collections import namedtuple
+from datetime import timedelta
+from backend.cache import LRUCache
+
+CommunitySnapshot = namedtuple("CommunitySnapshot", ("id", "name"))
+
+class UserSnapshot:
+    __slots__ = ("id", "username", "communities")
+
+    def __init__(self, user_obj):
+        self.id = user_obj.id
+        self.username = user_obj.username
+        # tuple of CommunitySnapshot, the communities the user is a member of
+        self.communities = tuple(CommunitySnapshot(c.id, c.name) for c in user_obj.communities)
+
+    def __repr__(self):
+        return "<UserSnapshot {}>".format(self.username)
+
+# user_id: UserSnapshot
+identity_cache = LRUCache(max_entries=10000, ttl=timedelta(minutes=5))
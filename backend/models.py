@@ -1,34 +1,46 @@
 # Discussion Website models file
 from flask_sqlalchemy import SQLAlchemy
 from datetime import datetime
+from math import log10
+from sqlalchemy import event, DDL
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm.attributes import set_committed_value
+import sqlite3
 
 db = SQLAlchemy() # context initialized in main
 
 # The various many-to-many user->community relationships
+# The primary key (user_id, community_id) finds a user's communities,
+# the (community_id, user_id) index finds a community's users.
 # Community memberships
 memberships = db.Table("memberships",
         db.Column("user_id", db.Integer, db.ForeignKey("user.id"), primary_key=True),
-        db.Column("community_id", db.Integer, db.ForeignKey("community.id"), primary_key=True)
+        db.Column("community_id", db.Integer, db.ForeignKey("community.id"), primary_key=True),
+        db.Index("memberships_community_user", "community_id", "user_id")
         )
 # Community bans
 bans = db.Table("bans",
         db.Column("user_id", db.Integer, db.ForeignKey("user.id"), primary_key=True),
-        db.Column("community_id", db.Integer, db.ForeignKey("community.id"), primary_key=True)
+        db.Column("community_id", db.Integer, db.ForeignKey("community.id"), primary_key=True),
+        db.Index("bans_community_user", "community_id", "user_id")
         )
 # Community owners
 owners = db.Table("owners",
         db.Column("user_id", db.Integer, db.ForeignKey("user.id"), primary_key=True),
-        db.Column("community_id", db.Integer, db.ForeignKey("community.id"), primary_key=True)
+        db.Column("community_id", db.Integer, db.ForeignKey("community.id"), primary_key=True),
+        db.Index("owners_community_user", "community_id", "user_id")
         )
 # Community admins
 admins = db.Table("admins",
         db.Column("user_id", db.Integer, db.ForeignKey("user.id"), primary_key=True),
-        db.Column("community_id", db.Integer, db.ForeignKey("community.id"), primary_key=True)
+        db.Column("community_id", db.Integer, db.ForeignKey("community.id"), primary_key=True),
+        db.Index("admins_community_user", "community_id", "user_id")
         )
 # Community moderators
 moderators = db.Table("moderators",
         db.Column("user_id", db.Integer, db.ForeignKey("user.id"), primary_key=True),
-        db.Column("community_id", db.Integer, db.ForeignKey("community.id"), primary_key=True)
+        db.Column("community_id", db.Integer, db.ForeignKey("community.id"), primary_key=True),
+        db.Index("moderators_community_user", "community_id", "user_id")
         )
 
 class User(db.Model):
@@ -43,16 +55,18 @@ class User(db.Model):
     posts = db.relationship("Post", backref="user") # user.posts; post.user
     comments = db.relationship("Comment", backref="user") # user.comments; comment.user
     # Now the various many-to-many user->community relationships
+    # These are all loaded on first access. To load them up front along with the user,
+    # use user_functions.load_user(user_id, with_=("communities", ...))
     # Memberships first: User.communities / Community.users
-    communities = db.relationship("Community", secondary=memberships, lazy="subquery", backref=db.backref("users", lazy=True))
+    communities = db.relationship("Community", secondary=memberships, lazy=True, backref=db.backref("users", lazy=True))
     # Groups in which the user is an owner: User.owner / Community.owners
-    owner = db.relationship("Community", secondary=owners, lazy="subquery", backref=db.backref("owners", lazy=True))
+    owner = db.relationship("Community", secondary=owners, lazy=True, backref=db.backref("owners", lazy=True))
     # Admin
-    admin = db.relationship("Community", secondary=admins, lazy="subquery", backref=db.backref("admins", lazy=True))  
+    admin = db.relationship("Community", secondary=admins, lazy=True, backref=db.backref("admins", lazy=True))  
     # Moderator
-    moderator = db.relationship("Community", secondary=moderators, lazy="subquery", backref=db.backref("moderators", lazy=True))
+    moderator = db.relationship("Community", secondary=moderators, lazy=True, backref=db.backref("moderators", lazy=True))
     # Banned: User.banned_on / Community.banned_users
-    banned_on = db.relationship("Community", secondary=bans, lazy="subquery", backref=db.backref("banned_users", lazy=True))
+    banned_on = db.relationship("Community", secondary=bans, lazy=True, backref=db.backref("banned_users", lazy=True))
 
     # This is just the names of the relationships for when we have to delete the user
     # or do something that requires this. Only done for extra modularity
@@ -78,10 +92,41 @@ class Community(db.Model):
     user_departure_relationships = ("users", "owners", "admins", "moderators") # not bans 
     # When deleting the community, delete all relationships
     deletion_relationships = user_departure_relationships + ("banned_users", "posts")
+    # The private communities, which search leaves out for non-members. There are few of them.
+    __table_args__ = (
+            db.Index("community_private", "id", sqlite_where=db.text("is_private = 1")),
+            )
 
     def __repr__(self):
         return "<Group {}>".format(self.name)
 
+# "Hot" ranking of posts.
+# Every order of magnitude of karma is worth HOT_SCORE_PERIOD seconds of being newer,
+# so new posts get their turn at the top, and the score of a post never has to be
+# recomputed as time passes, only when its karma changes.
+HOT_SCORE_EPOCH = datetime(2020, 1, 1)
+HOT_SCORE_PERIOD = 45000
+
+def hot_score(karma, post_time):
+    # post_time is a datetime, or the way SQLite stores it when called from SQL
+    if isinstance(post_time, str):
+        post_time = datetime.fromisoformat(post_time)
+    karma = karma or 0
+    sign = (karma > 0) - (karma < 0)
+    seconds = (post_time - HOT_SCORE_EPOCH).total_seconds()
+    return round(sign * log10(max(abs(karma), 1)) + seconds / HOT_SCORE_PERIOD, 7)
+
+def default_hot_score(context):
+    # The post_time column comes first, so its default is already in the parameters
+    parameters = context.get_current_parameters()
+    return hot_score(parameters.get("karma"), parameters.get("post_time") or datetime.utcnow())
+
+@event.listens_for(Engine, "connect")
+def register_sql_functions(dbapi_connection, connection_record):
+    # Make hot_score() available in SQL, so that vote UPDATEs can recompute it atomically
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        dbapi_connection.create_function("hot_score", 2, hot_score, deterministic=True)
+
 # TODO: edits
 class Post(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -93,9 +138,20 @@ class Post(db.Model):
     post_time = db.Column(db.DateTime, default=datetime.utcnow)
     is_pinned = db.Column(db.Boolean, default=False) # Post is pinned in the community index, showing at the top
     is_locked = db.Column(db.Boolean, default=False) # Post is locked - comments cannot be created, and votes cannot be cast
+    hot_score = db.Column(db.Float, default=default_hot_score) # hot_score(karma, post_time), kept up to date by the vote UPDATEs
+    version = db.Column(db.Integer, default=1, nullable=False) # Goes up whenever the cached HTML of the post changes: edits, not votes. See backend/fragment_cache.py
     # Relationship with comments
     # post_obj.comments; comment_obj.post
-    comments = db.relationship("Comment", backref=db.backref("post", lazy=True), cascade="all, delete-orphan")
+    # post_obj.comments is a query, so that a big thread is never loaded by accident.
+    # Read threads with comment_functions.get_thread_page() or iter_thread().
+    comments = db.relationship("Comment", backref=db.backref("post", lazy=True), cascade="all, delete-orphan", lazy="dynamic")
+    # Listing a community's posts, newest or hottest first, a page at a time.
+    # The id makes the order unique, which the pagination cursors rely on (see post_functions.get_posts_page)
+    __table_args__ = (
+            db.Index("post_community_time", "community_id", "post_time", "id"),
+            db.Index("post_community_hot_score", "community_id", "hot_score", "id"),
+            db.Index("post_user", "user_id"), # User.posts
+            )
 
     def __repr__(self):
         return "<Post {}>".format(self.title)
@@ -108,7 +164,36 @@ class Comment(db.Model):
     karma = db.Column(db.Integer, default=0) # Comment rating
     comment_time = db.Column(db.DateTime, default=datetime.utcnow)
     is_pinned = db.Column(db.Boolean, default=False) # comment is pinned in the thread, showing at the top
+    parent_id = db.Column(db.Integer, db.ForeignKey("comment.id")) # The comment this one replies to, None for top level comments
+    # Materialized path: the IDs of the comment's ancestors and its own, as fixed width segments,
+    # so sorting by path puts every comment right after its parent, and a subtree is a range of paths.
+    # Set by set_comment_path() after the insert.
+    path = db.Column(db.String)
     # Parent relationships are defined in the parent classes (Post, User)
+    __table_args__ = (
+            db.Index("comment_post_path", "post_id", "path"), # Post.comments, and threads in order
+            # A post's top level comments in thread order: pinned first, then the highest rated, then the oldest
+            db.Index("comment_post_top", post_id, is_pinned.desc(), karma.desc(), id, sqlite_where=db.text("parent_id IS NULL")),
+            db.Index("comment_user", "user_id"), # User.comments
+            )
+
+# Width of one comment ID in Comment.path
+COMMENT_PATH_SEGMENT = 10
+
+def comment_path_segment(comment_id):
+    return "{:0{}d}".format(comment_id, COMMENT_PATH_SEGMENT)
+
+@event.listens_for(Comment, "after_insert")
+def set_comment_path(mapper, connection, comment):
+    # The path needs the comment's own ID, so it can only be written after the insert
+    comment_table = Comment.__table__
+    parent_path = ""
+    if comment.parent_id is not None:
+        query = db.select([comment_table.c.path]).where(comment_table.c.id == comment.parent_id)
+        parent_path = connection.execute(query).scalar() or ""
+    path = parent_path + comment_path_segment(comment.id)
+    connection.execute(comment_table.update().where(comment_table.c.id == comment.id).values(path=path))
+    set_committed_value(comment, "path", path)
 
 # FIXME: this is bad design. We'll keep it for now, but you should find a better way.
 class PostVote(db.Model):
@@ -120,6 +205,12 @@ class PostVote(db.Model):
     # relationship with a user
     user = db.relationship("User", backref=db.backref("post_votes", lazy=True)) # postvote.user; user.post_votes
     post = db.relationship("Post", backref=db.backref("votes", lazy=True)) # postvote.post; post.votes
+    # A user can only have one vote on a post. Flipping it updates the existing row.
+    # The unique index also finds a user's votes, post_vote_post finds a post's votes.
+    __table_args__ = (
+            db.Index("post_vote_user_post", "user_id", "post_id", unique=True),
+            db.Index("post_vote_post", "post_id"),
+            )
 
 class CommentVote(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -130,3 +221,21 @@ class CommentVote(db.Model):
     # relationships etc
     user = db.relationship("User", backref=db.backref("comment_votes", lazy=True)) # commentvote.user; user.comment_votes
     comment = db.relationship("Comment", backref=db.backref("votes", lazy=True)) # commentvote.comment; comment.votes
+    # One vote per user per comment
+    __table_args__ = (
+            db.Index("comment_vote_user_comment", "user_id", "comment_id", unique=True),
+            db.Index("comment_vote_comment", "comment_id"),
+            )
+
+# Full text search over posts, comments and communities, see backend/database/search_functions.py.
+# An FTS5 virtual table, which SQLAlchemy can't define, so it's created and dropped with the other tables here.
+# The rowid says what a row is: <id> * SEARCH_KINDS + the kind's index in SEARCH_KIND_NAMES.
+# Posts have their title and body in it, comments only a body, communities their name and description.
+# Matches are ranked with BM25, a match in the title counting 10 times as much as one in the body.
+SEARCH_KIND_NAMES = ("post", "comment", "community")
+SEARCH_KINDS = len(SEARCH_KIND_NAMES)
+event.listen(db.metadata, "after_create", DDL(
+    "CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5(community_id UNINDEXED, title, body)"))
+event.listen(db.metadata, "after_create", DDL(
+    "INSERT INTO search_index (search_index, rank) VALUES ('rank', 'bm25(0.0, 10.0, 1.0)')"))
+event.listen(db.metadata, "before_drop", DDL("DROP TABLE IF EXISTS search_index"))
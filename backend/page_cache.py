@@ -0,0 +1,61 @@
+# Full page cache for visitors who aren't logged in.
+# Most of the traffic to the listing and post pages comes from anonymous readers,
+# who all see the same page. The first one to get a page renders it, and the next ones
+# get the stored response from memory, before the other before_request hooks run:
+# no session lookup, no query and no template.
+# Only the pages that build an ETag from content versions (see backend/blueprints/conditional.py)
+# are stored, together with the versions they were built from. A page whose versions changed
+# since is rendered again, and the pages also expire after a short while on their own.
+from datetime import timedelta
+from flask import current_app, g, request, session
+from backend.cache import LRUCache
+from backend.content_versions import content_versions
+
+def page_size(entry):
+    # Bytes held by a stored page, for the max_bytes limit. The headers are small next to the body.
+    return len(entry[1])
+
+class PageCache:
+    def __init__(self, max_entries=1000, max_bytes=64 * 1024 * 1024, ttl=timedelta(seconds=30)):
+        self.pages = LRUCache(max_entries, ttl, max_bytes, sizeof=page_size) # (path, query string): (versions, body, status, headers)
+
+    def is_anonymous(self):
+        # Only GETs without a session are served from, and stored in, the cache
+        return request.method == "GET" and "session_id" not in session
+
+    def serve(self):
+        # before_request hook, registered ahead of all the other ones
+        g.page_versions = None
+        g.page_cache_hit = False
+        if not self.is_anonymous():
+            return None
+        key = (request.path, request.query_string)
+        entry = self.pages.get(key)
+        if entry is None:
+            return None
+        versions, body, status, headers = entry
+        if any(content_versions.get(version_key) != version for version_key, version in versions.items()):
+            # The page's content changed since it was stored
+            self.pages.invalidate(key)
+            return None
+        g.page_cache_hit = True
+        response = current_app.response_class(body, status, headers)
+        return response.make_conditional(request)
+
+    def store(self, response):
+        # after_request hook: keep the anonymous responses of the pages that have content versions.
+        # g.page_versions is set by page_etag() before the page loads anything.
+        versions = g.get("page_versions")
+        if (versions is None or g.get("page_cache_hit") or not self.is_anonymous() or g.get("user") is not None
+                or response.status_code != 200 or "Set-Cookie" in response.headers):
+            return response
+        headers = [(name, value) for name, value in response.headers if name != "Content-Length"]
+        self.pages.set((request.path, request.query_string), (versions, response.get_data(), response.status_code, headers))
+        return response
+
+    def init_app(self, app):
+        # Call before registering the blueprints, so that serve() runs before their before_app_request hooks
+        app.before_request(self.serve)
+        app.after_request(self.store)
+
+page_cache = PageCache()
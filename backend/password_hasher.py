@@ -0,0 +1,236 @@
+# Password hashing in a pool of worker processes.
+# An argon2 hash takes a few hundred milliseconds of CPU and memory. Done in the request thread,
+# a burst of logins keeps every worker busy hashing and the page views wait behind them.
+# Instead, the hashes run in a small pool of processes, at a lower CPU priority than the web
+# workers, so a login storm can only take as much CPU as the pool has and the pages still
+# get served first. The queue in front of the pool is bounded: when it's full, hash() and
+# verify() raise HasherBusy right away, and the login or registration is answered with
+# "try again", instead of piling up requests that would wait for seconds anyway.
+# The pool and the latency metrics are per process. create_app() starts the pool, so that the
+# first logins don't wait for the hashing processes to start while holding their queue slots.
+# The hashing processes are started by a fork server, a fresh process without the web process'
+# threads, which imports the main module (keep starting the app under `if __name__ == "__main__"`)
+# and this module. Forking the web process itself, with its reaper, flusher and request threads,
+# could deadlock, and would run its at-fork hooks (like the session reaper's) in every worker.
+# calibrate() picks argon2 options for a target verify time, see "python main.py calibrate-hashing".
+import multiprocessing
+import os
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from time import perf_counter
+from passlib.hash import argon2
+
+# nice() increment of the hashing processes
+WORKER_NICENESS = 10
+
+class HasherBusy(Exception):
+    # Too many hashes are waiting, try again later
+    pass
+
+def start_worker():
+    # Initializer of the hashing processes
+    os.nice(WORKER_NICENESS)
+
+def warm_up():
+    # Runs in a hashing process, to get it started before the first hash
+    return os.getpid()
+
+# Configured hasher classes of this process: (config items): argon2.using(**config)
+hashers = {}
+
+def get_hasher(config):
+    # The argon2 hasher for the passlib options in <config>, built once per process
+    key = tuple(sorted(config.items()))
+    hasher = hashers.get(key)
+    if hasher is None:
+        hasher = hashers[key] = argon2.using(**config)
+    return hasher
+
+def hash_secret(config, secret):
+    # Runs in a hashing process. Returns (hash, seconds spent hashing).
+    start = perf_counter()
+    result = get_hasher(config).hash(secret)
+    return result, perf_counter() - start
+
+def verify_secret(config, secret, hashed):
+    # Runs in a hashing process. Returns (True if <secret> matches <hashed>, seconds spent hashing).
+    start = perf_counter()
+    result = get_hasher(config).verify(secret, hashed)
+    return result, perf_counter() - start
+
+def verify_and_update_secret(config, secret, hashed):
+    # Runs in a hashing process. Returns ((verified, new hash or None), seconds spent hashing).
+    # The new hash is made when <secret> matches but <hashed> was made with other options than <config>.
+    start = perf_counter()
+    hasher = get_hasher(config)
+    verified = hasher.verify(secret, hashed)
+    new_hash = hasher.hash(secret) if verified and hasher.needs_update(hashed) else None
+    return (verified, new_hash), perf_counter() - start
+
+def measure_verify(config, repeat=3):
+    # Median seconds of one verify with <config> in this process
+    hasher = get_hasher(config)
+    hashed = hasher.hash("calibration password")
+    timings = []
+    for i in range(repeat):
+        start = perf_counter()
+        hasher.verify("calibration password", hashed)
+        timings.append(perf_counter() - start)
+    return sorted(timings)[repeat // 2]
+
+def calibrate(target, config):
+    # argon2 options that take about <target> seconds to verify a password on this machine.
+    # Starts from the options in <config>: keeps its memory cost and picks the number of rounds,
+    # lowering the memory cost only if a single round is already too slow.
+    # Returns (new config, seconds a verify takes with it).
+    config = dict(config)
+    config.setdefault("memory_cost", argon2.memory_cost)
+    parallelism = config.get("parallelism", argon2.parallelism)
+    while True:
+        config["rounds"] = 1
+        one_round = measure_verify(config)
+        if one_round <= target or config["memory_cost"] // 2 < 8 * parallelism:
+            break
+        config["memory_cost"] //= 2
+    # Roughly proportional to the rounds, but filling the memory takes a part of the time:
+    # start from the estimate and add rounds while it's too fast
+    config["rounds"] = max(1, int(target / one_round))
+    seconds = measure_verify(config)
+    while seconds < target:
+        faster = seconds
+        config["rounds"] += 1
+        seconds = measure_verify(config)
+        if seconds - target > target - faster:
+            # The one with a round less was closer
+            config["rounds"] -= 1
+            seconds = faster
+            break
+    return config, seconds
+
+class LatencyStats:
+    # Latencies of one kind of call: totals since the start, and the most recent ones for percentiles
+    def __init__(self, recent=1000):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.recent = deque(maxlen=recent)
+
+    def record(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.recent.append(seconds)
+
+    def percentile(self, fraction):
+        recent = sorted(self.recent)
+        if not recent:
+            return 0.0
+        return recent[min(len(recent) - 1, int(len(recent) * fraction))]
+
+    def summary(self):
+        # Milliseconds
+        return {
+                "count": self.count,
+                "mean": self.total / self.count * 1000 if self.count else 0.0,
+                "p50": self.percentile(0.5) * 1000,
+                "p99": self.percentile(0.99) * 1000,
+                "max": self.max * 1000,
+                }
+
+class PasswordHasher:
+    def __init__(self, workers=None, max_pending=None):
+        # workers: number of hashing processes, one per CPU by default.
+        # 0 hashes in the calling thread, without a pool or a queue limit.
+        # max_pending: hashes running or waiting at once before HasherBusy, 2 per worker by default.
+        self.workers = (os.cpu_count() or 1) if workers is None else workers
+        self.max_pending = 2 * self.workers if max_pending is None else max_pending
+        self.executor = None # started by start(), or on first use
+        self.pid = None # the process that started the executor
+        self.pending = 0
+        self.rejected = 0
+        # Per call: "hash" and "verify" are the whole call, "wait" the time spent in the queue
+        self.latency = {"hash": LatencyStats(), "verify": LatencyStats(), "wait": LatencyStats()}
+        self.lock = threading.Lock()
+
+    def get_executor(self):
+        # Call with the lock held
+        if self.executor is None or self.pid != os.getpid():
+            # Not started, or started before this process was forked from the one that started it,
+            # e.g. by gunicorn --preload: that pool belongs to the parent
+            self.executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("forkserver"), initializer=start_worker)
+            self.pid = os.getpid()
+        return self.executor
+
+    def start(self, block=False):
+        # Start the hashing processes now instead of on the first hash. They start in the background,
+        # and the warm-up calls that start them don't count against max_pending.
+        # block: wait until they're all running.
+        if self.workers == 0:
+            return
+        with self.lock:
+            executor = self.get_executor()
+            # One process is started per call waiting for a free one
+            futures = [executor.submit(warm_up) for i in range(self.workers)]
+        if block:
+            wait(futures)
+
+    def run(self, kind, function, *args):
+        start = perf_counter()
+        if self.workers == 0:
+            result, hashing = function(*args)
+        else:
+            with self.lock:
+                if self.pending >= self.max_pending:
+                    self.rejected += 1
+                    raise HasherBusy("{} hashes pending".format(self.pending))
+                self.pending += 1
+                executor = self.get_executor()
+            try:
+                result, hashing = executor.submit(function, *args).result()
+            except BrokenProcessPool:
+                # A hashing process died. Start a new pool on the next call.
+                with self.lock:
+                    if self.executor is executor:
+                        self.executor = None
+                raise HasherBusy("the hashing processes stopped")
+            finally:
+                with self.lock:
+                    self.pending -= 1
+        elapsed = perf_counter() - start
+        with self.lock:
+            self.latency[kind].record(elapsed)
+            self.latency["wait"].record(max(0.0, elapsed - hashing))
+        return result
+
+    def hash(self, secret, config):
+        # argon2 hash of <secret> with the passlib options in <config>.
+        # Raises HasherBusy if too many hashes are pending, TypeError if <secret> isn't a string.
+        return self.run("hash", hash_secret, config, secret)
+
+    def verify(self, secret, hashed, config):
+        # True if <secret> matches the argon2 hash <hashed>.
+        # Raises HasherBusy if too many hashes are pending, TypeError if <secret> isn't a string.
+        return self.run("verify", verify_secret, config, secret, hashed)
+
+    def verify_and_update(self, secret, hashed, config):
+        # Like verify(), but also hashes <secret> again if it matches and <hashed> was made with
+        # other options than <config>, e.g. fewer rounds. Returns (verified, new hash or None).
+        return self.run("verify", verify_and_update_secret, config, secret, hashed)
+
+    def stats(self):
+        # Latency metrics of this process, in milliseconds
+        with self.lock:
+            stats = {kind: latency.summary() for kind, latency in self.latency.items()}
+            stats["pending"] = self.pending
+            stats["rejected"] = self.rejected
+        return stats
+
+    def shutdown(self):
+        with self.lock:
+            executor, self.executor = self.executor, None
+        if executor is not None:
+            executor.shutdown()
+
+password_hasher = PasswordHasher()
@@ -0,0 +1,185 @@
+# In-memory prefix index of usernames and community names, for search-as-you-type.
+# Matching a prefix with LIKE 'x%' reads the table on every keystroke. Instead, the names are
+# kept in a list sorted by their case folded form, where the names starting with a prefix are
+# next to each other: one bisect finds the first one.
+# The index is loaded from the database the first time it's used, and kept up to date by
+# register_user, delete_user, create_community and delete_community. Other worker processes
+# don't see those updates, so it's also loaded again after a while. Only that first load makes
+# the callers wait: the later ones run in a background thread, which builds new lists and swaps
+# them in at once, while the old ones keep being served. The changes made in this process
+# during a load are applied to the new lists before the swap.
+import threading
+from bisect import bisect_left
+from datetime import timedelta
+from time import monotonic
+from flask import current_app
+from backend.models import User, Community, db
+
+# Names read from the database at a time when loading
+LOAD_CHUNK_SIZE = 10000
+
+class PrefixIndex:
+    def __init__(self, column, max_age=timedelta(minutes=10)):
+        self.column = column # The names in the database, e.g. User.username
+        self.max_age = max_age.total_seconds()
+        # Two lists instead of one list of tuples, which would take twice the memory at a million names.
+        # keys[i] is names[i].casefold(), in ascending order.
+        self.keys = []
+        self.names = []
+        self.loaded = None # monotonic() of the last load, None if it has to be loaded
+        self.generation = 0 # goes up with invalidate(), a load started before it is thrown away
+        self.changes = None # [(True to add or False to remove, name)] made during a load, None when not loading
+        self.reloader = None # the thread loading the index again, if any
+        self.lock = threading.Lock()
+        self.load_lock = threading.Lock() # one load at a time
+
+    def build(self, names):
+        # The (keys, names) lists of <names>
+        pairs = []
+        for name in names:
+            key = name.casefold()
+            # The same string object when the name is already case folded
+            pairs.append((name if key == name else key, name))
+        pairs.sort()
+        keys = [key for key, name in pairs]
+        names = [name for key, name in pairs]
+        return keys, names
+
+    def set_names(self, names):
+        # Replace the index with <names>
+        keys, names = self.build(names)
+        with self.lock:
+            self.keys, self.names = keys, names
+            self.loaded = monotonic()
+
+    def load(self):
+        # Read all the names from the database, and swap them in. Call with the load lock held.
+        with self.lock:
+            generation = self.generation
+            self.changes = []
+        try:
+            query = db.session.query(self.column).filter(self.column != None).yield_per(LOAD_CHUNK_SIZE)
+            keys, names = self.build(name for name, in query)
+        except Exception:
+            with self.lock:
+                self.changes = None
+            raise
+        with self.lock:
+            changes, self.changes = self.changes, None
+            if generation != self.generation:
+                # Invalidated while loading, the names read may be out of date already
+                return
+            self.keys, self.names = keys, names
+            for added, name in changes:
+                if added:
+                    self.insert(name)
+                else:
+                    self.delete(name)
+            self.loaded = monotonic()
+
+    def reload(self, app):
+        # Runs in the reloader thread
+        try:
+            with app.app_context():
+                with self.load_lock:
+                    self.load()
+        except Exception as e:
+            # Keep serving the names there are, and try again after max_age
+            app.logger.exception("Loading the prefix index of %s failed: %s", self.column, e)
+            with self.lock:
+                if self.loaded is not None:
+                    self.loaded = monotonic()
+        finally:
+            with self.lock:
+                self.reloader = None
+
+    def ensure_loaded(self):
+        loaded = self.loaded
+        if loaded is None:
+            # Nothing to serve yet: load it now, or wait for the thread that's loading it
+            with self.load_lock:
+                if self.loaded is None:
+                    self.load()
+        elif monotonic() - loaded >= self.max_age:
+            # Serve the loaded names while they're loaded again
+            with self.lock:
+                if self.reloader is not None:
+                    return
+                reloader = self.reloader = threading.Thread(target=self.reload, args=(current_app._get_current_object(),),
+                        name="prefix-index-reloader", daemon=True)
+            reloader.start()
+
+    def invalidate(self):
+        # Load it from the database again on the next use
+        with self.lock:
+            self.loaded = None
+            self.generation += 1
+
+    def complete(self, prefix, limit=10):
+        # Up to <limit> names starting with <prefix>, ignoring case, in alphabetical order
+        if not prefix:
+            return []
+        self.ensure_loaded()
+        key = prefix.casefold()
+        with self.lock:
+            start = bisect_left(self.keys, key)
+            keys = self.keys[start:start + limit]
+            names = self.names[start:start + limit]
+        return [name for name_key, name in zip(keys, names) if name_key.startswith(key)]
+
+    def find(self, name):
+        # Index of <name> in the lists, or None. Call with the lock held.
+        key = name.casefold()
+        index = bisect_left(self.keys, key)
+        while index < len(self.keys) and self.keys[index] == key:
+            if self.names[index] == name:
+                return index
+            index += 1
+        return None
+
+    def contains(self, name):
+        # True if <name> is in the index, with the same case
+        if not name:
+            return False
+        self.ensure_loaded()
+        with self.lock:
+            return self.find(name) is not None
+
+    def insert(self, name):
+        # Call with the lock held
+        if self.find(name) is not None:
+            return
+        key = name.casefold()
+        index = bisect_left(self.keys, key)
+        self.keys.insert(index, name if key == name else key)
+        self.names.insert(index, name)
+
+    def delete(self, name):
+        # Call with the lock held
+        index = self.find(name)
+        if index is not None:
+            del self.keys[index]
+            del self.names[index]
+
+    def add(self, name):
+        # A name was added to the database. If the index isn't loaded, the load will read it.
+        with self.lock:
+            if self.changes is not None:
+                # The load may have read the database before the name was added
+                self.changes.append((True, name))
+            if self.loaded is not None:
+                self.insert(name)
+
+    def remove(self, name):
+        # A name was deleted from the database
+        with self.lock:
+            if self.changes is not None:
+                self.changes.append((False, name))
+            if self.loaded is not None:
+                self.delete(name)
+
+    def __len__(self):
+        return len(self.names)
+
+username_index = PrefixIndex(User.username)
+community_index = PrefixIndex(Community.name)
@@ -0,0 +1,147 @@
+# Rate limiting of logins and registrations, per IP address and per username.
+# Every attempt costs an argon2 hash, so a credential stuffing run would keep the hashing
+# processes busy. The attempts over the limits are turned away with 429 Too Many Requests
+# from a before_request hook, before anything reads the database or hashes a password.
+# The counters are approximate sliding windows: the count of the current fixed window, plus the
+# count of the previous one weighted by how much of it is still inside the sliding window.
+# They're kept in a fixed size table of buckets that the keys are hashed to, so the memory
+# doesn't grow with the number of addresses. Each key has a bucket in each of two rows, and
+# its count is the smaller of the two (a count-min sketch): keys sharing a bucket can only make
+# the count too high, and rarely in both rows.
+# The table is in a memory map, which can be a file shared by the worker processes of a host,
+# see create_app(rate_limit_store=...).
+# Setting the app config key RATE_LIMIT_ENABLED to False turns the limits off, e.g. for load tests
+# that log in as the same user over and over.
+import fcntl
+import mmap
+import os
+import threading
+from contextlib import contextmanager
+from datetime import timedelta
+from hashlib import blake2b
+from math import ceil
+from time import time
+from flask import current_app, request, render_template, make_response
+
+# The endpoints whose POST requests are rate limited
+RATE_LIMITED_ENDPOINTS = ("auth.login", "auth.register")
+
+# A bucket is three unsigned 32 bit integers: the number of its current window, and the counts
+# of the current window and the one before it
+WINDOW, CURRENT, PREVIOUS = 0, 1, 2
+FIELDS = 3
+ROWS = 2
+
+class RateLimiter:
+    def __init__(self, limits, window=timedelta(minutes=1), buckets=65536):
+        # limits: kind of key: most requests in any <window>, e.g. {"ip": 20}
+        self.limits = limits
+        self.window = window.total_seconds()
+        self.buckets = buckets # per row
+        self.size = ROWS * buckets * FIELDS * 4
+        self.lock = threading.Lock()
+        self.fd = None
+        self.map = mmap.mmap(-1, self.size)
+        self.counters = memoryview(self.map).cast("I")
+
+    def use_file(self, path):
+        # Keep the counters in the file <path>, shared by every process using the same file.
+        # Counts from before are lost.
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        if os.fstat(fd).st_size != self.size:
+            # New, or made with another number of buckets
+            os.ftruncate(fd, 0)
+            os.ftruncate(fd, self.size)
+        with self.lock:
+            self.counters.release()
+            self.map.close()
+            if self.fd is not None:
+                os.close(self.fd)
+            self.fd = fd
+            self.map = mmap.mmap(fd, self.size)
+            self.counters = memoryview(self.map).cast("I")
+
+    @contextmanager
+    def locked(self):
+        # The lock of this process' threads, and of the other processes when the counters are in a file
+        with self.lock:
+            if self.fd is None:
+                yield
+                return
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def offsets(self, kind, value):
+        # Where the buckets of a key are in the counters, one per row.
+        # Not hash(), which is different in every process.
+        digest = blake2b("{}:{}".format(kind, value).encode(), digest_size=4 * ROWS).digest()
+        return [(row * self.buckets + int.from_bytes(digest[row * 4:row * 4 + 4], "little") % self.buckets) * FIELDS
+                for row in range(ROWS)]
+
+    def roll(self, offset, window):
+        # Move the bucket at <offset> to <window>. Call with the lock held.
+        counters = self.counters
+        stored = counters[offset + WINDOW]
+        if stored == window:
+            return
+        counters[offset + PREVIOUS] = counters[offset + CURRENT] if stored == window - 1 else 0
+        counters[offset + CURRENT] = 0
+        counters[offset + WINDOW] = window
+
+    def count(self, offsets, elapsed):
+        # Requests in the sliding window ending now, <elapsed> is the part of the current window that has passed
+        counters = self.counters
+        return min(counters[offset + CURRENT] + counters[offset + PREVIOUS] * (1 - elapsed) for offset in offsets)
+
+    def hit(self, keys, now=None):
+        # Count a request of every (kind, value) in <keys>, unless one of them is over its limit.
+        # Returns None if the request is allowed, otherwise the seconds to wait before trying again.
+        if now is None:
+            now = time()
+        window, elapsed = divmod(now / self.window, 1)
+        window = int(window)
+        key_offsets = [(kind, self.offsets(kind, value)) for kind, value in keys]
+        with self.locked():
+            for kind, offsets in key_offsets:
+                for offset in offsets:
+                    self.roll(offset, window)
+            if any(self.count(offsets, elapsed) >= self.limits[kind] for kind, offsets in key_offsets):
+                # Turned away requests aren't counted, they don't make the wait longer
+                return max(1, ceil((1 - elapsed) * self.window))
+            for kind, offsets in key_offsets:
+                for offset in offsets:
+                    self.counters[offset + CURRENT] += 1
+        return None
+
+    def clear(self):
+        with self.locked():
+            self.map[:] = bytes(self.size)
+
+    def check(self):
+        # before_request hook: turn away the logins and registrations over the limits.
+        # request.remote_addr is the proxy's address behind a reverse proxy, use werkzeug's ProxyFix there.
+        if (request.method != "POST" or request.endpoint not in RATE_LIMITED_ENDPOINTS
+                or not current_app.config["RATE_LIMIT_ENABLED"]):
+            return None
+        keys = [("ip", request.remote_addr)]
+        username = request.form.get("username")
+        if username:
+            keys.append(("username", username))
+        retry_after = self.hit(keys)
+        if retry_after is None:
+            return None
+        response = make_response(render_template("error.html", error_message="Too many attempts, please try again later"), 429)
+        response.headers["Retry-After"] = str(retry_after)
+        return response
+
+    def init_app(self, app):
+        # Call before registering the blueprints, so that check() runs before their before_app_request hooks
+        app.config.setdefault("RATE_LIMIT_ENABLED", True)
+        app.before_request(self.check)
+
+# Attempts per minute from one IP address, and on one username from anywhere.
+# Someone can keep a user from logging in for a while by trying their username.
+rate_limiter = RateLimiter({"ip": 20, "username": 10})
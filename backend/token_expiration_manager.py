@@ -1,92 +1,185 @@
 # Our automatic token expiration manager.
 # Used to create sessions and CSRF tokens that expire automatically.
 # But, can be used to store anything that should "expire" at a later time.
+# Where the tokens are actually kept is up to the store, see token_stores.py
+import os
+import threading
 from datetime import datetime, timedelta
+from time import perf_counter
+from backend.token_stores import MemoryTokenStore
 
 class TokenExpirationManager:
     def __init__(self, **kwargs):
-        self.expirations = {} # <datetime>: set() of token_tag
-        self.tokens = {} # token_tag: tokenObj
-        self.token_expiration_time = {} # token_tag: <datetime> for the expirations group
         self.session_timeout = kwargs["session_timeout"] # datetime.timedelta() object
         self.expiration_proximity = kwargs["expiration_proximity"] #datetime.timedelta() object
+        # Fraction of session_timeout that has to pass before a used token's expiration time
+        # is pushed back again. 0 refreshes it on every use. With 0.1 and a 2 hour timeout,
+        # a token is rewritten at most once every 12 minutes no matter how often it's used,
+        # at the cost of expiring up to 12 minutes earlier than a full refresh would.
+        self.touch_granularity = kwargs.get("touch_granularity", 0)
+        self.store = kwargs.get("store") or MemoryTokenStore()
+        # Guards tokens, expirations and token_expiration_time,
+        # which are shared between the request threads and the reaper thread.
+        self.lock = threading.RLock()
+        # Background purging, see start_reaper()
+        self.reaper_interval = None
+        self.reaper_thread = None
+        self.reaper_stop = threading.Event()
+        self.reaper_fork_hook = False
+        self.purge_statistics = {
+                "sweeps": 0, # total number of purge_expired_tokens() calls
+                "tokens_purged": 0, # total tokens purged
+                "groups_purged": 0, # total expiration groups purged
+                "last_sweep_time": None, # <datetime> of the last sweep
+                "last_sweep_tokens": 0, # tokens purged by the last sweep
+                "last_sweep_groups": 0, # groups purged by the last sweep
+                "last_sweep_duration": 0.0, # seconds the last sweep took
+                }
+
+    def use_store(self, store):
+        # Switch to a different storage backend.
+        # Tokens in the previous store are not carried over,
+        # so this should only be called on startup.
+        with self.lock:
+            self.store = store
+
+    # The in-memory structures, available when using the default MemoryTokenStore
+    @property
+    def tokens(self):
+        return self.store.tokens # token_tag: tokenObj
+
+    @property
+    def expirations(self):
+        return self.store.expirations # <datetime>: set() of token_tag
+
+    @property
+    def token_expiration_time(self):
+        return self.store.token_expiration_time # token_tag: <datetime> for the expirations group
 
     def add_token(self, token, tokenObj):
-        self.tokens[token] = tokenObj
-        self.token_expiration_time[token] = datetime.utcnow() + self.session_timeout
-        self.update_expiration_time(token)
+        with self.lock:
+            self.store.add(token, tokenObj, self.get_new_expiration_time())
 
     def expire_token(self, token):
         # Remove an individual token manually
-        expiration_time = self.token_expiration_time[token]
-        self.expirations[expiration_time].remove(token)
-        del self.token_expiration_time[token]
-        del self.tokens[token]
-        # Do not remove an empty expiration group set here,
-        # it will be caught by purge_expired_tokens() and removed
-        # next time that method is called.
-
-    def update_expiration_time(self, token):
-        # Call this method when a token has been used
-        # or a new token has been created
-        current_expiration = self.token_expiration_time[token]
-        if self.expirations.get(current_expiration):
-            # Older token, remove its previous expiration time
-            self.expirations[current_expiration].remove(token)
+        with self.lock:
+            self.store.remove(token)
+
+    def get_new_expiration_time(self):
+        # We divide the tokens into various expiration groups based on the token's
+        # initial expiration time's proximity to the group's expiration time.
+        # Then when we want to remove expired tokens, we don't have to check every
+        # individual token's expiration time. We just check if the entire group's expiration time
+        # has elapsed, and then delete the whole group if it did.
+        # Expiration times only ever grow (utcnow() + session_timeout), so the most recently
+        # created group is the only one a new expiration time can be close enough to.
+        # That way we never have to scan all the groups on each update.
         new_expiration = datetime.utcnow() + self.session_timeout
-        for expiration_time in self.expirations:
-            # We divide the tokens into various expiration sets based on the token's
-            # initial expiration time's proximity to the group's expiration time.
-            # Then when we want to remove expired tokens, we don't have to check every
-            # individual token's expiration time. We just check if the entire group's expiration time
-            # has elapsed, and then delete the whole group if it did.
-            # This way we can save some CPU time and speed up our execution time, at the expense of memory usage.
-            difference = (new_expiration - expiration_time).total_seconds()
-            if difference < self.expiration_proximity.total_seconds():
-                # Found an existing expiration group whose expiration time is close enough
-                # to the token's personal expiration time.
-                # The token will expire alongside the group it is in.
-                self.expirations[expiration_time].add(token)
-                self.token_expiration_time[token] = expiration_time
-                break
-        else:
-            # No existing expiration group is sufficient for this token,
-            # so we create a new one
-            self.expirations[new_expiration] = {token}
-            self.token_expiration_time[token] = new_expiration
-    
+        latest_group = self.store.get_latest_expiration_time()
+        if latest_group is not None and (new_expiration - latest_group) < self.expiration_proximity:
+            # Found an existing expiration group whose expiration time is close enough
+            # to the token's personal expiration time.
+            # The token will expire alongside the group it is in.
+            return latest_group
+        # No existing expiration group is sufficient for this token,
+        # so the store will create a new one
+        return new_expiration
+
+    def update_expiration_time(self, token, current_expiration=None):
+        # Call this method when a token has been used
+        with self.lock:
+            new_expiration = self.get_new_expiration_time()
+            if new_expiration != current_expiration:
+                self.store.set_expiration_time(token, new_expiration)
+
+    def needs_refresh(self, current_expiration):
+        # How far the expiration time would move if we refreshed it now.
+        # Because of the grouping this is roughly the time since the last refresh.
+        elapsed = datetime.utcnow() + self.session_timeout - current_expiration
+        return elapsed >= self.session_timeout * self.touch_granularity
+
     def get_expiration_time(self, token):
-        return self.token_expiration_time.get(token)
+        with self.lock:
+            return self.store.get_expiration_time(token)
 
     def get_token_object(self, token):
         # The token is active, which means we update its expiration
         # time to a later time, so that it won't suddenly expire
         # in the middle of a user's session.
-        tokenObj = self.tokens.get(token)
-        if tokenObj is None:
-            # This token doesn't actually exist, return None
-            return None
-        self.update_expiration_time(token)
-        return tokenObj
+        # To avoid rewriting the token on every single use, this is only done
+        # once touch_granularity of the session_timeout has passed since the last time.
+        with self.lock:
+            tokenObj, current_expiration = self.store.get_with_expiration_time(token)
+            if tokenObj is None:
+                # This token doesn't actually exist, return None
+                return None
+            if self.needs_refresh(current_expiration):
+                self.update_expiration_time(token, current_expiration)
+            return tokenObj
 
     def purge_expired_tokens(self):
-        # Check all token groups whose expiration time has elapsed
-        # and remove them
-        removed_sets = []
-        purged = 0
-        for group_expiration_time in self.expirations:
-            # All times are UTC
-            utcnow = datetime.utcnow()
-            if utcnow >= group_expiration_time:
-                # Purge these sessions
-                removed_sets.append(group_expiration_time)
-                current_set = set(self.expirations[group_expiration_time])
-                purged += len(current_set)
-                for token in current_set:
-                    # Remove the token from everywhere
-                    self.expire_token(token)
-        # Now remove all the empty sets from the expirations dict
-        for removed_set in removed_sets:
-            del self.expirations[removed_set]
-        if purged > 0:
-            print("Purged {} expired tokens from {} groups.".format(purged, len(removed_sets)))
+        # Remove all the token groups whose expiration time has elapsed.
+        # The lock is taken for one group at a time, so that requests using
+        # other tokens are never stuck behind a large sweep.
+        # Returns (purged tokens, purged groups)
+        start = perf_counter()
+        utcnow = datetime.utcnow() # All times are UTC
+        purged, removed_sets = 0, 0
+        while True:
+            with self.lock:
+                group_tokens, groups = self.store.purge(utcnow, max_groups=1)
+            if groups == 0:
+                break
+            purged += group_tokens
+            removed_sets += groups
+        with self.lock:
+            statistics = self.purge_statistics
+            statistics["sweeps"] += 1
+            statistics["tokens_purged"] += purged
+            statistics["groups_purged"] += removed_sets
+            statistics["last_sweep_time"] = utcnow
+            statistics["last_sweep_tokens"] = purged
+            statistics["last_sweep_groups"] = removed_sets
+            statistics["last_sweep_duration"] = perf_counter() - start
+        return purged, removed_sets
+
+    def get_purge_statistics(self):
+        # A snapshot of the purge statistics, safe to hand out to other threads
+        with self.lock:
+            return dict(self.purge_statistics)
+
+    def start_reaper(self, interval):
+        # Purge expired tokens in a background thread every <interval> (datetime.timedelta() object),
+        # instead of calling purge_expired_tokens() while handling requests.
+        # Calling this again while the reaper is running does nothing.
+        with self.lock:
+            self.reaper_interval = interval
+            if self.reaper_thread is not None and self.reaper_thread.is_alive():
+                return
+            self.reaper_stop.clear()
+            self.reaper_thread = threading.Thread(target=self.reap, name="token-reaper", daemon=True)
+            self.reaper_thread.start()
+            if not self.reaper_fork_hook:
+                # Threads don't survive fork(), so restart the reaper in forked
+                # worker processes, e.g. gunicorn with --preload
+                os.register_at_fork(after_in_child=self.restart_reaper_after_fork)
+                self.reaper_fork_hook = True
+
+    def stop_reaper(self):
+        with self.lock:
+            reaper_thread = self.reaper_thread
+            self.reaper_thread = None
+            self.reaper_stop.set()
+        if reaper_thread is not None:
+            reaper_thread.join()
+
+    def restart_reaper_after_fork(self):
+        # The lock may have been held by another thread at the time of the fork
+        self.lock = threading.RLock()
+        if self.reaper_thread is not None and not self.reaper_stop.is_set():
+            self.reaper_thread = None
+            self.start_reaper(self.reaper_interval)
+
+    def reap(self):
+        while not self.reaper_stop.wait(self.reaper_interval.total_seconds()):
+            self.purge_expired_tokens()
@@ -0,0 +1,177 @@
+# Storage backends for the TokenExpirationManager.
+# The manager decides *when* a token expires (grouping, proximity, etc),
+# the store only keeps the tokens and their expiration times.
+# MemoryTokenStore is the default and lives in process memory.
+# SQLiteTokenStore keeps the tokens in an SQLite database in WAL mode,
+# so that several worker processes on the same host can share them.
+import os
+import pickle
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+from heapq import heappush, heappop
+
+class MemoryTokenStore:
+    def __init__(self):
+        self.expirations = {} # <datetime>: set() of token_tag
+        self.expiration_heap = [] # min-heap of the <datetime> keys of self.expirations
+        self.latest_group = None # <datetime> of the most recently created expiration group
+        self.tokens = {} # token_tag: tokenObj
+        self.token_expiration_time = {} # token_tag: <datetime> for the expirations group
+
+    def add(self, token, tokenObj, expiration_time):
+        self.tokens[token] = tokenObj
+        self.set_expiration_time(token, expiration_time)
+
+    def get(self, token):
+        return self.tokens.get(token)
+
+    def get_expiration_time(self, token):
+        return self.token_expiration_time.get(token)
+
+    def get_with_expiration_time(self, token):
+        return self.tokens.get(token), self.token_expiration_time.get(token)
+
+    def get_latest_expiration_time(self):
+        return self.latest_group
+
+    def set_expiration_time(self, token, expiration_time):
+        current_expiration = self.token_expiration_time.get(token)
+        if current_expiration == expiration_time:
+            # Already in this group, nothing to move
+            return
+        if expiration_time not in self.expirations:
+            # Create a new expiration group
+            self.expirations[expiration_time] = set()
+            heappush(self.expiration_heap, expiration_time)
+            if self.latest_group is None or expiration_time > self.latest_group:
+                self.latest_group = expiration_time
+        if self.expirations.get(current_expiration):
+            # Older token, remove it from its previous group
+            self.expirations[current_expiration].discard(token)
+        self.expirations[expiration_time].add(token)
+        self.token_expiration_time[token] = expiration_time
+
+    def remove(self, token):
+        expiration_time = self.token_expiration_time[token]
+        self.expirations[expiration_time].remove(token)
+        del self.token_expiration_time[token]
+        del self.tokens[token]
+        # Do not remove an empty expiration group set here,
+        # it will be caught by purge() and removed
+        # when the group's turn comes up in the heap.
+
+    def purge(self, utcnow, max_groups=None):
+        # Pop the token groups whose expiration time has elapsed off the heap
+        # and remove them, at most <max_groups> of them if given.
+        # Groups that haven't expired yet are never looked at.
+        # Returns (purged tokens, purged groups)
+        removed_sets = 0
+        purged = 0
+        while self.expiration_heap and self.expiration_heap[0] <= utcnow:
+            if max_groups is not None and removed_sets >= max_groups:
+                break
+            group_expiration_time = heappop(self.expiration_heap)
+            # Lazy deletion: the group might already be gone
+            current_set = self.expirations.pop(group_expiration_time, None)
+            if current_set is None:
+                continue
+            removed_sets += 1
+            purged += len(current_set)
+            for token in current_set:
+                # Remove the token from everywhere
+                del self.token_expiration_time[token]
+                del self.tokens[token]
+        if not self.expiration_heap:
+            self.latest_group = None
+        return purged, removed_sets
+
+# Expiration times are stored as integer microseconds since the epoch,
+# so that they round trip through SQLite exactly.
+EPOCH = datetime(1970, 1, 1)
+
+def to_microseconds(datetimeObj):
+    return (datetimeObj - EPOCH) // timedelta(microseconds=1)
+
+def from_microseconds(microseconds):
+    return EPOCH + timedelta(microseconds=microseconds)
+
+class SQLiteTokenStore:
+    def __init__(self, path, timeout=5.0):
+        self.path = path
+        self.timeout = timeout # seconds to wait for another process' write lock
+        # sqlite3 connections can't be shared between threads or across fork(),
+        # so every thread of every process gets its own connection.
+        self.local = threading.local()
+        connection = self.get_connection()
+        connection.execute("CREATE TABLE IF NOT EXISTS tokens ("
+                "token PRIMARY KEY, token_object BLOB NOT NULL, expires INTEGER NOT NULL)")
+        connection.execute("CREATE INDEX IF NOT EXISTS tokens_expires ON tokens (expires)")
+
+    def get_connection(self):
+        pid = os.getpid()
+        if getattr(self.local, "pid", None) != pid:
+            # isolation_level=None: every statement commits on its own,
+            # multi-statement transactions are opened explicitly.
+            connection = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            # WAL lets readers in other processes carry on while one process writes
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self.local.connection = connection
+            self.local.pid = pid
+        return self.local.connection
+
+    def add(self, token, tokenObj, expiration_time):
+        self.get_connection().execute("INSERT OR REPLACE INTO tokens (token, token_object, expires) VALUES (?, ?, ?)",
+                (token, pickle.dumps(tokenObj), to_microseconds(expiration_time)))
+
+    def get(self, token):
+        row = self.get_connection().execute("SELECT token_object FROM tokens WHERE token = ?", (token,)).fetchone()
+        if row is None:
+            return None
+        return pickle.loads(row[0])
+
+    def get_expiration_time(self, token):
+        row = self.get_connection().execute("SELECT expires FROM tokens WHERE token = ?", (token,)).fetchone()
+        if row is None:
+            return None
+        return from_microseconds(row[0])
+
+    def get_with_expiration_time(self, token):
+        row = self.get_connection().execute("SELECT token_object, expires FROM tokens WHERE token = ?", (token,)).fetchone()
+        if row is None:
+            return None, None
+        return pickle.loads(row[0]), from_microseconds(row[1])
+
+    def get_latest_expiration_time(self):
+        # Answered from the end of the expires index
+        row = self.get_connection().execute("SELECT MAX(expires) FROM tokens").fetchone()
+        if row[0] is None:
+            return None
+        return from_microseconds(row[0])
+
+    def set_expiration_time(self, token, expiration_time):
+        self.get_connection().execute("UPDATE tokens SET expires = ? WHERE token = ?",
+                (to_microseconds(expiration_time), token))
+
+    def remove(self, token):
+        self.get_connection().execute("DELETE FROM tokens WHERE token = ?", (token,))
+
+    def purge(self, utcnow, max_groups=None):
+        # Returns (purged tokens, purged groups), where a group is
+        # every token that shares the same expiration time.
+        # Everything is deleted in one statement, the other processes
+        # keep reading in the meantime, so <max_groups> is not needed here.
+        connection = self.get_connection()
+        utcnow = to_microseconds(utcnow)
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            purged, removed_sets = connection.execute("SELECT COUNT(*), COUNT(DISTINCT expires) FROM tokens WHERE expires <= ?",
+                    (utcnow,)).fetchone()
+            if purged > 0:
+                connection.execute("DELETE FROM tokens WHERE expires <= ?", (utcnow,))
+            connection.execute("COMMIT")
+        except sqlite3.Error:
+            connection.execute("ROLLBACK")
+            raise
+        return purged, removed_sets
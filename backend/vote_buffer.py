@@ -0,0 +1,154 @@
+# Write-behind buffer for votes.
+# When a post gets a lot of votes, committing every vote on its own means every one of them
+# waits for the SQLite write lock and rewrites the same karma row. Instead, votes are recorded
+# in memory, deduplicated per (user, post/comment) so only the latest vote of each user counts,
+# and written in one transaction once enough of them pile up or enough time has passed.
+# Until then, get_karma() shows the stored karma plus the buffered changes.
+# Recording a vote doesn't read the database: a user's previous vote is only known once a flush
+# has written it, so the buffered change of a vote is measured from the vote that the latest flush
+# wrote for the same user and target, or from no vote. A flush counts the actual changes
+# from the database, so the shown karma is exact again after it, and the voters and targets
+# are checked in one query per flush, dropping the votes of those that don't exist.
+# The buffer is per process, and votes that haven't been flushed are lost if the process dies.
+import threading
+from collections import defaultdict
+from datetime import timedelta
+from time import monotonic
+from backend.models import Post, PostVote, Comment, CommentVote, db
+from backend.database import vote_functions
+from backend.hot_feed import hot_feed
+from backend.content_versions import content_versions
+
+# What can be voted on: kind: (vote model, target model, the vote's column pointing at the target)
+VOTE_TARGETS = {
+        "post": (PostVote, Post, "post_id"),
+        "comment": (CommentVote, Comment, "comment_id"),
+        }
+
+class VoteBuffer:
+    def __init__(self, max_pending=1000, flush_interval=timedelta(seconds=1)):
+        self.max_pending = max_pending # flush once this many distinct votes are waiting
+        self.flush_interval = flush_interval.total_seconds() # or once the oldest one waited this long
+        self.pending = {} # (kind, user_id, target_id): latest vote_type (True, False or None for no vote)
+        self.base = {} # (kind, user_id, target_id): the vote_type the pending vote's karma change is measured from
+        self.flushed = {} # the votes written by the latest flush, or being written by the running one
+        self.deltas = defaultdict(int) # (kind, target_id): karma change that hasn't been written yet
+        self.oldest = None # monotonic() time of the oldest pending vote
+        self.lock = threading.RLock()
+        self.flush_lock = threading.Lock() # only one flush at a time
+        self.flusher_thread = None
+        self.flusher_stop = threading.Event()
+
+    def record(self, kind, user_id, target_id, vote_type):
+        # Buffer a vote. Votes of users or on posts/comments that don't exist are dropped by the flush.
+        key = (kind, user_id, target_id)
+        with self.lock:
+            if key in self.pending:
+                previous = self.pending[key]
+            else:
+                previous = self.base[key] = self.flushed.get(key)
+            self.pending[key] = vote_type
+            self.deltas[(kind, target_id)] += vote_functions.vote_value(vote_type) - vote_functions.vote_value(previous)
+            if self.oldest is None:
+                self.oldest = monotonic()
+            should_flush = len(self.pending) >= self.max_pending or monotonic() - self.oldest >= self.flush_interval
+        if should_flush:
+            self.flush()
+
+    def get_karma(self, kind, target_id, stored_karma):
+        # The karma of a post or comment including the votes that haven't been flushed yet
+        with self.lock:
+            return (stored_karma or 0) + self.deltas.get((kind, target_id), 0)
+
+    def flush(self):
+        # Write all the pending votes in one transaction, with a few statements per batch of votes
+        # (see vote_functions.apply_votes()) and one karma UPDATE per post or comment instead of one per vote.
+        # Returns the number of votes written, not counting the dropped ones.
+        with self.flush_lock:
+            with self.lock:
+                pending, base = self.pending, self.base
+                self.pending, self.base, self.oldest = {}, {}, None
+                # Votes recorded from now on are measured from these
+                self.flushed = pending
+            if not pending:
+                return 0
+            # The buffered karma changes that this flush moves into the database
+            expected = defaultdict(int)
+            karma = defaultdict(int)
+            written = 0
+            try:
+                by_kind = defaultdict(list)
+                for key, vote_type in pending.items():
+                    kind, user_id, target_id = key
+                    expected[(kind, target_id)] += vote_functions.vote_value(vote_type) - vote_functions.vote_value(base[key])
+                    by_kind[kind].append((user_id, target_id, vote_type))
+                for kind, votes in by_kind.items():
+                    vote_model, target_model, target_key = VOTE_TARGETS[kind]
+                    user_ids, target_ids = vote_functions.existing_ids(vote_model, target_model, target_key,
+                            {user_id for user_id, target_id, vote_type in votes}, {target_id for user_id, target_id, vote_type in votes})
+                    votes = [vote for vote in votes if vote[0] in user_ids and vote[1] in target_ids]
+                    # The actual changes come from the database: the stored votes, and other processes' votes
+                    changes = vote_functions.apply_votes(vote_model, target_model, target_key, votes)
+                    for target_id, delta in changes.items():
+                        karma[(kind, target_id)] += delta
+                    written += len(votes)
+                for (kind, target_id), delta in karma.items():
+                    vote_functions.add_karma(*VOTE_TARGETS[kind], target_id, delta)
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                # Put the votes back, unless the user voted again since
+                with self.lock:
+                    self.flushed = {}
+                    for key, vote_type in pending.items():
+                        if key not in self.pending:
+                            self.pending[key] = vote_type
+                        # A new vote was measured from this one, which the database doesn't have,
+                        # and its change in deltas plus this one's add up to the change from the stored vote
+                        self.base[key] = base[key]
+                    if self.pending and self.oldest is None:
+                        self.oldest = monotonic()
+                raise
+            with self.lock:
+                for key, delta in expected.items():
+                    self.deltas[key] -= delta
+                    if self.deltas[key] == 0:
+                        del self.deltas[key]
+            changed_posts = [target_id for (kind, target_id), delta in karma.items() if kind == "post" and delta]
+            changed_comments = [target_id for (kind, target_id), delta in karma.items() if kind == "comment" and delta]
+            content_versions.bump_communities(hot_feed.refresh_posts(changed_posts))
+            content_versions.bump_posts(changed_posts)
+            if changed_comments:
+                query = db.session.query(Comment.post_id).filter(Comment.id.in_(changed_comments)).distinct()
+                content_versions.bump_posts([post_id for post_id, in query])
+            return written
+
+    def start_flusher(self, app):
+        # Flush in a background thread every flush_interval, so that
+        # votes don't wait for the next vote to arrive before they're written.
+        # Calling this again while the flusher is running does nothing.
+        with self.lock:
+            if self.flusher_thread is not None and self.flusher_thread.is_alive():
+                return
+            self.flusher_stop.clear()
+            self.flusher_thread = threading.Thread(target=self.flush_periodically, args=(app,), name="vote-flusher", daemon=True)
+            self.flusher_thread.start()
+
+    def stop_flusher(self):
+        with self.lock:
+            flusher_thread = self.flusher_thread
+            self.flusher_thread = None
+            self.flusher_stop.set()
+        if flusher_thread is not None:
+            flusher_thread.join()
+
+    def flush_periodically(self, app):
+        while not self.flusher_stop.wait(self.flush_interval):
+            with app.app_context():
+                try:
+                    self.flush()
+                except Exception as e:
+                    # The votes are kept and retried on the next flush
+                    app.logger.exception("Flushing votes failed: %s", e)
+
+vote_buffer = VoteBuffer()
@@ -0,0 +1,55 @@
+# Benchmark for the memory used to serve a big comment thread.
+# Compares loading every comment of a 50k comment post as ORM objects (what
+# post.comments used to do) with the first page that viewpost shows, and with
+# streaming the whole thread through comment_functions.iter_thread(), which only
+# holds one chunk of rows at a time. Peak memory is measured with tracemalloc.
+# Usage: python -m benchmarks.bench_comment_stream [comments]
+import gc
+import os
+import sys
+import tempfile
+import tracemalloc
+from time import perf_counter
+from main import create_app
+from backend.models import db, Comment
+from backend.database import comment_functions
+from backend.blueprints.community import THREAD_DEPTH, THREAD_COMMENTS
+from benchmarks.bench_comment_tree import populate
+
+def measure(name, function):
+    db.session.expire_all()
+    gc.collect()
+    tracemalloc.start()
+    start = perf_counter()
+    count = function()
+    elapsed = perf_counter() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print("  {:32s} {:6d} comments, {:8.1f} ms, peak {:7.1f} MB".format(name, count, elapsed * 1000, peak / 1e6))
+
+def load_all():
+    return len(Comment.query.filter(Comment.post_id == 1).all())
+
+def first_page():
+    roots, next_token = comment_functions.get_thread_page(1, max_depth=THREAD_DEPTH, limit=THREAD_COMMENTS)
+    return len(comment_functions.flatten_tree(roots))
+
+def stream_all():
+    count = 0
+    for row in comment_functions.iter_thread(1):
+        count += 1
+    return count
+
+def main(count):
+    directory = tempfile.mkdtemp()
+    app = create_app(os.path.join(directory, "bench.db"))
+    with app.app_context():
+        db.create_all()
+        depth = populate(count)
+        print("{} comments, {} levels deep".format(count, depth))
+        measure("all comments as ORM objects", load_all)
+        measure("first page (get_thread_page)", first_page)
+        measure("stream (iter_thread)", stream_all)
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 50000)
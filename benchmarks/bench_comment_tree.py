@@ -0,0 +1,66 @@
+# Benchmark for loading and rendering a big comment thread.
+# A 50k comment thread is loaded with comment_functions.get_comment_tree() (one range query
+# on the comment_post_path index, and the tree built in one pass), flattened, and rendered
+# with the viewpost template. Also measures the first page that viewpost actually shows.
+# Usage: python -m benchmarks.bench_comment_tree [comments]
+import os
+import sys
+import tempfile
+from random import Random
+from time import perf_counter
+from flask import g, render_template
+from main import create_app
+from backend.models import db, User, Community, Post, Comment, comment_path_segment
+from backend.database import comment_functions
+from backend.blueprints.community import THREAD_DEPTH, THREAD_COMMENTS
+
+def populate(count):
+    # One post with <count> comments. Most replies go to recent comments, like in a real discussion.
+    random = Random(1234)
+    db.session.add(User(id=1, username="author", password="hash", salt="salt"))
+    db.session.add(Community(id=1, name="benchmark", description="description"))
+    db.session.add(Post(id=1, user_id=1, community_id=1, title="Big thread", body="body"))
+    db.session.commit()
+    paths = {}
+    rows = []
+    for comment_id in range(1, count + 1):
+        parent_id = None
+        if comment_id > 1 and random.random() < 0.8:
+            parent_id = max(1, comment_id - int(random.expovariate(1 / 50)) - 1)
+        paths[comment_id] = (paths[parent_id] if parent_id else "") + comment_path_segment(comment_id)
+        rows.append({"id": comment_id, "user_id": 1, "post_id": 1, "parent_id": parent_id, "path": paths[comment_id],
+            "text": "Comment number {}".format(comment_id), "karma": random.randint(-5, 50), "is_pinned": comment_id == count})
+    db.session.execute(Comment.__table__.insert(), rows)
+    db.session.commit()
+    return max(len(path) for path in paths.values()) // len(comment_path_segment(1))
+
+def measure(app, **kwargs):
+    db.session.expire_all()
+    start = perf_counter()
+    tree = comment_functions.get_comment_tree(1, **kwargs)
+    loaded = perf_counter()
+    comments = comment_functions.flatten_tree(tree)
+    flattened = perf_counter()
+    with app.test_request_context("/community/viewpost/1"):
+        g.user = None
+        post = Post.query.filter(Post.id == 1).first()
+        html = render_template("community/viewpost.html", post=post, community=post.community, comments=comments)
+    rendered = perf_counter()
+    print("  {:6d} comments: load {:8.1f} ms, flatten {:6.1f} ms, render {:8.1f} ms, total {:8.1f} ms ({:.1f} MB of HTML)".format(
+        len(comments), (loaded - start) * 1000, (flattened - loaded) * 1000, (rendered - flattened) * 1000,
+        (rendered - start) * 1000, len(html) / 1e6))
+
+def main(count):
+    directory = tempfile.mkdtemp()
+    app = create_app(os.path.join(directory, "bench.db"))
+    with app.app_context():
+        db.create_all()
+        depth = populate(count)
+        print("{} comments, {} levels deep".format(count, depth))
+        print("Whole thread:")
+        measure(app)
+        print("First page of viewpost (depth {}, {} comments):".format(THREAD_DEPTH, THREAD_COMMENTS))
+        measure(app, max_depth=THREAD_DEPTH, limit=THREAD_COMMENTS)
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 50000)
@@ -0,0 +1,58 @@
+# Benchmark for a community page with 200 posts, with and without the rendered
+# fragments of the posts in backend/fragment_cache.py.
+# Cold: the fragment cache is emptied before every request, so every post is rendered
+# (and its author loaded). Warm: every post's fragment comes from the cache.
+# The requests go through the whole application with the test client.
+# Usage: python -m benchmarks.bench_fragment_cache [posts] [requests]
+import os
+import sys
+import tempfile
+from datetime import datetime, timedelta
+from time import perf_counter
+from main import create_app
+from backend.models import db, User, Community, Post
+from backend.blueprints import community
+from backend.fragment_cache import fragment_cache
+from backend.page_cache import page_cache
+
+def populate(count):
+    # One community with <count> recent posts by 20 different users
+    now = datetime.utcnow()
+    db.session.add_all(User(id=user_id, username="user {}".format(user_id), password="hash", salt="salt") for user_id in range(1, 21))
+    db.session.add(Community(id=1, name="benchmark", description="description"))
+    db.session.add_all(Post(user_id=post_id % 20 + 1, community_id=1, title="Post number {}".format(post_id),
+        body="The body of post {}. ".format(post_id) * 20, karma=post_id % 50,
+        post_time=now - timedelta(minutes=post_id)) for post_id in range(count))
+    db.session.commit()
+
+def measure(client, name, requests, cold):
+    start = perf_counter()
+    for i in range(requests):
+        if cold:
+            fragment_cache.fragments.clear()
+        # Render the page every time, instead of serving it from the anonymous page cache
+        page_cache.pages.clear()
+        response = client.get("/community/benchmark")
+        assert response.status_code == 200
+    elapsed = perf_counter() - start
+    print("  {}: {:7.1f} requests per second, {:6.2f} ms per request".format(name, requests / elapsed, elapsed / requests * 1000))
+    return response.data
+
+def main(count, requests):
+    directory = tempfile.mkdtemp()
+    app = create_app(os.path.join(directory, "bench.db"))
+    community.POSTS_PER_PAGE = count
+    with app.app_context():
+        db.create_all()
+        populate(count)
+    client = app.test_client()
+    print("Community page with {} posts, {} requests each".format(count, requests))
+    cold_html = measure(client, "cold", requests, True)
+    warm_html = measure(client, "warm", requests, False)
+    assert cold_html == warm_html, "the cached page differs"
+    print("  {} fragments cached, {:.1f} kB".format(len(fragment_cache.fragments), fragment_cache.fragments.size / 1000))
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    requests = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    main(count, requests)
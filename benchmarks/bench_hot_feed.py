@@ -0,0 +1,77 @@
+# Benchmark for building the hot front page feed of a user in 500 communities
+# with 10M posts in total.
+# Compares sorting every post of the user's communities by hot score with the
+# k-way merge of the per-community rankings kept by HotFeed.
+# The posts are generated in memory. Loading a ranking from the database is one
+# index range scan per community, done once per ranking TTL, and isn't measured here.
+# Usage: python -m benchmarks.bench_hot_feed [total posts] [communities]
+import gc
+import sys
+from datetime import datetime, timedelta
+from heapq import nlargest
+from random import Random
+from time import perf_counter
+from backend.hot_feed import HotFeed, CommunityRanking
+from backend.models import hot_score
+
+FEED_SIZE = 25
+REPEAT = 1000
+
+def generate_scores(random, first_post_id, count, now):
+    # Hot scores of <count> posts from the last 30 days, most of them with little karma
+    scores = []
+    for post_id in range(first_post_id, first_post_id + count):
+        karma = int(random.paretovariate(1.2)) - 1
+        post_time = now - timedelta(seconds=random.randrange(30 * 24 * 3600))
+        scores.append((post_id, hot_score(karma, post_time)))
+    return scores
+
+def sort_all(all_scores):
+    # What serving the feed costs without precomputed rankings
+    all_scores.sort(key=lambda entry: (-entry[1], -entry[0]))
+    return [post_id for post_id, score in all_scores[:FEED_SIZE]]
+
+def main(total_posts, communities):
+    random = Random(1234)
+    now = datetime(2024, 6, 1)
+    per_community = total_posts // communities
+    feed = HotFeed(max_communities=communities)
+    all_scores = []
+    print("Generating {} posts in {} communities...".format(per_community * communities, communities))
+    for community_id in range(communities):
+        scores = generate_scores(random, community_id * per_community + 1, per_community, now)
+        all_scores.extend(scores)
+        # What load_rankings() reads from the post_community_hot_score index
+        hottest = nlargest(feed.max_posts, scores, key=lambda entry: (entry[1], entry[0]))
+        feed.rankings.set(community_id, CommunityRanking(hottest, len(scores) <= feed.max_posts))
+    community_ids = list(range(communities))
+
+    start = perf_counter()
+    expected = sort_all(all_scores)
+    sort_time = perf_counter() - start
+    print("  sort all posts: {:10.1f} ms per feed".format(sort_time * 1000))
+    # A server doesn't keep every post in memory, and the 10M objects
+    # would make the garbage collector dominate the timings below
+    del all_scores
+    gc.collect()
+
+    start = perf_counter()
+    for i in range(REPEAT):
+        merged = feed.get_feed(community_ids, FEED_SIZE)
+    merge_time = (perf_counter() - start) / REPEAT
+    print("  k-way merge:    {:10.3f} ms per feed ({:.0f}x faster)".format(merge_time * 1000, sort_time / merge_time))
+    assert merged == expected, "the merged feed differs from the sorted one"
+
+    # A vote on a post moves it within its community's ranking
+    updates = [(random.randrange(communities), random.random() * 2000) for i in range(REPEAT)]
+    start = perf_counter()
+    for community_id, score in updates:
+        post_id = community_id * per_community + 1
+        feed.update(community_id, post_id, score)
+    update_time = (perf_counter() - start) / REPEAT
+    print("  ranking update: {:10.3f} ms per vote".format(update_time * 1000))
+
+if __name__ == "__main__":
+    total_posts = int(sys.argv[1]) if len(sys.argv) > 1 else 10000000
+    communities = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    main(total_posts, communities)
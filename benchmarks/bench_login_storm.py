@@ -0,0 +1,99 @@
+# Benchmark for page views during a login storm (backend/password_hasher.py).
+# A logged in reader keeps loading the front page while a crowd of clients keeps logging in.
+# Compares the page latency with no logins, with the argon2 hashes in the request threads
+# like register_user() and verify_user() used to do, and with the hashing process pool.
+# Clients turned away with 503 Try again wait a little before logging in again.
+# The crowd logs in as the same user over and over, so the rate limits are turned off:
+# it measures the hashing, not backend/rate_limiter.py. A 429 would mean they're still on.
+# Usage: python -m benchmarks.bench_login_storm [login clients] [seconds]
+import os
+import sys
+import tempfile
+import threading
+from time import perf_counter, sleep
+from main import create_app
+from backend.models import db, Community, Post
+from backend.database import user_functions
+from backend.password_hasher import PasswordHasher
+
+POSTS = 100
+RETRY_PAUSE = 0.05 # seconds a client waits after a 503
+
+def percentile(timings, fraction):
+    timings = sorted(timings)
+    return timings[min(len(timings) - 1, int(len(timings) * fraction))] * 1000
+
+def populate():
+    user_functions.register_user("reader", "reader password", "reader@example.com")
+    user_functions.register_user("crowd", "crowd password", "crowd@example.com")
+    community = Community(name="community", description="description")
+    db.session.add(community)
+    db.session.commit()
+    db.session.add_all(Post(user_id=1, community_id=community.id, title="Post {}".format(i), body="Body of post {}".format(i))
+            for i in range(POSTS))
+    db.session.commit()
+
+def login(client, username, password):
+    return client.post("/login", data={"username": username, "password": password}).status_code
+
+def run(app, reader, login_clients, seconds):
+    stop = threading.Event()
+    logins = {"ok": 0, "busy": 0, "rate limited": 0, "failed": 0}
+    lock = threading.Lock()
+    def storm():
+        client = app.test_client()
+        while not stop.is_set():
+            status = login(client, "crowd", "crowd password")
+            with lock:
+                logins[{302: "ok", 503: "busy", 429: "rate limited"}.get(status, "failed")] += 1
+            if status == 503:
+                sleep(RETRY_PAUSE)
+    threads = [threading.Thread(target=storm) for i in range(login_clients)]
+    for thread in threads:
+        thread.start()
+    timings = []
+    end = perf_counter() + seconds
+    while perf_counter() < end:
+        start = perf_counter()
+        reader.get("/")
+        timings.append(perf_counter() - start)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    return timings, logins
+
+def report(name, timings, logins, seconds):
+    print("  {:22s} page views: median {:7.2f} ms, p99 {:7.2f} ms, max {:7.2f} ms; logins: {:5.1f}/s, {} busy (503), {} rate limited (429), {} failed".format(
+        name, percentile(timings, 0.5), percentile(timings, 0.99), max(timings) * 1000, logins["ok"] / seconds,
+        logins["busy"], logins["rate limited"], logins["failed"]))
+
+def main(login_clients, seconds):
+    app = create_app(os.path.join(tempfile.mkdtemp(), "bench.db"))
+    app.config["WTF_CSRF_ENABLED"] = False
+    app.config["RATE_LIMIT_ENABLED"] = False
+    app.app_context().push()
+    db.create_all()
+    populate()
+    reader = app.test_client()
+    assert login(reader, "reader", "reader password") == 302
+    print("{} login clients, {} s each, {} CPUs".format(login_clients, seconds, os.cpu_count()))
+    timings, logins = run(app, reader, 0, seconds)
+    report("no logins", timings, logins, seconds)
+    for name, hasher in (("hashing inline", PasswordHasher(workers=0)), ("hashing pool", PasswordHasher())):
+        user_functions.password_hasher = hasher
+        # Like create_app() does for the app's hasher, a while before the first login
+        start = perf_counter()
+        hasher.start(block=True)
+        if hasher.workers:
+            print("  {:22s} {} hashing processes started in {:.2f} s".format("", hasher.workers, perf_counter() - start))
+        timings, logins = run(app, reader, login_clients, seconds)
+        report(name, timings, logins, seconds)
+        stats = hasher.stats()
+        print("  {:22s} verify: median {:7.2f} ms, p99 {:7.2f} ms; queue wait: median {:7.2f} ms".format(
+            "", stats["verify"]["p50"], stats["verify"]["p99"], stats["wait"]["p50"]))
+        hasher.shutdown()
+
+if __name__ == "__main__":
+    login_clients = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 10
+    main(login_clients, seconds)
@@ -0,0 +1,61 @@
+# Benchmark for the permission checks in create_post() and create_comment().
+# Compares loading the community's member and ban lists and testing `user_obj in list`,
+# which is what those functions used to do, with permission_functions, both with a cold
+# cache (one UNION query) and a warm one (a dictionary lookup).
+# Usage: python -m benchmarks.bench_permission_checks [members]
+import os
+import sys
+import tempfile
+from time import perf_counter
+from main import create_app
+from backend.models import db, User, Community, memberships, bans
+from backend.database import permission_functions
+
+def populate(members, chunk_size=50000):
+    # Bulk insert through the core tables, creating a million ORM objects would take forever
+    community = Community(name="huge", description="A community with a lot of members")
+    db.session.add(community)
+    db.session.commit()
+    for start in range(1, members + 1, chunk_size):
+        ids = range(start, min(start + chunk_size, members + 1))
+        db.session.execute(User.__table__.insert(), [{"id": i, "username": "user_{}".format(i), "password": "hash", "salt": "salt"} for i in ids])
+        db.session.execute(memberships.insert(), [{"user_id": i, "community_id": community.id} for i in ids])
+    # Ban every 1000th user
+    db.session.execute(bans.insert(), [{"user_id": i, "community_id": community.id} for i in range(1000, members + 1, 1000)])
+    db.session.commit()
+    return community.id
+
+def time_it(function, repeat):
+    start = perf_counter()
+    for r in range(repeat):
+        function()
+    return (perf_counter() - start) / repeat * 1000
+
+if __name__ == "__main__":
+    members = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    path = os.path.join(tempfile.mkdtemp(), "bench.db")
+    app = create_app(path)
+    app.app_context().push()
+    db.create_all()
+    print("Populating a community with {} members".format(members))
+    community_id = populate(members)
+    user_id = members // 2 + 1 # a member, not banned
+
+    def legacy_check():
+        # What create_post() did: load both lists and scan them
+        db.session.expire_all()
+        community = Community.query.filter(Community.id == community_id).first()
+        user_obj = User.query.filter(User.id == user_id).first()
+        return user_obj in community.banned_users or user_obj not in community.users
+
+    def cached_check():
+        return permission_functions.is_banned(user_id, community_id) or not permission_functions.is_member(user_id, community_id)
+
+    def cold_check():
+        permission_functions.permission_cache.clear()
+        return cached_check()
+
+    print("legacy list scan: {:>10.3f} ms per check".format(time_it(legacy_check, 3)))
+    print("cold cache:       {:>10.3f} ms per check".format(time_it(cold_check, 1000)))
+    print("warm cache:       {:>10.3f} ms per check".format(time_it(cached_check, 100000)))
+    os.remove(path)
@@ -0,0 +1,113 @@
+# Benchmark for full text search (backend/database/search_functions.py) on a 5M post corpus.
+# Indexing: building the FTS5 index of every post at once with rebuild_index(), and adding
+# posts one at a time, each in its own transaction, like create_post() does.
+# Queries: latency of search() for common, uncommon and rare words, two words,
+# one community, and the second page through the cursor.
+# The text is made of made up words with a Zipf distribution, like the words of real text.
+# Usage: python -m benchmarks.bench_search [posts] [communities]
+import os
+import sys
+import tempfile
+from itertools import accumulate
+from random import Random
+from time import perf_counter
+from main import create_app
+from backend.models import db, User, Community, Post
+from backend.database import search_functions
+
+VOCABULARY = 50000
+TITLE_WORDS = 6
+BODY_WORDS = 40
+INSERT_CHUNK = 50000
+QUERIES = 50 # per kind of query
+INCREMENTAL_POSTS = 2000
+
+def make_vocabulary(random):
+    syllables = [consonant + vowel for consonant in "bdfgklmnprstvz" for vowel in "aeiou"]
+    words = set()
+    while len(words) < VOCABULARY:
+        words.add("".join(random.choice(syllables) for i in range(random.randint(2, 4))))
+    # Sorted first, a set's order changes from one run to another
+    words = sorted(words)
+    random.shuffle(words)
+    return words
+
+def populate(random, words, weights, posts, communities):
+    db.session.add(User(id=1, username="author", password="hash", salt="salt"))
+    db.session.add_all(Community(id=community_id, name="community {}".format(community_id), description="description")
+            for community_id in range(1, communities + 1))
+    db.session.commit()
+    post_table = Post.__table__
+    for start in range(0, posts, INSERT_CHUNK):
+        rows = []
+        for post_id in range(start + 1, min(start + INSERT_CHUNK, posts) + 1):
+            text = random.choices(words, cum_weights=weights, k=TITLE_WORDS + BODY_WORDS)
+            rows.append({"id": post_id, "user_id": 1, "community_id": random.randint(1, communities),
+                "title": " ".join(text[:TITLE_WORDS]), "body": " ".join(text[TITLE_WORDS:])})
+        db.session.execute(post_table.insert(), rows)
+        db.session.commit()
+        print("\r  {} posts".format(start + len(rows)), end="", flush=True)
+    print()
+
+def percentile(timings, fraction):
+    timings = sorted(timings)
+    return timings[min(len(timings) - 1, int(len(timings) * fraction))]
+
+def measure_queries(name, queries):
+    # queries: (text, community_id, cursor) tuples
+    timings = []
+    found = 0
+    for text, community_id, cursor in queries:
+        start = perf_counter()
+        results, next_cursor = search_functions.search(text, community_id, cursor)
+        timings.append(perf_counter() - start)
+        found += len(results)
+    print("  {:28s} median {:8.2f} ms, p95 {:8.2f} ms, {:5.1f} results per page".format(
+        name, percentile(timings, 0.5) * 1000, percentile(timings, 0.95) * 1000, found / len(queries)))
+
+def main(posts, communities):
+    random = Random(1234)
+    path = os.path.join(tempfile.mkdtemp(), "bench.db")
+    app = create_app(path)
+    with app.app_context():
+        db.create_all()
+        words = make_vocabulary(random)
+        weights = list(accumulate(1 / rank for rank in range(1, VOCABULARY + 1)))
+        print("Generating {} posts in {} communities...".format(posts, communities))
+        populate(random, words, weights, posts, communities)
+        size = os.path.getsize(path)
+
+        print("Indexing:")
+        start = perf_counter()
+        count = search_functions.rebuild_index()
+        elapsed = perf_counter() - start
+        print("  rebuild_index():     {:8.1f} s, {:8.0f} rows per second, index {:.0f} MB".format(
+            elapsed, count / elapsed, (os.path.getsize(path) - size) / 1e6))
+        start = perf_counter()
+        for post_id in range(posts + 1, posts + INCREMENTAL_POSTS + 1):
+            text = random.choices(words, cum_weights=weights, k=TITLE_WORDS + BODY_WORDS)
+            search_functions.add_to_index("post", post_id, 1, " ".join(text[:TITLE_WORDS]), " ".join(text[TITLE_WORDS:]))
+            db.session.commit()
+        elapsed = perf_counter() - start
+        print("  one post at a time:  {:8.3f} ms per post, {:8.0f} posts per second".format(
+            elapsed / INCREMENTAL_POSTS * 1000, INCREMENTAL_POSTS / elapsed))
+
+        print("Queries ({} of each):".format(QUERIES))
+        def pick(low, high):
+            return [random.choice(words[low:high]) for i in range(QUERIES)]
+        measure_queries("common word (top 100)", [(word, None, None) for word in pick(0, 100)])
+        measure_queries("uncommon word (top 5000)", [(word, None, None) for word in pick(1000, 5000)])
+        measure_queries("rare word", [(word, None, None) for word in pick(20000, VOCABULARY)])
+        measure_queries("two words", [("{} {}".format(*pair), None, None) for pair in zip(pick(100, 1000), pick(100, 1000))])
+        measure_queries("uncommon word, 1 community", [(word, random.randint(1, communities), None) for word in pick(1000, 5000)])
+        second_pages = []
+        for word in pick(1000, 5000):
+            cursor = search_functions.search(word)[1]
+            if cursor:
+                second_pages.append((word, None, cursor))
+        measure_queries("uncommon word, 2nd page", second_pages)
+
+if __name__ == "__main__":
+    posts = int(sys.argv[1]) if len(sys.argv) > 1 else 5000000
+    communities = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    main(posts, communities)
@@ -0,0 +1,42 @@
+# Memory benchmark for the session records.
+# Compares the bytes used per live session by the previous Session class
+# (a __dict__ per instance and a 128 character str ID) with the current one
+# (__slots__ and a 32 byte ID), both held by the same TokenExpirationManager.
+# Usage: python -m benchmarks.bench_session_memory [sessions]
+import sys
+import tracemalloc
+from datetime import timedelta
+from random import choice
+from string import ascii_letters, digits
+from time import perf_counter
+from backend.token_expiration_manager import TokenExpirationManager
+from backend.blueprints.session_manager import Session
+
+# The previous implementation, kept here only for comparison
+def generate_random_tag(length=128):
+    characters = ascii_letters + digits + "_"
+    return "".join([choice(characters) for c in range(length)])
+
+class LegacySession:
+    def __init__(self, user_id):
+        self.session_id = generate_random_tag()
+        self.user_id = user_id
+
+def measure(session_class, sessions):
+    manager = TokenExpirationManager(session_timeout=timedelta(hours=2), expiration_proximity=timedelta(minutes=10))
+    tracemalloc.start()
+    start = perf_counter()
+    for user_id in range(sessions):
+        session_obj = session_class(user_id)
+        manager.add_token(session_obj.session_id, session_obj)
+    elapsed = perf_counter() - start
+    used, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return used / sessions, elapsed
+
+if __name__ == "__main__":
+    sessions = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    print("{} live sessions".format(sessions))
+    for name, session_class in (("legacy", LegacySession), ("slots", Session)):
+        per_session, elapsed = measure(session_class, sessions)
+        print("{:>6}: {:>7.1f} bytes per session, {:.2f}s to create".format(name, per_session, elapsed))
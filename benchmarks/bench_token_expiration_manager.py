@@ -0,0 +1,96 @@
+# Micro-benchmark for the TokenExpirationManager.
+# Compares the heap-backed manager against the previous implementation,
+# which scanned every expiration group on each touch and each purge.
+# Usage: python -m benchmarks.bench_token_expiration_manager [sessions]
+import sys
+from datetime import datetime, timedelta
+from time import perf_counter
+from random import choice
+from backend.token_expiration_manager import TokenExpirationManager
+
+# The previous implementation, kept here only for comparison
+class LegacyTokenExpirationManager:
+    def __init__(self, **kwargs):
+        self.expirations = {}
+        self.tokens = {}
+        self.token_expiration_time = {}
+        self.session_timeout = kwargs["session_timeout"]
+        self.expiration_proximity = kwargs["expiration_proximity"]
+
+    def add_token(self, token, tokenObj):
+        self.tokens[token] = tokenObj
+        self.token_expiration_time[token] = datetime.utcnow() + self.session_timeout
+        self.update_expiration_time(token)
+
+    def update_expiration_time(self, token):
+        current_expiration = self.token_expiration_time[token]
+        if self.expirations.get(current_expiration):
+            self.expirations[current_expiration].remove(token)
+        new_expiration = datetime.utcnow() + self.session_timeout
+        for expiration_time in self.expirations:
+            difference = (new_expiration - expiration_time).total_seconds()
+            if difference < self.expiration_proximity.total_seconds():
+                self.expirations[expiration_time].add(token)
+                self.token_expiration_time[token] = expiration_time
+                break
+        else:
+            self.expirations[new_expiration] = {token}
+            self.token_expiration_time[token] = new_expiration
+
+    def get_token_object(self, token):
+        tokenObj = self.tokens.get(token)
+        if tokenObj is None:
+            return None
+        self.update_expiration_time(token)
+        return tokenObj
+
+    def purge_expired_tokens(self):
+        removed_sets = []
+        for group_expiration_time in self.expirations:
+            utcnow = datetime.utcnow()
+            if utcnow >= group_expiration_time:
+                removed_sets.append(group_expiration_time)
+                for token in set(self.expirations[group_expiration_time]):
+                    del self.token_expiration_time[token]
+                    del self.tokens[token]
+        for removed_set in removed_sets:
+            del self.expirations[removed_set]
+
+def populate(manager, sessions, groups):
+    # Spread the sessions over <groups> expiration groups, the same way
+    # a long-running server accumulates them over one session_timeout.
+    # The newest group is close enough for the touched tokens to join it.
+    per_group = sessions // groups
+    newest = datetime.utcnow() + manager.session_timeout
+    for g in range(groups):
+        group_time = newest - (groups - 1 - g) * manager.expiration_proximity
+        tokens = {"token_{}_{}".format(g, i) for i in range(per_group)}
+        manager.expirations[group_time] = tokens
+        if hasattr(manager, "store"):
+            manager.store.expiration_heap.append(group_time)
+            manager.store.latest_group = group_time
+        for token in tokens:
+            manager.tokens[token] = token
+            manager.token_expiration_time[token] = group_time
+    return list(manager.tokens)
+
+def run(manager_class, sessions, groups, requests=5000):
+    # A smaller expiration_proximity means more groups for the same session_timeout
+    timeout = timedelta(hours=2)
+    manager = manager_class(session_timeout=timeout, expiration_proximity=timeout / groups)
+    tokens = populate(manager, sessions, groups)
+    start = perf_counter()
+    for r in range(requests):
+        # One request: a session lookup and a purge, like the before_app_request hooks
+        manager.get_token_object(choice(tokens))
+        manager.purge_expired_tokens()
+    elapsed = perf_counter() - start
+    return elapsed / requests * 1e6
+
+if __name__ == "__main__":
+    sessions = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    print("{} live sessions, microseconds per request (touch + purge)".format(sessions))
+    for groups in (12, 120, 1200):
+        legacy = run(LegacyTokenExpirationManager, sessions, groups)
+        current = run(TokenExpirationManager, sessions, groups)
+        print("groups={:>6}  legacy={:>10.2f}  heap={:>8.2f}".format(groups, legacy, current))
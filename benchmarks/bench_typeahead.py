@@ -0,0 +1,97 @@
+# Benchmark for search-as-you-type on 1M usernames (backend/prefix_index.py).
+# Measures the prefix lookup itself, and the whole /typeahead/users request through
+# the test client, for prefixes of 1 to 5 characters like the keystrokes of a user typing,
+# and compares with the LIKE 'x%' query it replaces.
+# The names are generated in memory, the LIKE query runs on the same names in SQLite.
+# Also times loading the index from the database the first time, which the callers wait for,
+# and loading it again in the background, with the lookups served from the old index meanwhile.
+# Usage: python -m benchmarks.bench_typeahead [names]
+import os
+import sys
+import tempfile
+import tracemalloc
+from random import Random
+from string import ascii_lowercase, digits
+from time import perf_counter, monotonic
+from main import create_app
+from backend.models import db, User
+from backend.prefix_index import username_index
+
+LOOKUPS = 10000
+LIKE_LOOKUPS = 100
+
+def generate_names(random, count):
+    names = set()
+    while len(names) < count:
+        name = "".join(random.choice(ascii_lowercase) for i in range(random.randint(4, 10)))
+        if random.random() < 0.3:
+            name = name.capitalize()
+        if random.random() < 0.3:
+            name += "".join(random.choice(digits) for i in range(random.randint(1, 4)))
+        names.add(name)
+    return sorted(names)
+
+def percentiles(timings):
+    timings = sorted(timings)
+    return [timings[min(len(timings) - 1, int(len(timings) * fraction))] * 1000 for fraction in (0.5, 0.99)]
+
+def measure(name, prefixes, lookup):
+    timings = []
+    for prefix in prefixes:
+        start = perf_counter()
+        lookup(prefix)
+        timings.append(perf_counter() - start)
+    median, p99 = percentiles(timings)
+    print("  {:24s} median {:8.4f} ms, p99 {:8.4f} ms".format(name, median, p99))
+
+def main(count):
+    random = Random(1234)
+    names = generate_names(random, count)
+    prefixes = []
+    for i in range(LOOKUPS):
+        name = random.choice(names)
+        prefixes.append(name[:random.randint(1, 5)])
+
+    tracemalloc.start()
+    start = perf_counter()
+    username_index.set_names(names)
+    elapsed = perf_counter() - start
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print("{} names, built in {:.2f} s, {:.0f} MB".format(len(username_index), elapsed, size / 1e6))
+    measure("complete()", prefixes, username_index.complete)
+
+    app = create_app(os.path.join(tempfile.mkdtemp(), "bench.db"))
+    client = app.test_client()
+    measure("GET /typeahead/users", prefixes, lambda prefix: client.get("/typeahead/users", query_string={"prefix": prefix}))
+
+    with app.app_context():
+        db.create_all()
+        db.session.execute(User.__table__.insert(), [{"username": name, "password": "hash", "salt": "salt"} for name in names])
+        db.session.commit()
+        def like(prefix):
+            query = User.query.with_entities(User.username).filter(User.username.ilike(prefix + "%")).order_by(User.username).limit(10)
+            return query.all()
+        measure("LIKE 'x%' query", prefixes[:LIKE_LOOKUPS], like)
+
+        username_index.invalidate()
+        start = perf_counter()
+        username_index.ensure_loaded()
+        print("  {:24s} {:8.2f} s".format("first load", perf_counter() - start))
+        # Out of date: the next lookup starts the reload, and the ones after it don't wait for it
+        username_index.loaded = monotonic() - username_index.max_age
+        start = perf_counter()
+        username_index.complete(prefixes[0])
+        reloader = username_index.reloader
+        timings = []
+        while reloader is not None and reloader.is_alive():
+            lookup_start = perf_counter()
+            username_index.complete(random.choice(prefixes))
+            timings.append(perf_counter() - lookup_start)
+        reload_time = perf_counter() - start
+        median, p99 = percentiles(timings) if timings else (0.0, 0.0)
+        print("  {:24s} {:8.2f} s, {} lookups meanwhile: median {:8.4f} ms, p99 {:8.4f} ms".format(
+            "background reload", reload_time, len(timings), median, p99))
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000)
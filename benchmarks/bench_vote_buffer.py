@@ -0,0 +1,60 @@
+# Throughput benchmark for voting on a few hot posts.
+# Compares committing every vote on its own (post_functions.vote) with the
+# write-behind VoteBuffer (post_functions.queue_vote), against a target of 10k votes/sec.
+# Usage: python -m benchmarks.bench_vote_buffer [votes]
+import os
+import sys
+import tempfile
+from random import Random
+from time import perf_counter
+from main import create_app
+from backend.models import db, User, Community, Post
+from backend.database import post_functions
+from backend.vote_buffer import vote_buffer
+
+HOT_POSTS = 5
+TARGET = 10000 # votes per second
+
+def populate(users):
+    db.session.execute(User.__table__.insert(), [{"id": i, "username": "user_{}".format(i), "password": "hash", "salt": "salt"} for i in range(1, users + 1)])
+    community = Community(name="hot", description="Where the viral posts are")
+    db.session.add(community)
+    db.session.commit()
+    posts = [Post(user_id=1, community_id=community.id, title="Viral post {}".format(i), body="body") for i in range(HOT_POSTS)]
+    db.session.add_all(posts)
+    db.session.commit()
+    return [post.id for post in posts]
+
+def generate_votes(count, users, post_ids):
+    random = Random(1234)
+    return [(random.randint(1, users), random.choice(post_ids), random.random() < 0.8) for i in range(count)]
+
+def reset():
+    db.session.execute("DELETE FROM post_vote")
+    db.session.execute("UPDATE post SET karma = 0")
+    db.session.commit()
+
+def run(vote_function, votes):
+    start = perf_counter()
+    for user_id, post_id, vote_type in votes:
+        vote_function(user_id, post_id, vote_type)
+    vote_buffer.flush()
+    return len(votes) / (perf_counter() - start)
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    users = count // 2
+    path = os.path.join(tempfile.mkdtemp(), "bench.db")
+    app = create_app(path)
+    app.app_context().push()
+    db.create_all()
+    post_ids = populate(users)
+    votes = generate_votes(count, users, post_ids)
+    print("{} votes from {} users on {} hot posts".format(count, users, HOT_POSTS))
+    for name, vote_function in (("commit per vote", post_functions.vote), ("vote buffer", post_functions.queue_vote)):
+        reset()
+        throughput = run(vote_function, votes)
+        karma = sum(post.karma for post in Post.query.all())
+        print("{:>16}: {:>9.0f} votes/sec ({}) total karma {}".format(name, throughput,
+                "meets 10k/sec" if throughput >= TARGET else "below 10k/sec", karma))
+    os.remove(path)
@@ -1,24 +1,54 @@
 from flask import Flask
-from backend.blueprints import index, authentication, community, session_manager
+from backend.blueprints import index, authentication, community, session_manager, typeahead
 from backend.models import db
+from backend.token_stores import SQLiteTokenStore
+from backend.vote_buffer import vote_buffer
+from backend.page_cache import page_cache
+from backend.rate_limiter import rate_limiter
+from backend.database.user_functions import recompute_karma
+from backend.database import post_functions
+from backend.database.query_audit import audit
+from backend.database.search_functions import rebuild_index
+from backend.database.user_functions import hash_config
+from backend.password_hasher import password_hasher, calibrate, measure_verify
 from random import choice
 from string import ascii_letters, digits
 import sys
 
-def create_app(dbname=None):
+def create_app(dbname=None, session_store=None, rate_limit_store=None):
     if not dbname:
         dbname = "development.db"
     app = Flask(__name__)
+    if session_store:
+        # Keep the sessions in a shared SQLite file instead of process memory,
+        # so that they are visible to every worker process, e.g:
+        # gunicorn -w 4 "main:create_app(session_store='sessions.db')"
+        session_manager.session_manager.use_store(SQLiteTokenStore(session_store))
+    if rate_limit_store:
+        # Count the login and registration attempts in a file shared by the worker processes,
+        # e.g. rate_limit_store="/dev/shm/rate_limits"
+        rate_limiter.use_file(rate_limit_store)
+    # Anonymous pages from memory, ahead of the blueprints' before_app_request hooks
+    page_cache.init_app(app)
+    # Attempts over the limits are turned away before the session lookup
+    rate_limiter.init_app(app)
     # Blue prints
     app.register_blueprint(session_manager.bp)
     app.register_blueprint(index.bp)
     app.register_blueprint(authentication.bp)
     app.register_blueprint(community.bp)
+    app.register_blueprint(typeahead.bp)
     # SQL stuff
     app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///{}".format(dbname) # Test database for now
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
     # Initialize database session
     db.init_app(app)
+    # Cached HTML of posts, {{ render_post(post) }} in the templates
+    app.add_template_global(post_functions.render_post, "render_post")
+    # Write buffered votes in the background
+    vote_buffer.start_flusher(app)
+    # Start the password hashing processes before the first login
+    password_hasher.start()
     # Fixed endpoint for /
     app.add_url_rule("/", endpoint="index")
     app.add_url_rule("/community", endpoint="community")
@@ -35,3 +65,38 @@ if __name__ == "__main__":
         app.app_context().push()
         db.drop_all()
         db.create_all(app=app)
+    elif len(sys.argv) == 2 and sys.argv[1] == "explain-queries":
+        # Check that the application's queries use indexes, see backend/database/query_audit.py
+        app = create_app()
+        app.app_context().push()
+        scanning = []
+        for name, plan, tables in audit():
+            print("{}{}".format(name, " -- FULL SCAN: " + ", ".join(tables) if tables else ""))
+            for line in plan:
+                print("    {}".format(line))
+            if tables:
+                scanning.append(name)
+        print("{} queries scan a full table{}".format(len(scanning), ": " + ", ".join(scanning) if scanning else ""))
+        sys.exit(1 if scanning else 0)
+    elif len(sys.argv) in (2, 3) and sys.argv[1] == "recompute-karma":
+        # Rebuild every user's karma from the votes.
+        # "recompute-karma check" only reports how many users have the wrong karma.
+        app = create_app()
+        app.app_context().push()
+        fix = sys.argv[2:] != ["check"]
+        checked, wrong = recompute_karma(fix=fix)
+        print("{} users checked, {} had the wrong karma{}".format(checked, wrong, ", fixed" if fix and wrong else ""))
+    elif len(sys.argv) == 2 and sys.argv[1] == "rebuild-search-index":
+        # Index every post, comment and community again, see backend/database/search_functions.py
+        app = create_app()
+        app.app_context().push()
+        db.create_all()
+        print("{} rows indexed".format(rebuild_index()))
+    elif len(sys.argv) in (2, 3) and sys.argv[1] == "calibrate-hashing":
+        # argon2 options for hash_config in backend/database/user_functions.py that take about
+        # the given number of milliseconds (250 by default) to verify a password on this machine
+        target = float(sys.argv[2]) / 1000 if len(sys.argv) == 3 else 0.25
+        print("Current options: {:.0f} ms".format(measure_verify(hash_config) * 1000))
+        config, seconds = calibrate(target, hash_config)
+        print("Calibrated options: {:.0f} ms".format(seconds * 1000))
+        print("hash_config = {}".format(config))
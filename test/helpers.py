@@ -1,5 +1,15 @@
 from backend.models import User, Community, Post, db
+from backend.models import memberships, bans, owners, admins, moderators
+from backend.identity_cache import identity_cache
+from backend.database.permission_functions import permission_cache
+from backend.hot_feed import hot_feed
+from backend.fragment_cache import fragment_cache
+from backend.page_cache import page_cache
+from backend.database.search_functions import search_index
+from backend.prefix_index import username_index, community_index
 from main import create_app
+from contextlib import contextmanager
+from sqlalchemy import event
 
 def setup_test_environment():
     app = create_app("test/database.db")
@@ -31,4 +41,37 @@ def cleanup(*models):
     # Used to clean out the database without having to drop all the tables
     for model in models:
         model.query.delete()
+    # Bulk deletes don't go through the functions that keep the search index in sync
+    db.session.execute(search_index.delete())
     db.session.commit()
+    # Cached data from the database is gone too
+    identity_cache.clear()
+    permission_cache.clear()
+    hot_feed.rankings.clear()
+    fragment_cache.fragments.clear()
+    page_cache.pages.clear()
+    username_index.invalidate()
+    community_index.invalidate()
+
+def cleanup_relationships():
+    # Empty all the user->community association tables,
+    # which cleanup() doesn't touch because they aren't models
+    for table in (memberships, bans, owners, admins, moderators):
+        db.session.execute(table.delete())
+    db.session.commit()
+    permission_cache.clear()
+
+@contextmanager
+def count_queries():
+    # Count the SQL statements executed inside the with block:
+    # with count_queries() as statements:
+    #     ...
+    # len(statements) is the number of statements, and the list holds their SQL
+    statements = []
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+    event.listen(db.engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, "before_cursor_execute", before_cursor_execute)
@@ -0,0 +1,68 @@
+import unittest
+from datetime import timedelta
+from time import sleep
+from backend.cache import LRUCache
+
+class TestLRUCache(unittest.TestCase):
+    def test_get_and_set(self):
+        cache = LRUCache(max_entries=10)
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.get("a", "default"), "default")
+        cache.set("a", 1)
+        self.assertEqual(cache.get("a"), 1)
+        cache.set("a", 2)
+        self.assertEqual(cache.get("a"), 2)
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.hits, 2)
+        self.assertEqual(cache.misses, 2)
+
+    def test_lru_eviction(self):
+        cache = LRUCache(max_entries=3)
+        for key in ("a", "b", "c"):
+            cache.set(key, key)
+        # Use "a" so that "b" becomes the least recently used
+        cache.get("a")
+        cache.set("d", "d")
+        self.assertEqual(len(cache), 3)
+        self.assertIsNone(cache.get("b"))
+        for key in ("a", "c", "d"):
+            self.assertEqual(cache.get(key), key)
+
+    def test_ttl(self):
+        cache = LRUCache(max_entries=10, ttl=timedelta(seconds=0.5))
+        cache.set("a", 1)
+        self.assertEqual(cache.get("a"), 1)
+        print("\nSleeping 0.6 seconds")
+        sleep(0.6)
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(len(cache), 0)
+
+    def test_invalidate_and_clear(self):
+        cache = LRUCache(max_entries=10)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.invalidate("a")
+        cache.invalidate("doesn't exist")
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.get("b"), 2)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+    def test_byte_limit(self):
+        cache = LRUCache(max_entries=10, max_bytes=10, sizeof=len)
+        cache.set("a", "aaaa")
+        cache.set("b", "bbbb")
+        self.assertEqual(cache.size, 8)
+        # Over the limit, "a" is the least recently used
+        cache.set("c", "cccc")
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.size, 8)
+        # Replacing a value counts only the new one
+        cache.set("b", "bb")
+        self.assertEqual(cache.size, 6)
+        cache.invalidate("c")
+        self.assertEqual(cache.size, 2)
+        # Too big to be kept at all
+        cache.set("d", "d" * 11)
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.size, 0)
@@ -1,8 +1,8 @@
 import unittest
 from backend.database import comment_functions
-from backend.models import User, Community, Post, Comment, db
+from backend.models import User, Community, Post, Comment, CommentVote, db
 from test.helpers import setup_test_environment, cleanup
-from test.helpers import create_test_user, create_test_community, create_test_post
+from test.helpers import create_test_user, create_test_community, create_test_post, count_queries
 from sqlalchemy import exc
 from sqlalchemy.orm import exc as orm_exc
 
@@ -78,3 +78,147 @@ class TestUserFunctions(unittest.TestCase):
         self.assertRaises(orm_exc.UnmappedInstanceError, comment_functions.delete_comment, None)
         self.assertRaises(orm_exc.UnmappedInstanceError, comment_functions.delete_comment, -1)
         self.assertRaises(exc.InterfaceError, comment_functions.delete_comment, [])
+
+    #### upvote(), downvote() and unvote() ####
+    def test_vote(self):
+        user = create_test_user()
+        community = create_test_community()
+        post = create_test_post(community, user)
+        comment = Comment(user_id=user.id, post_id=post.id, text="Vote on me")
+        db.session.add(comment)
+        db.session.commit()
+        user_id, comment_id = user.id, comment.id
+        comment_functions.upvote(user_id, comment_id)
+        self.assertEqual(comment.karma, 1)
+        # Upvoting twice doesn't count twice
+        comment_functions.upvote(user_id, comment_id)
+        self.assertEqual(comment.karma, 1)
+        comment_functions.downvote(user_id, comment_id)
+        self.assertEqual(comment.karma, -1)
+        vote_obj = CommentVote.query.filter(CommentVote.user_id == user_id, CommentVote.comment_id == comment_id).first()
+        self.assertFalse(vote_obj.vote_type)
+        self.assertEqual(len(comment.votes), 1)
+        self.assertEqual(user.karma, -1)
+        comment_functions.unvote(user_id, comment_id)
+        self.assertEqual(comment.karma, 0)
+        self.assertEqual(user.karma, 0)
+        self.assertEqual(len(comment.votes), 0)
+        # Voting on comments that don't exist
+        self.assertRaises(ValueError, comment_functions.upvote, user_id, -1)
+        self.assertRaises(ValueError, comment_functions.downvote, -1, comment_id)
+        cleanup(CommentVote, Comment, Post, Community, User)
+
+    #### get_comment_tree(post_id, parent_id, max_depth, limit) ####
+    def test_comment_tree(self):
+        user = create_test_user()
+        community = create_test_community()
+        post = create_test_post(community, user)
+        user_id, post_id = user.id, post.id
+        def reply(text, parent_id=None):
+            comment_functions.create_comment(user_id, post_id, text, parent_id)
+            return Comment.query.filter(Comment.text == text).first().id
+        first = reply("first")
+        second = reply("second")
+        first_reply = reply("first reply", first)
+        nested_reply = reply("nested reply", first_reply)
+        second_reply = reply("second reply", first)
+        pinned = reply("pinned")
+        # Pinned first, then by karma, then oldest first
+        Comment.query.filter(Comment.id == pinned).update({"is_pinned": True})
+        Comment.query.filter(Comment.id == second_reply).update({"karma": 5})
+        db.session.commit()
+        with count_queries() as statements:
+            tree = comment_functions.get_comment_tree(post_id)
+            flat = comment_functions.flatten_tree(tree)
+            texts = [(node.depth, node.comment.text, node.username) for node in flat]
+        self.assertEqual(len(statements), 1)
+        self.assertEqual(texts, [(0, "pinned", "shit"), (0, "first", "shit"), (1, "second reply", "shit"),
+            (1, "first reply", "shit"), (2, "nested reply", "shit"), (0, "second", "shit")])
+        # Slices of the thread
+        flat = comment_functions.flatten_tree(comment_functions.get_comment_tree(post_id, max_depth=1))
+        self.assertEqual([node.comment.id for node in flat], [pinned, first, second])
+        flat = comment_functions.flatten_tree(comment_functions.get_comment_tree(post_id, parent_id=first))
+        self.assertEqual([node.comment.id for node in flat], [second_reply, first_reply, nested_reply])
+        flat = comment_functions.flatten_tree(comment_functions.get_comment_tree(post_id, parent_id=first, max_depth=1))
+        self.assertEqual([node.comment.id for node in flat], [second_reply, first_reply])
+        flat = comment_functions.flatten_tree(comment_functions.get_comment_tree(post_id, limit=3))
+        self.assertEqual(sorted(node.comment.id for node in flat), [first, first_reply, nested_reply])
+        # A reply has to be in the same post as its parent
+        self.assertRaises(ValueError, comment_functions.create_comment, user_id, post_id, "reply", -1)
+        cleanup(Comment, Post, Community, User)
+
+    #### get_thread_page(post_id, token, max_depth, limit) ####
+    def test_thread_pages(self):
+        # Following the continuation tokens reaches every comment exactly once
+        user = create_test_user()
+        community = create_test_community()
+        post = create_test_post(community, user)
+        user_id, post_id = user.id, post.id
+        ids = []
+        def reply(parent_index=None):
+            text = "comment {}".format(len(ids))
+            parent_id = ids[parent_index] if parent_index is not None else None
+            comment_functions.create_comment(user_id, post_id, text, parent_id)
+            ids.append(Comment.query.filter(Comment.text == text).first().id)
+        # 0 -> 1 -> 2 -> 3, 0 -> 4, 5, 6 -> 7
+        for parent_index in (None, 0, 1, 2, 0, None, None, 6):
+            reply(parent_index)
+        self.assertEqual([row.id for row in comment_functions.iter_thread(post_id, chunk_size=3)], ids)
+        roots, token = comment_functions.get_thread_page(post_id, max_depth=2, limit=3)
+        flat = comment_functions.flatten_tree(roots)
+        self.assertEqual([node.comment.id for node in flat], [ids[0], ids[1], ids[4]])
+        # Comment 1 is on the last level and has a reply
+        self.assertEqual([node.more_replies is not None for node in flat], [False, True, False])
+        self.assertIsNotNone(token)
+        seen = [node.comment.id for node in flat]
+        tokens = [flat[1].more_replies, token]
+        while tokens:
+            roots, next_token = comment_functions.get_thread_page(post_id, tokens.pop(), max_depth=2, limit=3)
+            for node in comment_functions.flatten_tree(roots):
+                seen.append(node.comment.id)
+                if node.more_replies:
+                    tokens.append(node.more_replies)
+            if next_token:
+                tokens.append(next_token)
+        self.assertEqual(sorted(seen), sorted(ids))
+        # Tokens only work for their own post
+        self.assertRaises(ValueError, comment_functions.get_thread_page, post_id + 1, token)
+        self.assertRaises(ValueError, comment_functions.get_thread_page, post_id, "garbage")
+        cleanup(Comment, Post, Community, User)
+
+    def test_thread_pages_order(self):
+        # In a thread longer than a page, the pinned and highest rated comments are on the first page
+        user = create_test_user()
+        community = create_test_community()
+        post = create_test_post(community, user)
+        user_id, post_id = user.id, post.id
+        for i in range(20):
+            comment_functions.create_comment(user_id, post_id, "c{}".format(i))
+        ids = {comment.text: comment.id for comment in Comment.query.filter(Comment.post_id == post_id)}
+        for i in range(3):
+            comment_functions.create_comment(user_id, post_id, "c10 reply {}".format(i), ids["c10"])
+        Comment.query.filter(Comment.id == ids["c19"]).update({"is_pinned": True, "karma": 1000})
+        Comment.query.filter(Comment.id == ids["c10"]).update({"karma": 50})
+        Comment.query.filter(Comment.id == ids["c15"]).update({"karma": 7})
+        db.session.commit()
+        with count_queries() as statements:
+            roots, token = comment_functions.get_thread_page(post_id, max_depth=10, limit=5)
+        texts = [node.comment.text for node in comment_functions.flatten_tree(roots)]
+        self.assertEqual(texts, ["c19", "c10", "c10 reply 0", "c10 reply 1", "c10 reply 2"])
+        # The top level comments, and the replies of the one that has some
+        self.assertEqual(len(statements), 2)
+        # The next pages go on in the same order, each comment once
+        while token:
+            roots, token = comment_functions.get_thread_page(post_id, token, max_depth=10, limit=5)
+            texts.extend(node.comment.text for node in comment_functions.flatten_tree(roots))
+        self.assertEqual(texts[:7], ["c19", "c10", "c10 reply 0", "c10 reply 1", "c10 reply 2", "c15", "c0"])
+        self.assertEqual(len(texts), 23)
+        self.assertEqual(len(set(texts)), 23)
+        # A page can end in the middle of a comment's replies
+        roots, token = comment_functions.get_thread_page(post_id, max_depth=10, limit=3)
+        self.assertEqual([node.comment.text for node in comment_functions.flatten_tree(roots)], ["c19", "c10", "c10 reply 0"])
+        roots, token = comment_functions.get_thread_page(post_id, token, max_depth=10, limit=3)
+        flat = comment_functions.flatten_tree(roots)
+        self.assertEqual([node.comment.text for node in flat], ["c10 reply 1", "c10 reply 2", "c15"])
+        self.assertEqual(flat[0].comment.parent_id, ids["c10"])
+        cleanup(Comment, Post, Community, User)
@@ -0,0 +1,52 @@
+# Test the community pages that change data, with a logged in user
+import unittest
+from flask import current_app
+from backend.models import User, Community, Post, db
+from backend.database import community_functions, permission_functions, user_functions
+from backend.blueprints.session_manager import Session, session_manager, encode_session_id
+from test.helpers import setup_test_environment, cleanup, cleanup_relationships, create_test_user, create_test_community
+
+class TestCommunityViews(unittest.TestCase):
+    setup_test_environment()
+
+    def setUp(self):
+        self.user_id = create_test_user().id
+        self.community_id = create_test_community().id
+        self.client = current_app.test_client()
+        current_app.config["WTF_CSRF_ENABLED"] = False
+        session_obj = Session(self.user_id)
+        session_manager.add_token(session_obj.session_id, session_obj)
+        with self.client.session_transaction() as session:
+            session["session_id"] = encode_session_id(session_obj.session_id)
+
+    def tearDown(self):
+        current_app.config["WTF_CSRF_ENABLED"] = True
+        db.session.rollback()
+        cleanup_relationships()
+        cleanup(Post, Community, User)
+
+    def create_post(self):
+        return self.client.post("/community/post", data={"community_id": self.community_id, "title": "Title", "text": "Text"})
+
+    def test_join(self):
+        # Load the identity and permissions into their caches first
+        self.client.get("/")
+        self.assertFalse(permission_functions.is_member(self.user_id, self.community_id))
+        response = self.client.post("/community/join", data={"name": "TestCommunity"})
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(permission_functions.is_member(self.user_id, self.community_id))
+        self.assertEqual([community.id for community in user_functions.get_user_snapshot(self.user_id).communities], [self.community_id])
+
+    def test_post(self):
+        # Only members can post
+        self.assertEqual(self.create_post().status_code, 302)
+        self.assertEqual(Post.query.count(), 0)
+        community_functions.join(self.user_id, self.community_id)
+        response = self.create_post()
+        post = Post.query.one()
+        self.assertTrue(response.headers["Location"].endswith("/community/viewpost/{}".format(post.id)))
+        self.assertEqual((post.user_id, post.title, post.body), (self.user_id, "Title", "Text"))
+        # Banned members can't
+        community_functions.ban_user(self.user_id, self.community_id)
+        self.create_post()
+        self.assertEqual(Post.query.count(), 1)
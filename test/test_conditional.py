@@ -0,0 +1,96 @@
+import unittest
+from flask import current_app
+from backend.models import User, Community, Post, Comment, db
+from backend.database import post_functions, comment_functions
+from backend.blueprints.session_manager import Session, session_manager, encode_session_id
+from backend.content_versions import ContentVersions
+from test.helpers import setup_test_environment, cleanup, create_test_user, create_test_community, create_test_post, count_queries
+
+class TestConditionalGet(unittest.TestCase):
+    setup_test_environment()
+
+    def setUp(self):
+        user = create_test_user()
+        community = create_test_community()
+        self.user_id, self.community_id = user.id, community.id
+        self.post_id = create_test_post(community, user).id
+        self.client = current_app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+        cleanup(Comment, Post, Community, User)
+
+    def log_in(self):
+        session_obj = Session(self.user_id)
+        session_manager.add_token(session_obj.session_id, session_obj)
+        with self.client.session_transaction() as session:
+            session["session_id"] = encode_session_id(session_obj.session_id)
+
+    def get(self, url, etag=None):
+        headers = {"If-None-Match": '"{}"'.format(etag)} if etag else {}
+        return self.client.get(url, headers=headers)
+
+    def assert_not_modified(self, url, etag):
+        # 304, without a single query
+        with count_queries() as statements:
+            response = self.get(url, etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.get_etag()[0], etag)
+        self.assertEqual(statements, [])
+
+    def test_versions(self):
+        versions = ContentVersions()
+        version = versions.get(("post", 1))
+        self.assertEqual(versions.get(("post", 1)), version)
+        versions.bump_posts([1])
+        self.assertNotEqual(versions.get(("post", 1)), version)
+        # Another process never has the same versions
+        self.assertNotEqual(ContentVersions().get(("post", 1)), versions.get(("post", 1)))
+
+    def test_community_page(self):
+        url = "/community/TestCommunity"
+        response = self.get(url)
+        self.assertEqual(response.status_code, 200)
+        etag = response.get_etag()[0]
+        self.assert_not_modified(url, etag)
+        # A new post changes the page
+        post_functions.create_post(self.user_id, self.community_id, "New post", "Body")
+        response = self.get(url, etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b"New post", response.data)
+        self.assertNotEqual(response.get_etag()[0], etag)
+        etag = response.get_etag()[0]
+        # And so does a vote
+        post_functions.upvote(self.user_id, self.post_id)
+        self.assertEqual(self.get(url, etag).status_code, 200)
+
+    def test_viewpost(self):
+        url = "/community/viewpost/{}".format(self.post_id)
+        etag = self.get(url).get_etag()[0]
+        self.assert_not_modified(url, etag)
+        comment_functions.create_comment(self.user_id, self.post_id, "A comment")
+        response = self.get(url, etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b"A comment", response.data)
+        # Editing another post doesn't change this one's page
+        etag = response.get_etag()[0]
+        other_post_id = create_test_post(Community.query.get(self.community_id), User.query.get(self.user_id)).id
+        post_functions.edit_post(other_post_id, "Edited", "Edited")
+        self.assert_not_modified(url, etag)
+
+    def test_logged_in(self):
+        # Logged in users and anonymous visitors have different validators
+        url = "/community/viewpost/{}".format(self.post_id)
+        anonymous_response = self.get(url)
+        self.assertNotIn("private", anonymous_response.headers["Cache-Control"])
+        anonymous_etag = anonymous_response.get_etag()[0]
+        self.log_in()
+        response = self.get(url, anonymous_etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("private", response.headers["Cache-Control"])
+        etag = response.get_etag()[0]
+        self.assertNotEqual(etag, anonymous_etag)
+        self.assert_not_modified(url, etag)
+        # The front page too
+        etag = self.get("/").get_etag()[0]
+        self.assert_not_modified("/", etag)
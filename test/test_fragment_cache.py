@@ -0,0 +1,78 @@
+import unittest
+from flask import current_app
+from backend.models import User, Community, Post, PostVote, db
+from backend.database import post_functions
+from backend.fragment_cache import FragmentCache, fragment_cache
+from backend.vote_buffer import vote_buffer
+from test.helpers import setup_test_environment, cleanup, create_test_user, create_test_community, create_test_post, count_queries
+
+class TestFragmentCache(unittest.TestCase):
+    setup_test_environment()
+
+    def setUp(self):
+        user = create_test_user()
+        community = create_test_community()
+        self.user_id = user.id
+        self.post_id = create_test_post(community, user).id
+
+    def tearDown(self):
+        db.session.rollback()
+        cleanup(PostVote, Post, Community, User)
+
+    def render(self, cache=fragment_cache):
+        post = Post.query.filter(Post.id == self.post_id).first()
+        with current_app.test_request_context():
+            return str(cache.render_post(post))
+
+    def test_cached(self):
+        # The second render doesn't touch the template or the post's author
+        html = self.render()
+        self.assertIn("Post title!", html)
+        post = Post.query.filter(Post.id == self.post_id).first()
+        db.session.expire_all()
+        with count_queries() as statements:
+            with current_app.test_request_context():
+                self.assertEqual(str(fragment_cache.render_post(post)), html)
+        # Only the reload of the expired post
+        self.assertEqual(len(statements), 1)
+
+    def test_changes(self):
+        # Edits and votes show up right away
+        self.render()
+        post_functions.edit_post(self.post_id, "New title", "New body")
+        self.assertIn("New title", self.render())
+        version = Post.query.filter(Post.id == self.post_id).first().version
+        post_functions.upvote(self.user_id, self.post_id)
+        # The karma is filled in outside the fragment: votes keep the version and the cached fragment
+        db.session.expire_all()
+        self.assertEqual(Post.query.filter(Post.id == self.post_id).first().version, version)
+        self.assertIsNotNone(fragment_cache.get(self.post_id, version))
+        self.assertIn("1 points", self.render())
+        # A change made by another process, which couldn't invalidate this process' cache,
+        # still shows up because the version changed
+        db.session.execute(Post.__table__.update().where(Post.id == self.post_id).values(title="Elsewhere", version=Post.version + 1))
+        db.session.commit()
+        self.assertIn("Elsewhere", self.render())
+        post_functions.unvote(self.user_id, self.post_id)
+        post_functions.delete_post(self.post_id)
+        self.assertIsNone(fragment_cache.fragments.get(self.post_id))
+
+    def test_buffered_votes(self):
+        # The karma of the listings includes the votes that haven't been flushed,
+        # without rendering the post again
+        post = Post.query.filter(Post.id == self.post_id).first()
+        with current_app.test_request_context():
+            self.assertIn("0 points", str(post_functions.render_post(post)))
+            post_functions.queue_vote(self.user_id, self.post_id, True)
+            with count_queries() as statements:
+                self.assertIn("1 points", str(post_functions.render_post(post)))
+            self.assertEqual(statements, [])
+        vote_buffer.flush()
+
+    def test_byte_limit(self):
+        cache = FragmentCache(max_bytes=1)
+        self.render(cache)
+        self.assertEqual(len(cache.fragments), 0)
+        cache = FragmentCache()
+        html = self.render(cache)
+        self.assertGreaterEqual(cache.fragments.size, len(html))
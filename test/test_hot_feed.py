@@ -0,0 +1,112 @@
+import unittest
+from datetime import datetime, timedelta
+from backend.models import User, Community, Post, PostVote, db, hot_score, HOT_SCORE_PERIOD
+from backend.database import post_functions
+from backend.hot_feed import HotFeed, hot_feed
+from test.helpers import setup_test_environment, cleanup, create_test_user, count_queries
+
+def create_communities(count):
+    communities = [Community(name="Hot community {}".format(i), description="description") for i in range(count)]
+    db.session.add_all(communities)
+    db.session.commit()
+    return [community.id for community in communities]
+
+def create_posts(user_id, community_id, count, start):
+    # <count> posts, one hour apart, the newest first
+    posts = [Post(user_id=user_id, community_id=community_id, title="Post", body="Body",
+        post_time=start - timedelta(hours=i)) for i in range(count)]
+    db.session.add_all(posts)
+    db.session.commit()
+    return [post.id for post in posts]
+
+def expected_feed(community_ids, count):
+    # The feed the slow way, sorting every post
+    posts = Post.query.filter(Post.community_id.in_(community_ids)).all()
+    posts.sort(key=lambda post: (-post.hot_score, -post.id))
+    return [post.id for post in posts[:count]]
+
+class TestHotFeed(unittest.TestCase):
+    setup_test_environment()
+
+    def setUp(self):
+        self.user_id = create_test_user().id
+        self.start = datetime(2024, 6, 1)
+
+    def tearDown(self):
+        db.session.rollback()
+        cleanup(PostVote, Post, Community, User)
+
+    def test_hot_score(self):
+        # Newer is hotter, and 10 times the karma is worth HOT_SCORE_PERIOD seconds
+        self.assertGreater(hot_score(0, self.start), hot_score(0, self.start - timedelta(hours=1)))
+        self.assertAlmostEqual(hot_score(10, self.start), hot_score(1, self.start + timedelta(seconds=HOT_SCORE_PERIOD)))
+        self.assertLess(hot_score(-5, self.start), hot_score(0, self.start))
+        # Same score from SQLite's representation of the time
+        self.assertEqual(hot_score(3, "2024-06-01 00:00:00.000000"), hot_score(3, self.start))
+
+    def test_vote_updates_score(self):
+        # The vote UPDATE recomputes the stored score, the same way as in Python
+        community_id = create_communities(1)[0]
+        post_id = create_posts(self.user_id, community_id, 1, self.start)[0]
+        post = Post.query.filter(Post.id == post_id).first()
+        self.assertEqual(post.hot_score, hot_score(0, self.start))
+        post_functions.upvote(self.user_id, post_id)
+        self.assertEqual(post.karma, 1)
+        self.assertEqual(post.hot_score, hot_score(1, self.start))
+
+    def test_feed(self):
+        # The merged feed is the same as sorting all the posts, and costs one query to load
+        community_ids = create_communities(3)
+        for i, community_id in enumerate(community_ids):
+            create_posts(self.user_id, community_id, 4, self.start - timedelta(minutes=20 * i))
+        with count_queries() as statements:
+            feed = hot_feed.get_feed(community_ids, 5)
+        self.assertEqual(len(statements), 1)
+        self.assertEqual(feed, expected_feed(community_ids, 5))
+        self.assertEqual(hot_feed.get_feed(community_ids, 100), expected_feed(community_ids, 100))
+        # Only loaded once
+        with count_queries() as statements:
+            hot_feed.get_feed(community_ids, 5)
+        self.assertEqual(len(statements), 0)
+
+    def test_feed_updates(self):
+        # Votes, new posts and deletions show up without reloading the rankings
+        community_ids = create_communities(2)
+        old_post_id = create_posts(self.user_id, community_ids[0], 3, self.start)[-1]
+        create_posts(self.user_id, community_ids[1], 3, self.start)
+        self.assertNotIn(old_post_id, hot_feed.get_feed(community_ids, 2))
+        # 100 upvotes are worth more than two hours
+        voters = [User(username="voter {}".format(i), password="hash", salt="salt") for i in range(100)]
+        db.session.add_all(voters)
+        db.session.commit()
+        for voter in voters:
+            post_functions.upvote(voter.id, old_post_id)
+        with count_queries() as statements:
+            feed = hot_feed.get_feed(community_ids, 2)
+        self.assertEqual(len(statements), 0)
+        self.assertEqual(feed[0], old_post_id)
+        self.assertEqual(hot_feed.get_feed(community_ids, 6), expected_feed(community_ids, 6))
+        post_functions.create_post(self.user_id, community_ids[1], "Title", "Body")
+        new_post = Post.query.filter(Post.title == "Title").first()
+        self.assertEqual(hot_feed.get_feed(community_ids, 7), expected_feed(community_ids, 7))
+        post_functions.delete_post(new_post.id)
+        self.assertNotIn(new_post.id, hot_feed.get_feed(community_ids, 7))
+
+    def test_limited_rankings(self):
+        # Only max_posts are kept per community, the feed can't go past
+        # where posts that aren't kept could come next
+        feed = HotFeed(max_posts=2)
+        community_ids = create_communities(2)
+        create_posts(self.user_id, community_ids[0], 5, self.start)
+        create_posts(self.user_id, community_ids[1], 5, self.start - timedelta(minutes=30))
+        expected = expected_feed(community_ids, 10)
+        self.assertEqual(feed.get_feed(community_ids, 3), expected[:3])
+        self.assertIsNone(feed.get_feed(community_ids, 4))
+        # Pages that start after a post
+        post = Post.query.filter(Post.id == expected[0]).first()
+        self.assertEqual(feed.get_feed(community_ids, 2, after=(post.hot_score, post.id)), expected[1:3])
+        self.assertIsNone(feed.get_feed(community_ids, 3, after=(post.hot_score, post.id)))
+        self.assertFalse(feed.rankings.get(community_ids[0]).complete)
+        # A post with no room left in the kept ones is left out
+        feed.update(community_ids[0], -1, 0)
+        self.assertEqual(len(feed.rankings.get(community_ids[0]).entries), 2)
@@ -0,0 +1,61 @@
+import unittest
+from flask import current_app
+from backend.models import User, Community, Post, db
+from backend.database import post_functions
+from backend.blueprints.session_manager import Session, session_manager, encode_session_id
+from backend.page_cache import page_cache
+from test.helpers import setup_test_environment, cleanup, create_test_user, create_test_community, create_test_post, count_queries
+
+class TestPageCache(unittest.TestCase):
+    setup_test_environment()
+
+    def setUp(self):
+        user = create_test_user()
+        community = create_test_community()
+        self.user_id, self.community_id = user.id, community.id
+        self.post_id = create_test_post(community, user).id
+        self.client = current_app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+        cleanup(Post, Community, User)
+
+    def test_anonymous(self):
+        # The second anonymous request doesn't touch the database
+        url = "/community/TestCommunity"
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        with count_queries() as statements:
+            cached_response = self.client.get(url)
+        self.assertEqual(statements, [])
+        self.assertEqual(cached_response.data, response.data)
+        self.assertEqual(cached_response.get_etag(), response.get_etag())
+        # Conditional GETs are answered from the cache too
+        with count_queries() as statements:
+            cached_response = self.client.get(url, headers={"If-None-Match": '"{}"'.format(response.get_etag()[0])})
+        self.assertEqual(cached_response.status_code, 304)
+        self.assertEqual(statements, [])
+        # Other query strings are other pages
+        self.assertEqual(self.client.get(url + "?cursor=invalid").status_code, 400)
+
+    def test_changes(self):
+        # A change to what the page shows is there on the next request
+        url = "/community/viewpost/{}".format(self.post_id)
+        self.client.get(url)
+        post_functions.edit_post(self.post_id, "New title", "New body")
+        response = self.client.get(url)
+        self.assertIn(b"New title", response.data)
+
+    def test_logged_in(self):
+        # Logged in users never get the anonymous page
+        url = "/community/TestCommunity"
+        self.client.get(url)
+        session_obj = Session(self.user_id)
+        session_manager.add_token(session_obj.session_id, session_obj)
+        with self.client.session_transaction() as session:
+            session["session_id"] = encode_session_id(session_obj.session_id)
+        hits = page_cache.pages.hits
+        response = self.client.get(url)
+        self.assertIn(b"Log out", response.data)
+        self.assertEqual(page_cache.pages.hits, hits)
+        self.assertEqual(len(page_cache.pages), 1)
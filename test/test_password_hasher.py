@@ -0,0 +1,113 @@
+# Test the password hashing pool, backend/password_hasher.py
+import unittest
+from flask import current_app
+from backend.models import User, db
+from backend.database import user_functions
+from backend.password_hasher import PasswordHasher, HasherBusy, password_hasher, get_hasher, calibrate
+from test.helpers import setup_test_environment, cleanup
+
+class TestPasswordHasher(unittest.TestCase):
+    setup_test_environment()
+    def test_hash_and_verify(self):
+        config = user_functions.hash_config
+        for hasher in (PasswordHasher(workers=0), PasswordHasher(workers=1)):
+            hashed = hasher.hash("password", config)
+            self.assertTrue(hasher.verify("password", hashed, config))
+            self.assertFalse(hasher.verify("wrong password", hashed, config))
+            # Exceptions from the hashing processes reach the caller
+            self.assertRaises(TypeError, hasher.hash, 1234, config)
+            stats = hasher.stats()
+            self.assertEqual(stats["hash"]["count"], 1)
+            self.assertEqual(stats["verify"]["count"], 2)
+            self.assertGreater(stats["verify"]["p50"], 0)
+            self.assertEqual(stats["pending"], 0)
+            hasher.shutdown()
+
+    def test_verify_and_update(self):
+        config = {"rounds": 1, "memory_cost": 1024}
+        self.assertIs(get_hasher(config), get_hasher(dict(config)))
+        hasher = PasswordHasher(workers=0)
+        hashed = hasher.hash("password", config)
+        self.assertEqual(hasher.verify_and_update("password", hashed, config), (True, None))
+        # New options: the hash is made again, only if the password is right
+        new_config = {"rounds": 2, "memory_cost": 1024}
+        self.assertEqual(hasher.verify_and_update("wrong password", hashed, new_config), (False, None))
+        verified, new_hash = hasher.verify_and_update("password", hashed, new_config)
+        self.assertTrue(verified)
+        self.assertIn("t=2", new_hash)
+        self.assertEqual(hasher.verify_and_update("password", new_hash, new_config), (True, None))
+
+    def test_rehash_on_login(self):
+        # verify_user() stores the hash again when hash_config changed since it was made
+        user_functions.register_user("someone", "password", "someone@example.com")
+        old_hash = User.query.filter(User.username == "someone").first().password
+        config = user_functions.hash_config
+        user_functions.hash_config = dict(config, rounds=config["rounds"] + 1)
+        try:
+            self.assertFalse(user_functions.verify_user("someone", "wrong password"))
+            self.assertEqual(User.query.filter(User.username == "someone").first().password, old_hash)
+            self.assertTrue(user_functions.verify_user("someone", "password"))
+            new_hash = User.query.filter(User.username == "someone").first().password
+            self.assertNotEqual(new_hash, old_hash)
+            self.assertIn("t={}".format(config["rounds"] + 1), new_hash)
+            self.assertTrue(user_functions.verify_user("someone", "password"))
+            self.assertEqual(User.query.filter(User.username == "someone").first().password, new_hash)
+        finally:
+            user_functions.hash_config = config
+            cleanup(User)
+
+    def test_calibrate(self):
+        config, seconds = calibrate(0.01, {"salt_size": 16, "memory_cost": 1024})
+        self.assertEqual(config["salt_size"], 16)
+        self.assertGreaterEqual(config["rounds"], 1)
+        self.assertLessEqual(config["memory_cost"], 1024)
+        self.assertGreater(seconds, 0)
+
+    def test_start(self):
+        # Started ahead of the first hash, without taking up the queue
+        hasher = PasswordHasher(workers=1, max_pending=1)
+        hasher.start(block=True)
+        executor = hasher.executor
+        self.assertEqual(hasher.pending, 0)
+        hasher.hash("password", user_functions.hash_config)
+        self.assertIs(hasher.executor, executor)
+        # In a process forked from the one that started it, a new pool is started
+        hasher.pid = -1
+        hasher.hash("password", user_functions.hash_config)
+        self.assertIsNot(hasher.executor, executor)
+        executor.shutdown()
+        hasher.shutdown()
+        PasswordHasher(workers=0).start(block=True)
+
+    def test_admission_control(self):
+        hasher = PasswordHasher(workers=1, max_pending=2)
+        # As if two hashes were already running or waiting
+        hasher.pending = 2
+        self.assertRaises(HasherBusy, hasher.hash, "password", user_functions.hash_config)
+        self.assertEqual(hasher.stats()["rejected"], 1)
+        hasher.pending = 1
+        hasher.hash("password", user_functions.hash_config)
+        self.assertEqual(hasher.pending, 1)
+        hasher.shutdown()
+
+    def test_login_when_busy(self):
+        # The login and registration pages ask to try again instead of waiting
+        client = current_app.test_client()
+        current_app.config["WTF_CSRF_ENABLED"] = False
+        pending = password_hasher.pending
+        password_hasher.pending = password_hasher.max_pending
+        try:
+            response = client.post("/register", data={"username": "someone", "password": "password",
+                "password_confirm": "password", "email": "someone@example.com"})
+            self.assertEqual(response.status_code, 503)
+            self.assertIn("Retry-After", response.headers)
+            self.assertIsNone(User.query.filter(User.username == "someone").first())
+            db.session.add(User(username="someone", password="hash", salt="salt"))
+            db.session.commit()
+            response = client.post("/login", data={"username": "someone", "password": "password"})
+            self.assertEqual(response.status_code, 503)
+            self.assertNotIn("Set-Cookie", response.headers)
+        finally:
+            password_hasher.pending = pending
+            current_app.config["WTF_CSRF_ENABLED"] = True
+            cleanup(User)
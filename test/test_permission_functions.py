@@ -0,0 +1,82 @@
+import unittest
+from backend.database import permission_functions, community_functions
+from backend.models import User, Community, db
+from test.helpers import setup_test_environment, cleanup, cleanup_relationships, count_queries
+
+class TestPermissionFunctions(unittest.TestCase):
+    setup_test_environment()
+
+    def setUp(self):
+        self.user = User(username="permission user", password="hash", salt="salt")
+        self.other_user = User(username="other permission user", password="hash", salt="salt")
+        self.community = Community(name="Permission community", description="description")
+        db.session.add_all((self.user, self.other_user, self.community))
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+        cleanup_relationships()
+        cleanup(Community, User)
+
+    def test_checks(self):
+        checks = (
+                (permission_functions.is_member, "users"),
+                (permission_functions.is_banned, "banned_users"),
+                (permission_functions.is_moderator, "moderators"),
+                (permission_functions.is_admin, "admins"),
+                (permission_functions.is_owner, "owners"),
+                )
+        user_id, community_id = self.user.id, self.community.id
+        for check, relationship in checks:
+            self.assertFalse(check(user_id, community_id))
+            # Changed behind community_functions' back, so invalidate it by hand
+            getattr(self.community, relationship).append(self.user)
+            db.session.commit()
+            permission_functions.invalidate_permissions(user_id, community_id)
+            self.assertTrue(check(user_id, community_id))
+            # Only for that user, and only in that community
+            self.assertFalse(check(self.other_user.id, community_id))
+            self.assertFalse(check(user_id, -1))
+
+    def test_non_existent_user(self):
+        self.assertFalse(permission_functions.is_member(None, self.community.id))
+        self.assertFalse(permission_functions.is_banned(-1, self.community.id))
+
+    def test_single_query(self):
+        # One query for all five permissions, without loading the community's members,
+        # and none once the bitmask is cached
+        self.community.users.append(self.other_user)
+        db.session.commit()
+        user_id, community_id = self.user.id, self.community.id
+        db.session.expire_all()
+        with count_queries() as statements:
+            self.assertFalse(permission_functions.is_member(user_id, community_id))
+            self.assertFalse(permission_functions.is_banned(user_id, community_id))
+            self.assertFalse(permission_functions.is_owner(user_id, community_id))
+        self.assertEqual(len(statements), 1)
+        self.assertIn("UNION ALL", statements[0])
+
+    def test_get_permissions(self):
+        self.community.users.append(self.user)
+        self.community.moderators.append(self.user)
+        db.session.commit()
+        user_id, community_id = self.user.id, self.community.id
+        permissions = permission_functions.get_permissions(user_id, community_id)
+        self.assertEqual(permissions, permission_functions.MEMBER | permission_functions.MODERATOR)
+        self.assertEqual(permission_functions.get_permissions(self.other_user.id, community_id), 0)
+
+    def test_invalidation(self):
+        # The community_functions mutators keep the cached bitmask up to date
+        user_id, community_id = self.user.id, self.community.id
+        self.assertFalse(permission_functions.is_member(user_id, community_id))
+        community_functions.join(user_id, community_id)
+        self.assertTrue(permission_functions.is_member(user_id, community_id))
+        community_functions.ban_user(user_id, community_id)
+        self.assertTrue(permission_functions.is_banned(user_id, community_id))
+        community_functions.unban_user(user_id, community_id)
+        self.assertFalse(permission_functions.is_banned(user_id, community_id))
+        community_functions.add_moderator(user_id, community_id)
+        self.assertTrue(permission_functions.is_moderator(user_id, community_id))
+        community_functions.delete_moderator(user_id, community_id)
+        self.assertFalse(permission_functions.is_moderator(user_id, community_id))
+        self.assertTrue(permission_functions.is_member(user_id, community_id))
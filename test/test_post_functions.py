@@ -2,6 +2,8 @@ import unittest
 from backend.database import post_functions
 from backend.models import Post, User, Community, PostVote, db
 from test.helpers import setup_test_environment, create_test_user, create_test_community, create_test_post, cleanup
+from test.helpers import count_queries
+from datetime import datetime, timedelta
 from sqlalchemy import exc
 from sqlalchemy.orm import exc as orm_exc
 
@@ -97,8 +99,9 @@ class TestPostFunctions(unittest.TestCase):
         post = create_test_post(community, user)
         # Upvote it and check the karma
         post_functions.upvote(user.id, post.id)
-        # Should be 1
+        # Should be 1, and so should the author's karma
         self.assertEqual(post.karma, 1)
+        self.assertEqual(user.karma, 1)
         vote_obj = PostVote.query.filter(PostVote.user_id == user.id, PostVote.post_id == post.id).first()
         self.assertIsNotNone(vote_obj)
         self.assertTrue(vote_obj.vote_type) # True vote_type means upvote
@@ -179,6 +182,44 @@ class TestPostFunctions(unittest.TestCase):
         # cleanup
         cleanup(Post, PostVote, Community, User)
 
+    def test_revote(self):
+        # Voting again is a no-op, flipping a vote moves the karma by 2,
+        # and neither depends on how many votes the post already has
+        user = create_test_user()
+        community = create_test_community()
+        post = create_test_post(community, user)
+        user_id, post_id = user.id, post.id
+        post_functions.upvote(user_id, post_id)
+        post_functions.upvote(user_id, post_id)
+        self.assertEqual(post.karma, 1)
+        self.assertEqual(PostVote.query.filter(PostVote.post_id == post_id).count(), 1)
+        with count_queries() as statements:
+            post_functions.downvote(user_id, post_id)
+        # existence check, flip, post and author karma updates, and reading the new hot score
+        self.assertEqual(len(statements), 5)
+        self.assertEqual(post.karma, -1)
+        self.assertEqual(user.karma, -1)
+        vote_obj = PostVote.query.filter(PostVote.user_id == user_id, PostVote.post_id == post_id).first()
+        self.assertFalse(vote_obj.vote_type)
+        self.assertEqual(PostVote.query.filter(PostVote.post_id == post_id).count(), 1)
+        post_functions.unvote(user_id, post_id)
+        post_functions.unvote(user_id, post_id)
+        self.assertEqual(post.karma, 0)
+        self.assertEqual(PostVote.query.filter(PostVote.post_id == post_id).count(), 0)
+        cleanup(Post, PostVote, Community, User)
+
+    def test_duplicate_vote(self):
+        # The unique index doesn't allow two votes by the same user on the same post
+        user = create_test_user()
+        community = create_test_community()
+        post = create_test_post(community, user)
+        db.session.add(PostVote(user_id=user.id, post_id=post.id, vote_type=True))
+        db.session.commit()
+        db.session.add(PostVote(user_id=user.id, post_id=post.id, vote_type=False))
+        self.assertRaises(exc.IntegrityError, db.session.commit)
+        db.session.rollback()
+        cleanup(Post, PostVote, Community, User)
+
     def test_upvote_non_existent_post(self):
         # Try to upvote a post that doesn't exist
         user = create_test_user()
@@ -224,3 +265,56 @@ class TestPostFunctions(unittest.TestCase):
         self.assertRaises(ValueError, post_functions.edit_post, post.id, "", "test")
         self.assertRaises(ValueError, post_functions.edit_post, post.id, "test", "")
         cleanup(Post, Community, User)
+
+    #### get_posts_page(community_ids, order, cursor, count, since) ####
+
+    def test_get_posts_page(self):
+        # Paging through two communities gives every post once, in order
+        user = create_test_user()
+        communities = [Community(name="Paged {}".format(i), description="description") for i in range(2)]
+        db.session.add_all(communities)
+        db.session.commit()
+        community_ids = [community.id for community in communities]
+        start = datetime(2024, 6, 1)
+        posts = [Post(user_id=user.id, community_id=community_ids[i % 2], title="Post {}".format(i), body="Body",
+            post_time=start - timedelta(minutes=i // 2), karma=i % 3) for i in range(7)]
+        db.session.add_all(posts)
+        db.session.commit()
+        for order, key in (("new", lambda post: (post.post_time, post.id)), ("hot", lambda post: (post.hot_score, post.id))):
+            expected = [post.id for post in sorted(posts, key=key, reverse=True)]
+            seen = []
+            cursor = None
+            while True:
+                with count_queries() as statements:
+                    page, cursor = post_functions.get_posts_page(community_ids, order, cursor, count=3)
+                # The page's keys, then the posts themselves
+                self.assertEqual(len(statements), 2)
+                seen.extend(post.id for post in page)
+                if cursor is None:
+                    break
+            self.assertEqual(seen, expected)
+        # Only the recent ones
+        page, cursor = post_functions.get_posts_page(community_ids, "new", since=start - timedelta(minutes=1))
+        self.assertEqual(len(page), 4)
+        self.assertIsNone(cursor)
+        # Cursors can't be made up or used for another order
+        page, cursor = post_functions.get_posts_page(community_ids, "new", count=2)
+        self.assertRaises(ValueError, post_functions.get_posts_page, community_ids, "hot", cursor)
+        self.assertRaises(ValueError, post_functions.get_posts_page, community_ids, "new", "garbage")
+        self.assertRaises(ValueError, post_functions.get_posts_page, community_ids, "random")
+        cleanup(Post, Community, User)
+
+    def test_get_hot_posts(self):
+        # The front page pages through the hot feed the same way as through the database
+        user, community = create_test_user(), create_test_community()
+        start = datetime(2024, 6, 1)
+        db.session.add_all([Post(user_id=user.id, community_id=community.id, title="Post", body="Body",
+            post_time=start - timedelta(minutes=i)) for i in range(5)])
+        db.session.commit()
+        from_feed, cursor = post_functions.get_hot_posts([community.id], count=3)
+        from_database, database_cursor = post_functions.get_posts_page([community.id], "hot", count=3)
+        self.assertEqual(from_feed, from_database)
+        self.assertEqual(cursor, database_cursor)
+        self.assertEqual(post_functions.get_hot_posts([community.id], cursor, count=3)[0],
+                post_functions.get_posts_page([community.id], "hot", cursor, count=3)[0])
+        cleanup(Post, Community, User)
@@ -0,0 +1,87 @@
+import threading
+import unittest
+from unittest import mock
+from flask import current_app
+from backend.models import User, Community, db
+from backend.database import user_functions, community_functions
+from backend.prefix_index import PrefixIndex, username_index, community_index
+from test.helpers import setup_test_environment, cleanup, cleanup_relationships, create_test_user, count_queries
+
+class TestPrefixIndex(unittest.TestCase):
+    setup_test_environment()
+
+    def tearDown(self):
+        db.session.rollback()
+        cleanup_relationships()
+        cleanup(Community, User)
+
+    def test_complete(self):
+        index = PrefixIndex(User.username)
+        index.set_names(["bob", "Bobby", "alice", "bobcat", "BOB", "carol"])
+        # Case doesn't matter, the same name in different cases are both there
+        self.assertEqual(sorted(index.complete("Bo")), ["BOB", "Bobby", "bob", "bobcat"])
+        self.assertEqual(index.complete("bobb"), ["Bobby"])
+        self.assertEqual(len(index.complete("b", limit=2)), 2)
+        self.assertEqual(index.complete("d"), [])
+        self.assertEqual(index.complete(""), [])
+        self.assertTrue(index.contains("BOB"))
+        self.assertFalse(index.contains("Bob"))
+        index.add("Bob")
+        index.add("Bob")
+        self.assertTrue(index.contains("Bob"))
+        index.remove("bob")
+        index.remove("doesn't exist")
+        self.assertEqual(sorted(index.complete("bob")), ["BOB", "Bob", "Bobby", "bobcat"])
+
+    def test_kept_up_to_date(self):
+        # Loaded from the database once, then changed by the functions
+        create_test_user()
+        self.assertEqual(username_index.complete("sh"), ["shit"])
+        user_functions.register_user("shiny", "password", "shiny@example.com")
+        with count_queries() as statements:
+            self.assertEqual(username_index.complete("sh"), ["shiny", "shit"])
+        self.assertEqual(statements, [])
+        user_functions.delete_user(User.query.filter(User.username == "shiny").first().id)
+        self.assertEqual(username_index.complete("sh"), ["shit"])
+        user_id = User.query.first().id
+        community_functions.create_community("Gardening", "description", user_id)
+        self.assertEqual(community_index.complete("gar"), ["Gardening"])
+        community_functions.delete_community(Community.query.first().id)
+        self.assertEqual(community_index.complete("gar"), [])
+
+    def test_endpoints(self):
+        user_id = create_test_user().id
+        community_functions.create_community("Gardening", "description", user_id)
+        client = current_app.test_client()
+        self.assertEqual(client.get("/typeahead/communities?prefix=GA").json, {"matches": ["Gardening"]})
+        self.assertEqual(client.get("/typeahead/users?prefix=sh").json, {"matches": ["shit"], "taken": False})
+        self.assertEqual(client.get("/typeahead/users?prefix=shit").json, {"matches": ["shit"], "taken": True})
+        self.assertEqual(client.get("/typeahead/users").json, {"matches": [], "taken": False})
+
+    def test_background_reload(self):
+        # Once loaded, an out of date index is loaded again in the background, and served meanwhile
+        create_test_user()
+        index = PrefixIndex(User.username)
+        self.assertEqual(index.complete("sh"), ["shit"])
+        user_functions.register_user("shiny", "password", "shiny@example.com")
+        index.loaded -= index.max_age
+        reading, finish = threading.Event(), threading.Event()
+        build = index.build
+        def slow_build(names):
+            names = list(names)
+            reading.set()
+            finish.wait(5)
+            return build(names)
+        with mock.patch.object(index, "build", slow_build):
+            self.assertEqual(index.complete("sh"), ["shit"])
+            reloader = index.reloader
+            self.assertTrue(reading.wait(5))
+            # Not waiting for the load, which read the names before this one was added
+            with count_queries() as statements:
+                self.assertEqual(index.complete("sh"), ["shit"])
+            self.assertEqual(statements, [])
+            index.add("shore")
+            finish.set()
+            reloader.join(5)
+        self.assertEqual(index.complete("sh"), ["shiny", "shit", "shore"])
+        self.assertIsNone(index.reloader)
@@ -0,0 +1,20 @@
+import unittest
+from backend.database import query_audit
+from backend.models import Post
+from test.helpers import setup_test_environment
+
+class TestQueryAudit(unittest.TestCase):
+    setup_test_environment()
+
+    def test_no_full_scans(self):
+        # None of the application's known queries reads a whole table
+        for name, plan, tables in query_audit.audit():
+            self.assertEqual(tables, [], "{}: {}".format(name, plan))
+
+    def test_full_scans(self):
+        # A query on an unindexed column is reported
+        plan = query_audit.explain(Post.query.filter(Post.title == "title").statement)
+        self.assertEqual(query_audit.full_scans(plan), ["post"])
+        self.assertEqual(query_audit.full_scans(["SCAN memberships_1", "SCAN CONSTANT ROW", "SCAN anon_1"]), ["memberships"])
+        # Partial indexes only have the rows they were made for
+        self.assertEqual(query_audit.full_scans(["SCAN community USING INDEX community_private"]), [])
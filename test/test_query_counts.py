@@ -0,0 +1,84 @@
+# Query count regression tests.
+# These pin down how many SQL statements the common request flows issue,
+# so that a change in relationship loading doesn't silently add queries to every page view.
+import unittest
+from backend.database import user_functions, post_functions
+from backend.identity_cache import identity_cache
+from backend.models import User, Community, Post, db
+from passlib.hash import argon2
+from test.helpers import setup_test_environment, cleanup, cleanup_relationships, count_queries
+
+def create_user_with_communities(count):
+    # A user who's a member of <count> communities, and owner of the first one
+    salt = "salt"
+    password = argon2.using(**user_functions.hash_config).hash("password" + salt)
+    user_obj = User(username="query counter", password=password, salt=salt)
+    db.session.add(user_obj)
+    for i in range(count):
+        community = Community(name="Counted community {}".format(i), description="description")
+        community.users.append(user_obj)
+        if i == 0:
+            community.owners.append(user_obj)
+        db.session.add(community)
+    db.session.commit()
+    user_id = user_obj.id
+    # Start every flow from a clean state, like a new request would
+    db.session.expire_all()
+    identity_cache.clear()
+    return user_id
+
+class TestQueryCounts(unittest.TestCase):
+    setup_test_environment()
+
+    def tearDown(self):
+        identity_cache.clear()
+        cleanup_relationships()
+        cleanup(Post, Community, User)
+
+    def test_login_flow(self):
+        # authentication.login: verify_user() and get_user_by_name()
+        # Was 12 statements while every user relationship was loaded eagerly.
+        create_user_with_communities(3)
+        with count_queries() as statements:
+            self.assertTrue(user_functions.verify_user("query counter", "password"))
+            user_functions.get_user_by_name("query counter")
+        self.assertEqual(len(statements), 2)
+
+    def test_index_flow(self):
+        # authentication.get_logged_in_user and index.index, with a cold identity cache
+        # Was 6 statements: the user and all five of its community relationships.
+        user_id = create_user_with_communities(3)
+        with count_queries() as statements:
+            snapshot = user_functions.get_user_snapshot(user_id)
+            self.assertEqual(len(snapshot.communities), 3)
+        self.assertEqual(len(statements), 2)
+        # And none at all once the identity is cached
+        with count_queries() as statements:
+            user_functions.get_user_snapshot(user_id)
+        self.assertEqual(len(statements), 0)
+
+    def test_post_flow(self):
+        # post_functions.create_post
+        # Was 9 statements, 5 of which loaded user relationships that were never used.
+        user_id = create_user_with_communities(3)
+        community = Community.query.filter(Community.name == "Counted community 0").first()
+        community_id = community.id
+        db.session.expire_all()
+        with count_queries() as statements:
+            post_functions.create_post(user_id, community_id, "Title", "Body")
+        # Including the insert into the search index
+        self.assertEqual(len(statements), 5)
+
+    def test_load_user(self):
+        # Only the requested relationships are loaded, one statement each
+        user_id = create_user_with_communities(3)
+        with count_queries() as statements:
+            user_obj = user_functions.load_user(user_id)
+        self.assertEqual(len(statements), 1)
+        db.session.expire_all()
+        with count_queries() as statements:
+            user_obj = user_functions.load_user(user_id, with_=("communities", "owner"))
+            self.assertEqual(len(user_obj.communities), 3)
+            self.assertEqual(len(user_obj.owner), 1)
+        self.assertEqual(len(statements), 3)
+        self.assertRaises(AttributeError, user_functions.load_user, user_id, ("not_a_relationship",))
@@ -0,0 +1,78 @@
+# Test the login and registration rate limiter, backend/rate_limiter.py
+import os
+import tempfile
+import unittest
+from datetime import timedelta
+from flask import current_app
+from backend.models import User
+from backend.rate_limiter import RateLimiter, rate_limiter
+from test.helpers import setup_test_environment, count_queries
+
+class TestRateLimiter(unittest.TestCase):
+    setup_test_environment()
+    def test_limits(self):
+        limiter = RateLimiter({"ip": 3, "username": 2}, window=timedelta(seconds=60), buckets=1024)
+        start = 6000.0 # the start of a window
+        self.assertIsNone(limiter.hit([("ip", "1.1.1.1"), ("username", "someone")], start))
+        self.assertIsNone(limiter.hit([("ip", "1.1.1.1"), ("username", "someone")], start + 1))
+        # The username is over its limit, from any address
+        self.assertEqual(limiter.hit([("ip", "2.2.2.2"), ("username", "someone")], start + 15), 45)
+        self.assertIsNone(limiter.hit([("ip", "1.1.1.1"), ("username", "someone else")], start + 15))
+        self.assertIsNotNone(limiter.hit([("ip", "1.1.1.1")], start + 20))
+        self.assertIsNone(limiter.hit([("ip", "2.2.2.2")], start + 20))
+        # At the start of the next window, the 3 requests of the previous one all count
+        self.assertIsNotNone(limiter.hit([("ip", "1.1.1.1")], start + 60))
+        # Half way through it, half of them (1.5) count
+        self.assertIsNone(limiter.hit([("ip", "1.1.1.1")], start + 90))
+        self.assertIsNone(limiter.hit([("ip", "1.1.1.1")], start + 90))
+        self.assertIsNotNone(limiter.hit([("ip", "1.1.1.1")], start + 90))
+        # A window later, the 2 requests of the window before count
+        self.assertIsNone(limiter.hit([("ip", "1.1.1.1")], start + 120))
+        self.assertIsNotNone(limiter.hit([("ip", "1.1.1.1")], start + 120))
+        # Long after, nothing counts
+        for i in range(3):
+            self.assertIsNone(limiter.hit([("ip", "1.1.1.1")], start + 600))
+        limiter.clear()
+        self.assertIsNone(limiter.hit([("ip", "1.1.1.1")], start + 600))
+
+    def test_shared_file(self):
+        # Two limiters on the same file, like two worker processes, count together
+        path = os.path.join(tempfile.mkdtemp(), "rate_limits")
+        first = RateLimiter({"ip": 2}, buckets=1024)
+        second = RateLimiter({"ip": 2}, buckets=1024)
+        first.use_file(path)
+        second.use_file(path)
+        self.assertIsNone(first.hit([("ip", "1.1.1.1")], 6000.0))
+        self.assertIsNone(second.hit([("ip", "1.1.1.1")], 6000.0))
+        self.assertIsNotNone(first.hit([("ip", "1.1.1.1")], 6000.0))
+        self.assertEqual(os.path.getsize(path), first.size)
+
+    def test_login_limit(self):
+        client = current_app.test_client()
+        current_app.config["WTF_CSRF_ENABLED"] = False
+        rate_limiter.clear()
+        try:
+            limit = rate_limiter.limits["username"]
+            for i in range(limit):
+                response = client.post("/login", data={"username": "nobody", "password": "password"})
+                self.assertNotEqual(response.status_code, 429)
+            # Turned away before any query or hashing
+            with count_queries() as statements:
+                response = client.post("/login", data={"username": "nobody", "password": "password"})
+            self.assertEqual(response.status_code, 429)
+            self.assertIn("Retry-After", response.headers)
+            self.assertEqual(statements, [])
+            response = client.post("/register", data={"username": "nobody", "password": "password",
+                "password_confirm": "password", "email": "nobody@example.com"})
+            self.assertEqual(response.status_code, 429)
+            self.assertIsNone(User.query.filter(User.username == "nobody").first())
+            # Other pages aren't limited
+            self.assertEqual(client.get("/login").status_code, 200)
+            # Nor anything when the limits are turned off
+            current_app.config["RATE_LIMIT_ENABLED"] = False
+            response = client.post("/login", data={"username": "nobody", "password": "password"})
+            self.assertNotEqual(response.status_code, 429)
+        finally:
+            current_app.config["WTF_CSRF_ENABLED"] = True
+            current_app.config["RATE_LIMIT_ENABLED"] = True
+            rate_limiter.clear()
@@ -0,0 +1,87 @@
+import unittest
+from backend.models import User, Community, Post, Comment, db
+from backend.database import post_functions, comment_functions, community_functions, search_functions
+from test.helpers import setup_test_environment, cleanup, cleanup_relationships, create_test_user
+
+def result_ids(results, kind="post"):
+    return [result.id for result in results if result.kind == kind]
+
+class TestSearchFunctions(unittest.TestCase):
+    setup_test_environment()
+
+    def setUp(self):
+        self.user_id = create_test_user().id
+        community_functions.create_community("gardening", "Growing tomatoes and other plants", self.user_id)
+        self.community_id = Community.query.filter(Community.name == "gardening").first().id
+
+    def tearDown(self):
+        db.session.rollback()
+        cleanup_relationships()
+        cleanup(Comment, Post, Community, User)
+
+    def create_post(self, title, body, community_id=None):
+        post_functions.create_post(self.user_id, community_id or self.community_id, title, body)
+        return Post.query.filter(Post.title == title).first().id
+
+    def test_search(self):
+        body_match = self.create_post("Watering", "How often should tomatoes get water?")
+        title_match = self.create_post("Tomatoes", "Mine are turning yellow")
+        self.create_post("Potatoes", "Nothing about the other plant here")
+        comment_functions.create_comment(self.user_id, body_match, "My tomatoes get water every day")
+        comment_id = Comment.query.first().id
+        results, cursor = search_functions.search("tomatoes")
+        # A match in the title ranks higher
+        self.assertEqual(result_ids(results), [title_match, body_match])
+        self.assertEqual(result_ids(results, "comment"), [comment_id])
+        self.assertEqual(result_ids(results, "community"), [self.community_id])
+        self.assertIsNone(cursor)
+        # Every word has to match, and query syntax is just words
+        self.assertEqual(result_ids(search_functions.search("tomatoes water")[0], "comment"), [comment_id])
+        self.assertEqual(result_ids(search_functions.search('water" OR "yellow')[0]), [])
+        self.assertEqual(search_functions.search("  *** "), ([], None))
+        loaded = search_functions.load_results(results)
+        self.assertEqual([kind for kind, obj in loaded], [result.kind for result in results])
+
+    def test_pages(self):
+        # The cursor goes through all the results once
+        post_ids = [self.create_post("Post {}".format(i), "tomatoes " * (i % 4 + 1)) for i in range(12)]
+        found = []
+        cursor = None
+        while True:
+            results, cursor = search_functions.search("tomatoes", self.community_id, cursor, count=5)
+            found.extend(result_ids(results))
+            if cursor is None:
+                break
+        self.assertEqual(sorted(found), post_ids)
+        self.assertRaises(ValueError, search_functions.search, "tomatoes", None, "garbage")
+        # A cursor only works for its own search
+        cursor = search_functions.search("tomatoes", self.community_id, count=5)[1]
+        self.assertRaises(ValueError, search_functions.search, "potatoes", self.community_id, cursor)
+
+    def test_changes(self):
+        # Edits and deletions are searchable right away
+        post_id = self.create_post("Tomatoes", "Mine are turning yellow")
+        comment_functions.create_comment(self.user_id, post_id, "Too much water")
+        post_functions.edit_post(post_id, "Tomatoes", "Mine are turning brown")
+        self.assertEqual(result_ids(search_functions.search("yellow")[0]), [])
+        self.assertEqual(result_ids(search_functions.search("brown")[0]), [post_id])
+        post_functions.delete_post(post_id)
+        self.assertEqual(search_functions.search("brown")[0], [])
+        self.assertEqual(search_functions.search("water")[0], [])
+        # Rebuilding gives the same index
+        self.create_post("Cucumbers", "Growing cucumbers")
+        before = search_functions.search("growing")[0]
+        self.assertEqual(search_functions.rebuild_index(), 2)
+        self.assertEqual(search_functions.search("growing")[0], before)
+
+    def test_communities(self):
+        # Only one community, and private ones only for their members
+        community_functions.create_community("secret", "Secret tomatoes", self.user_id)
+        secret = Community.query.filter(Community.name == "secret").first()
+        secret.is_private = True
+        db.session.commit()
+        public_post = self.create_post("Public", "tomatoes")
+        secret_post = self.create_post("Secret", "tomatoes", secret.id)
+        self.assertEqual(result_ids(search_functions.search("tomatoes")[0]), [public_post])
+        self.assertEqual(sorted(result_ids(search_functions.search("tomatoes", member_of=[secret.id])[0])), [public_post, secret_post])
+        self.assertEqual(result_ids(search_functions.search("tomatoes", secret.id, member_of=[secret.id])[0]), [secret_post])
@@ -166,3 +166,105 @@ class TestTokenExpirationManager(unittest.TestCase):
         self.assertEqual(len(manager.expirations), 0)
         self.assertEqual(len(manager.tokens), 0)
         self.assertEqual(len(manager.token_expiration_time), 0)
+
+    def test_touch_granularity(self):
+        # Tokens are only refreshed once half of the session timeout has passed since the last refresh
+        manager = TokenExpirationManager(session_timeout=timedelta(seconds=4), expiration_proximity=timedelta(seconds=0.1),
+                touch_granularity=0.5)
+        t1 = "t1"
+        manager.add_token(t1, t1)
+        t1_exp = manager.get_expiration_time(t1)
+        # Use the token a few times within the first second, the expiration time must not move
+        for i in range(5):
+            sleep(0.2)
+            self.assertEqual(manager.get_token_object(t1), t1)
+            self.assertEqual(manager.get_expiration_time(t1), t1_exp)
+        self.assertEqual(len(manager.expirations), 1)
+        # Now wait until more than half of the timeout has passed, the next use refreshes it
+        print("\nSleeping 1.2 seconds")
+        sleep(1.2)
+        self.assertEqual(manager.get_token_object(t1), t1)
+        new_exp = manager.get_expiration_time(t1)
+        self.assertGreater(new_exp, t1_exp)
+        self.assertEqual(strip_milliseconds(new_exp), strip_milliseconds(datetime.utcnow() + timedelta(seconds=4)))
+        # It moved out of its old group and into a new one
+        self.assertEqual(len(manager.expirations[t1_exp]), 0)
+        self.assertEqual(manager.expirations[new_exp], {t1})
+        # And it's not refreshed again right away
+        self.assertEqual(manager.get_token_object(t1), t1)
+        self.assertEqual(manager.get_expiration_time(t1), new_exp)
+
+    def test_touch_granularity_expiration_proximity(self):
+        # A refreshed token still joins the newest expiration group if it's close enough
+        manager = TokenExpirationManager(session_timeout=timedelta(seconds=4), expiration_proximity=timedelta(seconds=1),
+                touch_granularity=0.25)
+        t1, t2 = "t1", "t2"
+        manager.add_token(t1, t1)
+        print("\nSleeping 1.5 seconds")
+        sleep(1.5)
+        manager.add_token(t2, t2)
+        t2_exp = manager.get_expiration_time(t2)
+        self.assertNotEqual(manager.get_expiration_time(t1), t2_exp)
+        # More than a quarter of the timeout has passed for t1, so it's refreshed
+        # into t2's group, which is within the expiration proximity
+        sleep(0.2)
+        manager.get_token_object(t1)
+        self.assertEqual(manager.get_expiration_time(t1), t2_exp)
+        self.assertEqual(manager.expirations[t2_exp], {t1, t2})
+        # t2 has only been alive for 0.2 seconds, so using it changes nothing
+        manager.get_token_object(t2)
+        self.assertEqual(manager.get_expiration_time(t2), t2_exp)
+        # Purging later still removes both of them together
+        print("Sleeping 4 seconds")
+        sleep(4)
+        manager.purge_expired_tokens()
+        self.assertEqual(len(manager.tokens), 0)
+        self.assertEqual(len(manager.expirations), 0)
+
+    def test_purge_statistics(self):
+        manager = TokenExpirationManager(session_timeout=timedelta(seconds=1), expiration_proximity=timedelta(seconds=0.5))
+        for i in range(100):
+            manager.add_token("token_{}".format(i), i)
+        print("\nSleeping 0.6 seconds")
+        sleep(0.6)
+        for i in range(50):
+            manager.add_token("later_token_{}".format(i), i)
+        print("Sleeping 1 second")
+        sleep(1)
+        self.assertEqual(manager.purge_expired_tokens(), (150, 2))
+        statistics = manager.get_purge_statistics()
+        self.assertEqual(statistics["sweeps"], 1)
+        self.assertEqual(statistics["tokens_purged"], 150)
+        self.assertEqual(statistics["groups_purged"], 2)
+        self.assertEqual(statistics["last_sweep_tokens"], 150)
+        self.assertEqual(statistics["last_sweep_groups"], 2)
+        self.assertGreater(statistics["last_sweep_duration"], 0)
+        # An empty sweep updates the last sweep, but not the totals
+        self.assertEqual(manager.purge_expired_tokens(), (0, 0))
+        statistics = manager.get_purge_statistics()
+        self.assertEqual(statistics["sweeps"], 2)
+        self.assertEqual(statistics["tokens_purged"], 150)
+        self.assertEqual(statistics["last_sweep_tokens"], 0)
+
+    def test_reaper(self):
+        # The background reaper purges the tokens without anyone calling purge_expired_tokens()
+        manager = TokenExpirationManager(session_timeout=timedelta(seconds=1), expiration_proximity=timedelta(seconds=0.5))
+        manager.start_reaper(timedelta(seconds=0.1))
+        # Starting it twice doesn't start a second thread
+        reaper_thread = manager.reaper_thread
+        manager.start_reaper(timedelta(seconds=0.1))
+        self.assertIs(manager.reaper_thread, reaper_thread)
+        for i in range(1000):
+            manager.add_token("token_{}".format(i), i)
+        print("\nSleeping 1.5 seconds")
+        sleep(1.5)
+        self.assertEqual(len(manager.tokens), 0)
+        self.assertEqual(len(manager.expirations), 0)
+        self.assertEqual(len(manager.token_expiration_time), 0)
+        self.assertEqual(manager.get_purge_statistics()["tokens_purged"], 1000)
+        manager.stop_reaper()
+        self.assertFalse(reaper_thread.is_alive())
+        # Nothing is purged after the reaper was stopped
+        manager.add_token("t1", "t1")
+        sleep(1.2)
+        self.assertEqual(manager.tokens, {"t1": "t1"})
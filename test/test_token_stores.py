@@ -0,0 +1,84 @@
+import os
+import unittest
+import multiprocessing
+from datetime import datetime, timedelta
+from time import sleep
+from backend.token_expiration_manager import TokenExpirationManager
+from backend.token_stores import SQLiteTokenStore
+
+STORE_PATH = "test/sessions.db"
+
+def create_manager(session_timeout=timedelta(minutes=1), expiration_proximity=timedelta(seconds=5)):
+    return TokenExpirationManager(session_timeout=session_timeout, expiration_proximity=expiration_proximity,
+            store=SQLiteTokenStore(STORE_PATH))
+
+def worker(worker_id, count):
+    # Runs in a separate process, just like a gunicorn worker would
+    manager = create_manager()
+    for i in range(count):
+        token = "worker_{}_{}".format(worker_id, i)
+        manager.add_token(token, {"worker": worker_id, "number": i})
+        # Touch the token and one created by the previous worker
+        manager.get_token_object(token)
+        manager.get_token_object("worker_{}_{}".format(worker_id - 1, i))
+
+def remove_store():
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(STORE_PATH + suffix):
+            os.remove(STORE_PATH + suffix)
+
+class TestSQLiteTokenStore(unittest.TestCase):
+    def setUp(self):
+        remove_store()
+
+    def tearDown(self):
+        remove_store()
+
+    def test_add_and_get_token(self):
+        manager = create_manager()
+        manager.add_token("t1", {"user_id": 1})
+        self.assertEqual(manager.get_token_object("t1"), {"user_id": 1})
+        self.assertIsNone(manager.get_token_object("t2"))
+        # The expiration time survives the round trip through the database exactly
+        expiration_time = manager.get_expiration_time("t1")
+        self.assertIsInstance(expiration_time, datetime)
+        self.assertEqual(manager.get_expiration_time("t1"), expiration_time)
+        # Tokens added close to each other share an expiration group
+        manager.add_token("t2", {"user_id": 2})
+        self.assertEqual(manager.get_expiration_time("t2"), expiration_time)
+
+    def test_expire_token(self):
+        manager = create_manager()
+        manager.add_token("t1", "t1")
+        manager.add_token("t2", "t2")
+        manager.expire_token("t1")
+        self.assertIsNone(manager.get_token_object("t1"))
+        self.assertIsNone(manager.get_expiration_time("t1"))
+        self.assertEqual(manager.get_token_object("t2"), "t2")
+
+    def test_purge_expired_tokens(self):
+        manager = create_manager(session_timeout=timedelta(seconds=1), expiration_proximity=timedelta(seconds=0.5))
+        for i in range(100):
+            manager.add_token("token_{}".format(i), i)
+        sleep(1.5)
+        manager.add_token("fresh", "fresh")
+        self.assertEqual(manager.store.purge(datetime.utcnow()), (100, 1))
+        self.assertIsNone(manager.get_token_object("token_0"))
+        self.assertEqual(manager.get_token_object("fresh"), "fresh")
+
+    def test_multiple_processes(self):
+        # Several worker processes read and write the same store concurrently.
+        # Every token created in any of them has to be visible to all the others.
+        create_manager() # create the table before the workers start
+        workers, count = 4, 200
+        processes = [multiprocessing.Process(target=worker, args=(w, count)) for w in range(workers)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+            self.assertEqual(process.exitcode, 0)
+        manager = create_manager()
+        for w in range(workers):
+            for i in range(count):
+                token_object = manager.get_token_object("worker_{}_{}".format(w, i))
+                self.assertEqual(token_object, {"worker": w, "number": i})
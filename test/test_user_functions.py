@@ -1,8 +1,9 @@
 # Test the various User database functions
 import unittest
 from datetime import datetime
-from backend.models import User, db, Community
-from backend.database import user_functions
+from backend.models import User, db, Community, Post, Comment, PostVote, CommentVote
+from backend.database import user_functions, community_functions
+from backend.identity_cache import identity_cache
 from passlib.hash import argon2
 from sqlalchemy import exc
 from sqlalchemy.orm import exc as orm_exc
@@ -175,3 +176,53 @@ class TestUserFunctions(unittest.TestCase):
             lists = (com.users, com.admins, com.owners, com.moderators, com.banned_users)
             # assert not in
             [self.assertNotIn(user_obj, list_obj) for list_obj in lists]
+
+    def test_get_user_snapshot(self):
+        # The snapshot is cached, and invalidated when the user's memberships change
+        user_obj = User(username="snapshot user", password="hash", salt="salt")
+        db.session.add(user_obj)
+        db.session.commit()
+        community = create_test_community("Snapshot community")
+        snapshot = user_functions.get_user_snapshot(user_obj.id)
+        self.assertEqual(snapshot.id, user_obj.id)
+        self.assertEqual(snapshot.username, "snapshot user")
+        self.assertEqual(snapshot.communities, ())
+        self.assertIs(user_functions.get_user_snapshot(user_obj.id), snapshot)
+        # Joining the community invalidates it
+        community_functions.join(user_obj.id, community.id)
+        snapshot = user_functions.get_user_snapshot(user_obj.id)
+        self.assertEqual([c.name for c in snapshot.communities], ["Snapshot community"])
+        # Deleting the user removes it
+        user_functions.delete_user(user_obj.id)
+        self.assertIsNone(identity_cache.get(user_obj.id))
+        self.assertIsNone(user_functions.get_user_snapshot(user_obj.id))
+        cleanup(Community)
+
+    def test_recompute_karma(self):
+        # Karma is rebuilt from the votes on the user's posts and comments
+        author = User(username="karma author", password="hash", salt="salt")
+        voter = User(username="karma voter", password="hash", salt="salt")
+        db.session.add_all([author, voter])
+        db.session.commit()
+        community = create_test_community("Karma community")
+        posts = [Post(user_id=author.id, community_id=community.id, title="Title", body="Body") for i in range(3)]
+        db.session.add_all(posts)
+        db.session.commit()
+        comment = Comment(user_id=voter.id, post_id=posts[0].id, text="Comment")
+        db.session.add(comment)
+        db.session.commit()
+        # The votes are added directly, so the stored karma is left at 0
+        db.session.add_all([PostVote(user_id=voter.id, post_id=post.id, vote_type=True) for post in posts])
+        db.session.add(PostVote(user_id=author.id, post_id=posts[0].id, vote_type=False))
+        db.session.add(CommentVote(user_id=author.id, comment_id=comment.id, vote_type=False))
+        db.session.commit()
+        author_id, voter_id = author.id, voter.id
+        self.assertEqual(user_functions.compute_karma(chunk_size=2), {author_id: 2, voter_id: -1})
+        # Only checking doesn't change anything
+        self.assertEqual(user_functions.recompute_karma(chunk_size=1, fix=False), (2, 2))
+        self.assertEqual(db.session.query(User.karma).filter(User.id == author_id).scalar(), 0)
+        self.assertEqual(user_functions.recompute_karma(chunk_size=1), (2, 2))
+        self.assertEqual(db.session.query(User.karma).filter(User.id == author_id).scalar(), 2)
+        self.assertEqual(db.session.query(User.karma).filter(User.id == voter_id).scalar(), -1)
+        self.assertEqual(user_functions.recompute_karma(chunk_size=1, fix=False), (2, 0))
+        cleanup(PostVote, CommentVote, Comment, Post, Community, User)
@@ -0,0 +1,156 @@
+import unittest
+from unittest import mock
+from datetime import timedelta
+from backend.models import User, Community, Post, PostVote, Comment, CommentVote, db
+from backend.vote_buffer import VoteBuffer
+from backend.database import vote_functions
+from test.helpers import setup_test_environment, cleanup, create_test_community, create_test_post, count_queries
+
+def create_voters(count):
+    users = [User(username="voter {}".format(i), password="hash", salt="salt") for i in range(count)]
+    db.session.add_all(users)
+    db.session.commit()
+    return [user.id for user in users]
+
+def get_stored_karma(post_id):
+    db.session.expire_all()
+    return Post.query.filter(Post.id == post_id).first().karma
+
+class TestVoteBuffer(unittest.TestCase):
+    setup_test_environment()
+
+    def setUp(self):
+        self.voters = create_voters(5)
+        community = create_test_community()
+        author = User.query.filter(User.id == self.voters[0]).first()
+        self.post_id = create_test_post(community, author).id
+        self.buffer = VoteBuffer(max_pending=100, flush_interval=timedelta(minutes=1))
+
+    def tearDown(self):
+        db.session.rollback()
+        cleanup(CommentVote, Comment, PostVote, Post, Community, User)
+
+    def test_buffered_karma(self):
+        # Votes show up in get_karma() right away, but only reach the database on flush()
+        for user_id in self.voters:
+            self.buffer.record("post", user_id, self.post_id, True)
+        self.assertEqual(get_stored_karma(self.post_id), 0)
+        self.assertEqual(PostVote.query.count(), 0)
+        self.assertEqual(self.buffer.get_karma("post", self.post_id, 0), 5)
+        self.assertEqual(self.buffer.flush(), 5)
+        self.assertEqual(get_stored_karma(self.post_id), 5)
+        self.assertEqual(PostVote.query.count(), 5)
+        # Nothing is counted twice after the flush
+        self.assertEqual(self.buffer.get_karma("post", self.post_id, 5), 5)
+        self.assertEqual(self.buffer.flush(), 0)
+
+    def test_deduplication(self):
+        # Only the latest vote of each user counts
+        user_id = self.voters[0]
+        self.buffer.record("post", user_id, self.post_id, True)
+        self.buffer.record("post", user_id, self.post_id, True)
+        self.assertEqual(self.buffer.get_karma("post", self.post_id, 0), 1)
+        self.buffer.record("post", user_id, self.post_id, False)
+        self.assertEqual(self.buffer.get_karma("post", self.post_id, 0), -1)
+        self.assertEqual(self.buffer.flush(), 1)
+        self.assertEqual(get_stored_karma(self.post_id), -1)
+        # Changing a vote that's already in the database
+        self.buffer.record("post", user_id, self.post_id, True)
+        self.assertEqual(self.buffer.get_karma("post", self.post_id, -1), 1)
+        self.buffer.record("post", user_id, self.post_id, None)
+        self.assertEqual(self.buffer.get_karma("post", self.post_id, -1), 0)
+        self.buffer.flush()
+        self.assertEqual(get_stored_karma(self.post_id), 0)
+        self.assertEqual(PostVote.query.count(), 0)
+
+    def test_batched_flush(self):
+        # One transaction, with a single statement to remove the previous votes, one to insert the new ones,
+        # and a single karma update for the post
+        for user_id in self.voters:
+            self.buffer.record("post", user_id, self.post_id, False)
+        with count_queries() as statements:
+            self.buffer.flush()
+        karma_updates = [statement for statement in statements if statement.startswith("UPDATE post SET karma")]
+        self.assertEqual(len(karma_updates), 1)
+        self.assertEqual(len([statement for statement in statements if statement.startswith("DELETE FROM post_vote")]), 1)
+        self.assertEqual(len([statement for statement in statements if statement.startswith("INSERT INTO post_vote")]), 1)
+        self.assertEqual(get_stored_karma(self.post_id), -5)
+
+    def test_size_threshold(self):
+        self.buffer.max_pending = 3
+        for user_id in self.voters[:2]:
+            self.buffer.record("post", user_id, self.post_id, True)
+        self.assertEqual(get_stored_karma(self.post_id), 0)
+        # The third distinct vote fills the buffer and flushes it
+        self.buffer.record("post", self.voters[2], self.post_id, True)
+        self.assertEqual(get_stored_karma(self.post_id), 3)
+
+    def test_comments(self):
+        comment = Comment(user_id=self.voters[0], post_id=self.post_id, text="comment")
+        db.session.add(comment)
+        db.session.commit()
+        comment_id = comment.id
+        self.buffer.record("comment", self.voters[1], comment_id, True)
+        self.assertEqual(self.buffer.get_karma("comment", comment_id, 0), 1)
+        # Votes on posts and comments with the same ID are kept apart
+        self.assertEqual(self.buffer.get_karma("post", comment_id, 0), 0)
+        self.buffer.flush()
+        self.assertEqual(CommentVote.query.count(), 1)
+
+    def test_non_existent_target(self):
+        # Dropped by the flush, which checks all the voters and targets in one query
+        self.buffer.record("post", self.voters[0], -1, True)
+        self.buffer.record("post", -1, self.post_id, True)
+        self.buffer.record("post", self.voters[1], self.post_id, True)
+        with count_queries() as statements:
+            self.assertEqual(self.buffer.flush(), 1)
+        # One read before the writes of the votes
+        self.assertTrue(statements[0].startswith("SELECT"))
+        self.assertFalse(statements[1].startswith("SELECT"))
+        self.assertEqual(PostVote.query.count(), 1)
+        self.assertEqual(get_stored_karma(self.post_id), 1)
+        self.assertEqual(dict(self.buffer.deltas), {})
+
+    def test_no_reads_when_recording(self):
+        with count_queries() as statements:
+            for user_id in self.voters:
+                self.buffer.record("post", user_id, self.post_id, True)
+        self.assertEqual(statements, [])
+
+    def test_vote_during_flush(self):
+        # The user votes again while a flush is writing their earlier vote
+        user_id = self.voters[0]
+        self.buffer.record("post", user_id, self.post_id, True)
+        apply_votes = vote_functions.apply_votes
+        def vote_again(*args):
+            self.buffer.record("post", user_id, self.post_id, False)
+            return apply_votes(*args)
+        with mock.patch.object(vote_functions, "apply_votes", vote_again):
+            self.assertEqual(self.buffer.flush(), 1)
+        self.assertEqual(get_stored_karma(self.post_id), 1)
+        self.assertEqual(self.buffer.get_karma("post", self.post_id, 1), -1)
+        self.assertEqual(self.buffer.flush(), 1)
+        self.assertEqual(get_stored_karma(self.post_id), -1)
+        self.assertEqual(self.buffer.get_karma("post", self.post_id, -1), -1)
+        self.assertEqual(PostVote.query.count(), 1)
+        # Voting the same way again after the flush changes nothing
+        self.buffer.record("post", user_id, self.post_id, False)
+        self.assertEqual(self.buffer.get_karma("post", self.post_id, -1), -1)
+        self.buffer.flush()
+        self.assertEqual(get_stored_karma(self.post_id), -1)
+
+    def test_failed_flush_with_new_vote(self):
+        # The user votes again while a flush is writing their vote, and that flush fails
+        user_id = self.voters[0]
+        self.buffer.record("post", user_id, self.post_id, True)
+        def vote_again_and_fail(*args):
+            self.buffer.record("post", user_id, self.post_id, False)
+            raise RuntimeError("database error")
+        with mock.patch.object(vote_functions, "apply_votes", vote_again_and_fail):
+            self.assertRaises(RuntimeError, self.buffer.flush)
+        # Only the new vote counts
+        self.assertEqual(self.buffer.get_karma("post", self.post_id, 0), -1)
+        self.assertEqual(self.buffer.flush(), 1)
+        self.assertEqual(get_stored_karma(self.post_id), -1)
+        self.assertEqual(self.buffer.get_karma("post", self.post_id, -1), -1)
+        self.assertEqual(dict(self.buffer.deltas), {})